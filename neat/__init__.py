@@ -7,10 +7,16 @@ if not os.environ.get('DISPLAY'):
 
 from neat.trees.stree import STree
 from neat.trees.stree import SNode
+from neat.trees.stree import SubTreeView
+
+from neat.trees.arraytree import ArrayTree
+from neat.trees.spatialindex import SegmentIndex
 
 from neat.trees.morphtree import MorphTree
 from neat.trees.morphtree import MorphNode
 from neat.trees.morphtree import MorphLoc
+from neat.trees.morphtree import LocArray
+from neat.trees.morphtree import MorphTreeView
 
 from neat.trees.phystree import PhysTree
 from neat.trees.phystree import PhysNode
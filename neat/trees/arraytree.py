@@ -0,0 +1,322 @@
+"""
+File contains:
+
+    - :class:`ArrayTree`
+
+Author: W. Wybo
+"""
+
+import numpy as np
+
+
+class ArrayTree(object):
+    '''
+    Compact array representation (struct-of-arrays) of the topology and the
+    node attributes of a tree. Rows correspond to nodes and are ordered
+    according to the depth-first iteration order of the tree (preorder), so
+    that the parent of a node always comes before the node itself.
+
+    Not intended to be constructed directly, use :func:`STree.getArrayTree`.
+    The array tree is a snapshot of the tree at the moment of its construction.
+
+    Attributes
+    ----------
+        nodes: list of :class:`SNode`
+            The nodes corresponding to the rows
+        index: numpy.array of ints
+            The indices of the nodes
+        parent: numpy.array of ints
+            The row of the parent of each node, ``-1`` for the root
+        depth: numpy.array of ints
+            The number of nodes between each node and the root
+        child_ptr, child_ind: numpy.array of ints
+            Child lists in compressed sparse row format, the rows of the
+            children of the node at row ``i`` are
+            ``child_ind[child_ptr[i]:child_ptr[i+1]]``
+        size: numpy.array of ints
+            The number of nodes in the subtree of each node, including the node.
+            Since rows are in preorder, the row of a node and its row plus its
+            size are the entry and exit times of an Euler tour of the tree, so
+            that the subtree of the node at row ``i`` are the rows ``i`` to
+            ``i+size[i]``
+        preorder, postorder, bfsorder: numpy.array of ints
+            Permutations of the rows according to resp. a depth-first ordering
+            where parents precede children, a depth-first ordering where
+            children precede parents and a breadth-first ordering
+        level_ptr: numpy.array of ints
+            The rows at depth ``d`` are ``bfsorder[level_ptr[d]:level_ptr[d+1]]``
+        columns: dict of numpy.array
+            The node attributes, keys are the attribute names
+    '''
+
+    def __init__(self, nodes, columns=None):
+        '''
+        Parameters
+        ----------
+            nodes: list of :class:`SNode`
+                The nodes of the tree in depth-first order, starting with the
+                root
+            columns: dict of numpy.array (optional)
+                The node attributes, each array has the number of nodes as its
+                first dimension
+        '''
+        n_node = len(nodes)
+        self.nodes = nodes
+        self.index = np.array([node.index for node in nodes], dtype=int)
+        # map from node index to row
+        self._rowmap = {index: ii for ii, index in enumerate(self.index)}
+        self._rowlookup = None
+        # parent and depth arrays
+        self.parent = -np.ones(n_node, dtype=int)
+        self.depth = np.zeros(n_node, dtype=int)
+        for ii, node in enumerate(nodes[1:]):
+            prow = self._rowmap[node.parent_node.index]
+            self.parent[ii+1] = prow
+            self.depth[ii+1] = self.depth[prow] + 1
+        # child lists in CSR format, rows are in preorder so a stable sort on
+        # the parent row retains the order of the child nodes
+        n_child = np.bincount(self.parent[1:], minlength=n_node) \
+                  if n_node > 1 else np.zeros(n_node, dtype=int)
+        self.child_ptr = np.concatenate(([0], np.cumsum(n_child))).astype(int)
+        self.child_ind = np.argsort(self.parent[1:], kind='mergesort') + 1
+        # breadth-first order and the level structure
+        self.bfsorder = np.argsort(self.depth, kind='mergesort')
+        n_level = np.bincount(self.depth) if n_node > 0 else np.zeros(0, dtype=int)
+        self.level_ptr = np.concatenate(([0], np.cumsum(n_level))).astype(int)
+        # subtree sizes
+        self.size = self.accumulateUp(np.ones(n_node, dtype=int))
+        # traversal orders, a node's postorder position equals the number of
+        # nodes preceding it in preorder that are not its ancestors plus the
+        # number of nodes in its subtree
+        self.preorder = np.arange(n_node)
+        self.postorder = np.zeros(n_node, dtype=int)
+        self.postorder[self.preorder + self.size - 1 - self.depth] = self.preorder
+        # node attributes
+        self.columns = {} if columns is None else columns
+        # ancestor table for lowest common ancestor queries and nearest
+        # bifurcations, constructed on first use
+        self._ancestors = None
+        self._up_bifurcations = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        '''
+        Returns the column with the given name
+        '''
+        return self.columns[key]
+
+    def getRows(self, indices):
+        '''
+        Convert node indices to rows
+
+        Parameters
+        ----------
+            indices: int or iterable of ints
+                The node indices
+
+        Returns
+        -------
+            int or numpy.array of ints
+        '''
+        if np.ndim(indices) == 0:
+            return self._rowmap[indices]
+        indices = np.asarray(indices, dtype=int)
+        if self._rowlookup is None:
+            # dense lookup table from node index to row, constructed on first
+            # use
+            n_index = self.index.max() + 1 if len(self.index) > 0 else 0
+            rowlookup = -np.ones(n_index, dtype=int)
+            rowlookup[self.index] = np.arange(len(self.index))
+            self._rowlookup = rowlookup
+        rows = -np.ones(indices.shape, dtype=int)
+        valid = (indices >= 0) & (indices < len(self._rowlookup))
+        rows[valid] = self._rowlookup[indices[valid]]
+        if np.any(rows < 0):
+            raise KeyError(int(indices[rows < 0].flat[0]))
+        return rows
+
+    def getChildRows(self, row):
+        '''
+        Returns the rows of the children of the node at the given row
+
+        Parameters
+        ----------
+            row: int
+
+        Returns
+        -------
+            numpy.array of ints
+        '''
+        return self.child_ind[self.child_ptr[row]:self.child_ptr[row+1]]
+
+    def getNChildren(self):
+        return np.diff(self.child_ptr)
+
+    n_children = property(getNChildren)
+
+    def getSubtreeRows(self, row):
+        '''
+        Returns the rows of the nodes in the subtree of the node at the given
+        row, which form a contiguous range in preorder
+
+        Parameters
+        ----------
+            row: int
+
+        Returns
+        -------
+            numpy.array of ints
+        '''
+        return np.arange(row, row + self.size[row])
+
+    def getUpBifurcations(self):
+        '''
+        For each node, find the nearest ancestor that has more than one child
+        (or the root if there is no such ancestor), together with the child of
+        that ancestor on the path to the node. Constructed level by level on
+        first use.
+
+        Returns
+        -------
+            (numpy.array of ints, numpy.array of ints)
+                The rows of the bifurcation nodes and of their children on the
+                path to each node, ``-1`` for the root
+        '''
+        if self._up_bifurcations is None:
+            n_node = len(self)
+            brows = -np.ones(n_node, dtype=int)
+            crows = -np.ones(n_node, dtype=int)
+            is_bifurcation = self.n_children > 1
+            if n_node > 0:
+                is_bifurcation[0] = True
+            for rows in self.getLevels()[1:]:
+                prows = self.parent[rows]
+                is_bif = is_bifurcation[prows]
+                brows[rows] = np.where(is_bif, prows, brows[prows])
+                crows[rows] = np.where(is_bif, rows, crows[prows])
+            self._up_bifurcations = (brows, crows)
+        return self._up_bifurcations
+
+    def getLevels(self):
+        '''
+        Returns the rows grouped per depth level, starting at the root
+
+        Returns
+        -------
+            list of numpy.array of ints
+        '''
+        return [self.bfsorder[self.level_ptr[dd]:self.level_ptr[dd+1]] \
+                for dd in xrange(len(self.level_ptr)-1)]
+
+    def accumulateUp(self, vals):
+        '''
+        Sum values over the subtree of each node, by proceeding level by level
+        from the deepest nodes to the root.
+
+        Parameters
+        ----------
+            vals: numpy.array
+                Values associated with each node (first dimension)
+
+        Returns
+        -------
+            numpy.array
+                The sum of the values of all nodes in the subtree of each node
+        '''
+        acc = np.array(vals, copy=True)
+        for rows in self.getLevels()[:0:-1]:
+            np.add.at(acc, self.parent[rows], acc[rows])
+        return acc
+
+    def accumulateDown(self, vals):
+        '''
+        Sum values on the path from the root to each node, by proceeding level
+        by level from the root to the deepest nodes.
+
+        Parameters
+        ----------
+            vals: numpy.array
+                Values associated with each node (first dimension)
+
+        Returns
+        -------
+            numpy.array
+                The sum of the values of all nodes on the path between the root
+                and each node, including both
+        '''
+        acc = np.array(vals, copy=True)
+        for rows in self.getLevels()[1:]:
+            acc[rows] += acc[self.parent[rows]]
+        return acc
+
+    def getAncestorTable(self):
+        '''
+        Returns the binary lifting table of the tree, row ``k`` contains the
+        ``2**k``'th ancestor of each node, or the root if the node has less than
+        ``2**k`` ancestors. The table is constructed on first use.
+
+        Returns
+        -------
+            numpy.array of ints (``ndim=2``)
+        '''
+        if self._ancestors is None:
+            n_node = len(self)
+            max_depth = int(self.depth.max()) if n_node > 0 else 0
+            n_k = max(1, max_depth.bit_length())
+            ancestors = np.zeros((n_k, n_node), dtype=int)
+            if n_node > 0:
+                ancestors[0] = np.maximum(self.parent, 0)
+            for kk in xrange(1, n_k):
+                ancestors[kk] = ancestors[kk-1][ancestors[kk-1]]
+            self._ancestors = ancestors
+        return self._ancestors
+
+    def isAncestor(self, rows1, rows2):
+        '''
+        Check whether the nodes at `rows1` are ancestors of the nodes at `rows2`.
+        Every node is considered an ancestor of itself. Since rows are in
+        preorder, the subtree of the node at row ``i`` are the rows
+        ``i`` to ``i+size[i]``, so that this is a constant time check.
+
+        Parameters
+        ----------
+            rows1, rows2: int or numpy.array of ints
+
+        Returns
+        -------
+            bool or numpy.array of bools
+        '''
+        rows1 = np.asarray(rows1); rows2 = np.asarray(rows2)
+        return (rows1 <= rows2) & (rows2 < rows1 + self.size[rows1])
+
+    def getLCA(self, rows1, rows2):
+        '''
+        Find the lowest common ancestors of pairs of nodes through binary
+        lifting, in ``O(log(max_depth))`` per pair.
+
+        Parameters
+        ----------
+            rows1, rows2: int or numpy.array of ints
+                The rows of the nodes in each pair, arrays are broadcasted
+                against each other
+
+        Returns
+        -------
+            int or numpy.array of ints
+                The rows of the lowest common ancestors
+        '''
+        scalar = np.ndim(rows1) == 0 and np.ndim(rows2) == 0
+        rows1, rows2 = np.broadcast_arrays(np.asarray(rows1, dtype=int),
+                                           np.asarray(rows2, dtype=int))
+        is_anc = self.isAncestor(rows1, rows2)
+        ancestors = self.getAncestorTable()
+        # move the first nodes up to the highest ancestor that is not an
+        # ancestor of the second nodes
+        rows = rows1.copy()
+        for anc in ancestors[::-1]:
+            cand = anc[rows]
+            rows = np.where(self.isAncestor(cand, rows2), rows, cand)
+        lca = np.where(is_anc, rows1, ancestors[0][rows])
+        return int(lca) if scalar else lca
@@ -32,6 +32,9 @@ class CompartmentNode(SNode):
             Coupling conductance of compartment with parent compartment (uS).
             Ignore if node is the root
     '''
+    __slots__ = ('loc_ind', 'ca', 'g_c', 'e_eq', 'currents', 'concmechs',
+                 'expansion_points')
+
     def __init__(self, index, loc_ind=None, ca=1., g_c=0., g_l=1e-2, e_eq=-75.):
         super(CompartmentNode, self).__init__(index)
         # location index this node corresponds to
@@ -249,6 +252,7 @@ class CompartmentTree(STree):
         else:
             e_eq = self._permuteToTree(np.array(e_eq))
         for ii, node in enumerate(self): node.e_eq = e_eq[ii]
+        self.bumpRevision('parameter')
 
     def getEEq(self):
         return np.array([node.e_eq for node in self])
@@ -268,11 +272,13 @@ class CompartmentTree(STree):
             for node, sv in zip(self, svs[to_tree_inds]):
                 node.setExpansionPoint(channel_name, statevar=sv,
                                        channel_storage=self.channel_storage)
+        self.bumpRevision('parameter')
 
     def removeExpansionPoints(self):
         for node in self:
             for channel_name in node.currents:
                 node.setExpansionPoint(channel_name, statevar='asymptotic')
+        self.bumpRevision('parameter')
 
     def fitEL(self):
         '''
@@ -287,6 +293,7 @@ class CompartmentTree(STree):
         # set the leak reversals
         for ii, node in enumerate(self):
             node.currents['L'][1] = e_l[ii]
+        self.bumpRevision('parameter')
 
     def _fun(self, e_l):
         # set the leak reversal potentials
@@ -322,6 +329,7 @@ class CompartmentTree(STree):
         for ii, node in enumerate(self):
             node.addCurrent(channel_name, e_rev=e_rev,
                             channel_storage=self.channel_storage)
+        self.bumpRevision('parameter')
 
     def addConcMech(self, ion, params={}):
         '''
@@ -335,6 +343,7 @@ class CompartmentTree(STree):
             parameters for the concentration mechanism (only used for NEURON model)
         '''
         for node in self: node.addConcMech(ion, params=params)
+        self.bumpRevision('parameter')
 
     def _permuteToTreeInds(self):
         return np.array([node.loc_ind for node in self])
@@ -463,11 +472,14 @@ class CompartmentTree(STree):
                              'has to be \'tree\' or \'locs\'')
 
 
-    def _preprocessZMatArg(self, z_mat_arg):
+    def _preprocessZMatArg(self, z_mat_arg, permute=True):
+        # without permutation, e.g. for memory-mapped arrays that are permuted
+        # block by block
+        permute_ = self._permuteToTree if permute else lambda z_mat: z_mat
         if isinstance(z_mat_arg, np.ndarray):
-            return [self._permuteToTree(z_mat_arg)]
+            return [permute_(z_mat_arg)]
         elif isinstance(z_mat_arg, list):
-            return [self._permuteToTree(z_mat) for z_mat in z_mat_arg]
+            return [permute_(z_mat) for z_mat in z_mat_arg]
         else:
             raise ValueError('`z_mat_arg` has to be ``np.ndarray`` or list of ' + \
                              '`np.ndarray`')
@@ -515,8 +527,18 @@ class CompartmentTree(STree):
         z_mat_arg = z_mat_arg_
         return freqs, w_freqs, z_mat_arg
 
+    def _reduceLstSq(self, mats_feature, vecs_target):
+        '''
+        Reduce the stacked least squares problem to an equivalent triangular
+        system with as many rows as there are parameters, by QR decomposition,
+        so that a fit can be accumulated over blocks of the impedance matrix
+        '''
+        q_mat, r_mat = np.linalg.qr(np.concatenate(mats_feature, 0))
+        return [r_mat], [np.dot(q_mat.conj().T, np.concatenate(vecs_target))]
+
 
-    def computeGMC(self, z_mat_arg, e_eqs=None, channel_names=None):
+    def computeGMC(self, z_mat_arg, e_eqs=None, channel_names=None,
+                         block_size=None):
         '''
         Fit the models' membrane and coupling conductances to a given steady
         state impedance matrix.
@@ -531,8 +553,14 @@ class CompartmentTree(STree):
         e_eqs: np.ndarray (ndim = 1, dtype = float) or float
             The equilibirum potentials in each compartment for each
             evaluation of ``z_mat``
+        block_size: int or None
+            If given, the fit is accumulated over blocks of this number of
+            rows of the impedance matrices, which can then be memory-mapped
+            arrays that do not fit in memory
         '''
-        z_mat_arg = self._preprocessZMatArg(z_mat_arg)
+        z_mat_arg = self._preprocessZMatArg(z_mat_arg, permute=False)
+        inds = self._permuteToTreeInds()
+        n_row = len(self) if block_size is None else block_size
         e_eqs, _ = self._preprocessEEqs(e_eqs)
         assert len(z_mat_arg) == len(e_eqs)
         if channel_names is None:
@@ -545,13 +573,20 @@ class CompartmentTree(STree):
             self.setEEq(e_eq)
             # create the matrices for linear fit
             g_struct = self._toStructureTensorGMC(channel_names)
-            tensor_feature = np.einsum('ij,jkl->ikl', z_mat, g_struct)
-            tshape = tensor_feature.shape
-            mat_feature_aux = np.reshape(tensor_feature,
-                                         (tshape[0]*tshape[1], tshape[2]))
-            vec_target_aux = np.reshape(np.eye(len(self)), (len(self)*len(self),))
-            mats_feature.append(mat_feature_aux)
-            vecs_target.append(vec_target_aux)
+            for i0 in xrange(0, len(self), n_row):
+                i1 = min(i0 + n_row, len(self))
+                z_rows = np.asarray(z_mat[inds[i0:i1]])[:,inds]
+                tensor_feature = np.einsum('ij,jkl->ikl', z_rows, g_struct)
+                tshape = tensor_feature.shape
+                mat_feature_aux = np.reshape(tensor_feature,
+                                             (tshape[0]*tshape[1], tshape[2]))
+                vec_target_aux = np.reshape(np.eye(len(self))[i0:i1],
+                                            ((i1-i0)*len(self),))
+                mats_feature.append(mat_feature_aux)
+                vecs_target.append(vec_target_aux)
+                if block_size is not None:
+                    mats_feature, vecs_target = \
+                                self._reduceLstSq(mats_feature, vecs_target)
         mat_feature = np.concatenate(mats_feature, 0)
         vec_target = np.concatenate(vecs_target)
         # linear regression fit
@@ -614,6 +649,7 @@ class CompartmentTree(STree):
                 for channel_name in channel_names:
                     node.currents[channel_name][0] = g_vec[kk]
                     kk += 1
+        self.bumpRevision('parameter')
 
     def _preprocessExpansionPoints(self, svs, e_eqs):
         if svs is None:
@@ -693,7 +729,8 @@ class CompartmentTree(STree):
 
     def computeGM(self, z_mat_arg, e_eqs=None, freqs=0.,
                     w_e_eqs=None, w_freqs=None,
-                    channel_names=None, other_channel_names=None):
+                    channel_names=None, other_channel_names=None,
+                    freq_block_size=None):
         '''
         Fit the models' conductances to a given impedance matrix.
 
@@ -715,9 +752,13 @@ class CompartmentTree(STree):
             types that have been added to the tree are included.
         other_channel_names: ``None`` or `list` of `string`
             The channels that are not to be included in the fit
+        freq_block_size: int or None
+            If given, the fit is accumulated over blocks of this number of
+            frequencies of the impedance matrices, which can then be
+            memory-mapped arrays that do not fit in memory
         '''
 
-        z_mat_arg = self._preprocessZMatArg(z_mat_arg)
+        z_mat_arg = self._preprocessZMatArg(z_mat_arg, permute=False)
         e_eqs, w_e_eqs = self._preprocessEEqs(e_eqs, w_e_eqs)
         assert len(z_mat_arg) == len(e_eqs)
         freqs, w_freqs, z_mat_arg = self._preprocessFreqs(freqs, w_freqs=w_freqs, z_mat_arg=z_mat_arg)
@@ -728,26 +769,34 @@ class CompartmentTree(STree):
         # do the fit
         mats_feature = []
         vecs_target = []
+        n_freq = len(freqs) if freq_block_size is None else freq_block_size
         for z_mat, e_eq, w_e_eq in zip(z_mat_arg, e_eqs, w_e_eqs):
             # set equilibrium conductances
             self.setEEq(e_eq)
-            # feature matrix
-            g_struct = self._toStructureTensorGM(freqs=freqs, channel_names=channel_names)
-            tensor_feature = np.einsum('oij,ojkl->oikl', z_mat, g_struct)
-            tensor_feature *= w_freqs[:,np.newaxis,np.newaxis,np.newaxis]
-            tshape = tensor_feature.shape
-            mat_feature_aux = np.reshape(tensor_feature,
-                                         (tshape[0]*tshape[1]*tshape[2], tshape[3]))
-            # target vector
-            g_mat = self.calcSystemMatrix(freqs, channel_names=other_channel_names,
-                                                 indexing='tree')
-            zg_prod = np.einsum('oij,ojk->oik', z_mat, g_mat)
-            mat_target_aux = np.eye(len(self))[np.newaxis,:,:] - zg_prod
-            mat_target_aux *= w_freqs[:,np.newaxis,np.newaxis]
-            vec_target_aux = np.reshape(mat_target_aux, (tshape[0]*tshape[1]*tshape[2],))
-            # store feature matrix and target vector for this voltage
-            mats_feature.append(mat_feature_aux * np.sqrt(w_e_eq))
-            vecs_target.append(vec_target_aux * np.sqrt(w_e_eq))
+            for f0 in xrange(0, len(freqs), n_freq):
+                f1 = min(f0 + n_freq, len(freqs))
+                freqs_ = freqs[f0:f1]; w_freqs_ = w_freqs[f0:f1]
+                z_mat_ = self._permuteToTree(z_mat[f0:f1])
+                # feature matrix
+                g_struct = self._toStructureTensorGM(freqs=freqs_, channel_names=channel_names)
+                tensor_feature = np.einsum('oij,ojkl->oikl', z_mat_, g_struct)
+                tensor_feature *= w_freqs_[:,np.newaxis,np.newaxis,np.newaxis]
+                tshape = tensor_feature.shape
+                mat_feature_aux = np.reshape(tensor_feature,
+                                             (tshape[0]*tshape[1]*tshape[2], tshape[3]))
+                # target vector
+                g_mat = self.calcSystemMatrix(freqs_, channel_names=other_channel_names,
+                                                      indexing='tree')
+                zg_prod = np.einsum('oij,ojk->oik', z_mat_, g_mat)
+                mat_target_aux = np.eye(len(self))[np.newaxis,:,:] - zg_prod
+                mat_target_aux *= w_freqs_[:,np.newaxis,np.newaxis]
+                vec_target_aux = np.reshape(mat_target_aux, (tshape[0]*tshape[1]*tshape[2],))
+                # store feature matrix and target vector for this voltage
+                mats_feature.append(mat_feature_aux * np.sqrt(w_e_eq))
+                vecs_target.append(vec_target_aux * np.sqrt(w_e_eq))
+                if freq_block_size is not None:
+                    mats_feature, vecs_target = \
+                                self._reduceLstSq(mats_feature, vecs_target)
         mat_feature = np.concatenate(mats_feature)
         vec_target = np.concatenate(vecs_target)
         # linear regression fit
@@ -786,8 +835,10 @@ class CompartmentTree(STree):
             for channel_name in channel_names:
                 node.currents[channel_name][0] = g_vec[kk]
                 kk += 1
+        self.bumpRevision('parameter')
 
-    def computeC(self, freqs, z_mat_arg, e_eqs=None, channel_names=None):
+    def computeC(self, freqs, z_mat_arg, e_eqs=None, channel_names=None,
+                       freq_block_size=None):
         '''
         Fit the models' capacitances to a given impedance matrix.
 
@@ -801,8 +852,12 @@ class CompartmentTree(STree):
                 The impedance matrix. The first dimension corresponds to the
                 frequency, the second and third dimension contain the impedance
                 matrix for that frequency
+            freq_block_size: int or None
+                If given, the fit is accumulated over blocks of this number of
+                frequencies of the impedance matrices, which can then be
+                memory-mapped arrays that do not fit in memory
         '''
-        z_mat_arg = self._preprocessZMatArg(z_mat_arg)
+        z_mat_arg = self._preprocessZMatArg(z_mat_arg, permute=False)
         if isinstance(freqs, float) or isinstance(freqs, complex):
             freqs = np.array([freqs])
         if e_eqs is None:
@@ -823,24 +878,32 @@ class CompartmentTree(STree):
         # do the fit
         mats_feature = []
         vecs_target = []
-        for zf_mat, e_eq in zip(z_mat_arg, e_eqs):
+        n_freq = len(freqs) if freq_block_size is None else freq_block_size
+        for zf_mat, e_eq in zip(z_mat_arg_, e_eqs):
             # set equilibrium conductances
             self.setEEq(e_eq)
-            # compute c structure tensor
-            c_struct = self._toStructureTensorC(freqs)
-            # feature matrix
-            tensor_feature = np.einsum('oij,ojkl->oikl', zf_mat, c_struct)
-            tshape = tensor_feature.shape
-            mat_feature_aux = np.reshape(tensor_feature, (tshape[0]*tshape[1]*tshape[2], tshape[3]))
-            # target vector
-            g_mat = self.calcSystemMatrix(freqs, channel_names=channel_names,
-                                                 with_ca=False, indexing='tree')
-            zg_prod = np.einsum('oij,ojk->oik', zf_mat, g_mat)
-            mat_target = np.eye(len(self))[np.newaxis,:,:] - zg_prod
-            vec_target_aux = np.reshape(mat_target,(tshape[0]*tshape[1]*tshape[2],))
-            # store feature matrix and target vector for this voltage
-            mats_feature.append(mat_feature_aux)
-            vecs_target.append(vec_target_aux)
+            for f0 in xrange(0, len(freqs), n_freq):
+                f1 = min(f0 + n_freq, len(freqs))
+                freqs_ = freqs[f0:f1]
+                zf_mat_ = self._permuteToTree(zf_mat[f0:f1])
+                # compute c structure tensor
+                c_struct = self._toStructureTensorC(freqs_)
+                # feature matrix
+                tensor_feature = np.einsum('oij,ojkl->oikl', zf_mat_, c_struct)
+                tshape = tensor_feature.shape
+                mat_feature_aux = np.reshape(tensor_feature, (tshape[0]*tshape[1]*tshape[2], tshape[3]))
+                # target vector
+                g_mat = self.calcSystemMatrix(freqs_, channel_names=channel_names,
+                                                      with_ca=False, indexing='tree')
+                zg_prod = np.einsum('oij,ojk->oik', zf_mat_, g_mat)
+                mat_target = np.eye(len(self))[np.newaxis,:,:] - zg_prod
+                vec_target_aux = np.reshape(mat_target,(tshape[0]*tshape[1]*tshape[2],))
+                # store feature matrix and target vector for this voltage
+                mats_feature.append(mat_feature_aux)
+                vecs_target.append(vec_target_aux)
+                if freq_block_size is not None:
+                    mats_feature, vecs_target = \
+                                self._reduceLstSq(mats_feature, vecs_target)
         mat_feature = np.concatenate(mats_feature, 0)
         vec_target = np.concatenate(vecs_target)
         # linear regression fit
@@ -864,8 +927,9 @@ class CompartmentTree(STree):
     def _toTreeC(self, c_vec):
         for ii, node in enumerate(self):
             node.ca = c_vec[ii]
+        self.bumpRevision('parameter')
 
-    def computeGC(self, freqs, zf_mat, z_mat=None):
+    def computeGC(self, freqs, zf_mat, z_mat=None, freq_block_size=None):
         '''
         Fit the models' conductances and capacitances to a given impedance matrix
         evaluated at a number of frequency points in the Fourrier domain.
@@ -883,6 +947,9 @@ class CompartmentTree(STree):
                 function tries to find index of freq = 0 in ``freqs`` to
                 determine ``z_mat``. If no such element is found, a
                 ``ValueError`` is raised
+            freq_block_size: int or None
+                If given, the capacitance fit is accumulated over blocks of
+                this number of frequencies (see :func:`computeC`)
 
         Raises
         ------
@@ -891,14 +958,14 @@ class CompartmentTree(STree):
         '''
         if z_mat is None:
             try:
-                ind0 = np.where(np.abs(freqs) < 1e-12)[0]
+                ind0 = np.where(np.abs(freqs) < 1e-12)[0][0]
                 z_mat = zf_mat[ind0,:,:].real
             except IndexError:
                 raise ValueError("No zero frequency in `freqs`")
         # compute leak and coupling conductances
-        self.computeG(z_mat)
+        self.computeGMC(z_mat)
         # compute capacitances
-        self.computeC(freqs, zf_mat)
+        self.computeC(freqs, zf_mat, freq_block_size=freq_block_size)
 
     # def computeGC_(self, freqs, zf_mat):
     #     '''
@@ -11,18 +11,109 @@ Author: W. Wybo
 import numpy as np
 
 import copy
+import multiprocessing
 
 import morphtree
 from morphtree import MorphLoc
+from morphtree import LocArray
 from phystree import PhysNode, PhysTree
 from neat.channels import channelcollection
 
 
+# task executed by the worker processes of `GreensTree._mapFrequencyBlocks`,
+# inherited from the parent process when the workers are forked
+_worker_task = None
+
+def _initWorker(task):
+    global _worker_task
+    _worker_task = task
+
+def _runWorker(f_block):
+    _worker_task(*f_block)
+
+
+def _getBlocks(n, block_size=None):
+    '''
+    Start and stop indices of consecutive blocks of at most `block_size`
+    elements, a single block if `block_size` is ``None``
+    '''
+    block_size = n if block_size is None else block_size
+    block_size = max(block_size, 1)
+    return [(i0, min(i0 + block_size, n)) for i0 in xrange(0, n, block_size)]
+
+
+def _impedanceBufferProperty(name):
+    '''
+    Creates a property of a :class:`GreensNode` that stores the frequency
+    dependent quantity `name` in a row of the impedance buffer of the node
+    '''
+    def getter(self):
+        if self._z_buffer is None:
+            raise AttributeError('\'%s\' has not been computed'%name)
+        return self._z_buffer[self._buffer_rows[name]]
+    def setter(self, value):
+        self._z_buffer[self._buffer_rows[name]] = value
+    return property(getter, setter)
+
 
 class GreensNode(PhysNode):
+    '''
+    Node for :class:`GreensTree`. The frequency dependent quantities of the
+    node are stored in the rows of a 2d impedance buffer, which is a view on
+    the buffer of the full tree when the impedances are computed through
+    :func:`GreensTree.setImpedance`.
+    '''
+    __slots__ = ('expansion_points', 'R_', 'L_', '_z_buffer')
+    # names of the frequency dependent quantities, in the order of the rows of
+    # the impedance buffer
+    impedance_names = ('z_m', 'z_a', 'gamma', 'z_c', 'z_distal', 'z_proximal',
+                       'gammaL', 'z_cp', 'z_cd', 'wrongskian',
+                       'z_00', 'z_11', 'z_01')
+    _buffer_rows = {name: ii for ii, name in enumerate(impedance_names)}
+
+    z_m = _impedanceBufferProperty('z_m')
+    z_a = _impedanceBufferProperty('z_a')
+    gamma = _impedanceBufferProperty('gamma')
+    z_c = _impedanceBufferProperty('z_c')
+    z_distal = _impedanceBufferProperty('z_distal')
+    z_proximal = _impedanceBufferProperty('z_proximal')
+    gammaL = _impedanceBufferProperty('gammaL')
+    z_cp = _impedanceBufferProperty('z_cp')
+    z_cd = _impedanceBufferProperty('z_cd')
+    wrongskian = _impedanceBufferProperty('wrongskian')
+    z_00 = _impedanceBufferProperty('z_00')
+    z_11 = _impedanceBufferProperty('z_11')
+    z_01 = _impedanceBufferProperty('z_01')
+
     def __init__(self, index, p3d):
         super(GreensNode, self).__init__(index, p3d)
         self.expansion_points = {}
+        self._z_buffer = None
+
+    def setImpedanceBuffer(self, freqs, z_buffer=None):
+        '''
+        Set the array in which the frequency dependent quantities of the node
+        are stored
+
+        Parameters
+        ----------
+        freqs: `np.ndarray`
+            The frequencies at which the impedances are evaluated
+        z_buffer: `np.ndarray` (optional)
+            Array of shape ``(len(GreensNode.impedance_names),) + freqs.shape``,
+            typically a view on the buffer of the tree. If not given, a new
+            array is allocated.
+        '''
+        if z_buffer is None:
+            dtype = complex if np.iscomplexobj(freqs) else float
+            z_buffer = np.zeros((len(self.impedance_names),) + np.shape(freqs),
+                                dtype=dtype)
+        self._z_buffer = z_buffer
+
+    def _checkImpedanceBuffer(self, freqs):
+        if self._z_buffer is None or \
+           self._z_buffer.shape[1:] != np.shape(freqs):
+            self.setImpedanceBuffer(freqs)
 
     def rescaleLengthRadius(self):
         self.R_ = self.R * 1e-4 # convert to cm
@@ -86,6 +177,7 @@ class GreensNode(PhysNode):
                 statevar = channel.findMaxCurrentVGiven(self.e_eq, self.freqs,
                                                         self.currents[channel_name][1])
         self.expansion_points[channel_name] = statevar
+        self._setModified()
 
     def calcMembraneImpedance(self, freqs, channel_storage=None):
         '''
@@ -122,7 +214,7 @@ class GreensNode(PhysNode):
         return 1. / (2. * np.pi * self.R_ * g_m_aux)
 
     def setImpedance(self, freqs, channel_storage=None):
-        self.counter = 0
+        self._checkImpedanceBuffer(freqs)
         self.z_m = self.calcMembraneImpedance(freqs, channel_storage=channel_storage)
         self.z_a = self.r_a / (np.pi * self.R_**2)
         self.gamma = np.sqrt(self.z_a / self.z_m)
@@ -197,13 +289,23 @@ class GreensNode(PhysNode):
 
 
 class SomaGreensNode(GreensNode):
+    __slots__ = ()
+    # the soma impedance and the input impedance are stored in the rows of
+    # resp. the membrane impedance and the impedance at x=0
+    _buffer_rows = dict(GreensNode._buffer_rows,
+                        z_soma=GreensNode._buffer_rows['z_m'],
+                        z_in=GreensNode._buffer_rows['z_00'])
+
+    z_soma = _impedanceBufferProperty('z_soma')
+    z_in = _impedanceBufferProperty('z_in')
+
     def calcMembraneImpedance(self, freqs, channel_storage=None):
         z_m = super(SomaGreensNode, self).calcMembraneImpedance(freqs, channel_storage=channel_storage)
         # rescale for soma surface instead of cylinder radius
         return z_m / (2. * self.R_)
 
     def setImpedance(self, freqs, channel_storage=None):
-        self.counter = 0
+        self._checkImpedanceBuffer(freqs)
         self.z_soma = self.calcMembraneImpedance(freqs, channel_storage=channel_storage)
 
     def collapseBranchToLeaf(self):
@@ -234,6 +336,7 @@ class GreensTree(PhysTree):
     def __init__(self, file_n=None, types=[1,3,4]):
         super(GreensTree, self).__init__(file_n=file_n, types=types)
         self.freqs = None
+        self._impedance_buffer = None
 
     def createCorrespondingNode(self, node_index, p3d=None):
         '''
@@ -250,9 +353,25 @@ class GreensTree(PhysTree):
             return GreensNode(node_index, p3d)
 
     @morphtree.computationalTreetypeDecorator
-    def setImpedance(self, freqs, pprint=False):
+    def setImpedance(self, freqs, pprint=False, recompute_flag=False,
+                           n_workers=None, freq_block_size=None):
         '''
-        Set the boundary impedances for each node in the tree
+        Set the boundary impedances for each node in the tree. The impedances
+        are only recomputed if the frequencies or the revision of the tree have
+        changed since the last call (see :func:`STree.getRevision`).
+
+        The frequency dependent quantities of all nodes are computed at once,
+        as arrays of shape ``(n_node,) + freqs.shape`` in the depth-first
+        order of the nodes, and the boundary impedances are obtained by
+        sweeping level by level through the tree, first from the leafs to the
+        root and then from the root to the leafs.
+
+        When only the parameters of some nodes have changed since the last
+        evaluation at the same frequencies, the impedances are updated
+        incrementally and in place: the node specific quantities are
+        recomputed for the modified nodes only, the distal boundary
+        impedances only along their paths to the root, and the proximal
+        boundary impedances only for the nodes where they change.
 
         Parameters
         ----------
@@ -260,43 +379,388 @@ class GreensTree(PhysTree):
             frequencies at which the impedances will be evaluated [Hz]
         pprint: bool (default ``False``)
             whether or not to print info on the progression of the algorithm
+        recompute_flag: bool (default ``False``)
+            force recomputing the impedances. Parameters modified through the
+            methods of the tree or the nodes are detected, node attributes
+            that are assigned directly require a call to
+            :func:`STree.bumpRevision`.
+        n_workers: int or None
+            if larger than one, the sweeps for blocks of frequencies are
+            distributed over this number of forked worker processes, that
+            write into an impedance buffer in shared memory
+        freq_block_size: int or None
+            number of frequencies swept at once. If ``None``, all
+            frequencies are swept at once, or divided evenly over the
+            workers.
 
         '''
+        cache = self.getRevisionCache('impedance')
+        if not recompute_flag and 'freqs' in cache and \
+           np.shape(cache['freqs']) == np.shape(freqs) and \
+           np.array_equal(cache['freqs'], freqs):
+            return
         self.freqs = freqs
-        # set the node specific impedances
-        for node in self:
+        arr = self.getArrayTree(recompute_flag=recompute_flag)
+        nodes = arr.nodes
+        # the state from which the impedances can be updated incrementally
+        state = self.getRevisionCache('impedance_state', kinds=('structure',))
+        rows = None if recompute_flag else \
+               self._getModifiedRows(arr, freqs, state)
+        if rows is not None and len(rows) <= len(nodes) // 2:
+            if len(rows) > 0:
+                self._updateImpedance(arr, freqs, rows, state)
+            cache['freqs'] = np.array(freqs, copy=True)
+            return
+        # the frequency dependent quantities of all nodes are stored in one
+        # buffer of shape (n_quantity, n_node) + freqs.shape, in shared memory
+        # if the sweeps are distributed over worker processes
+        dtype = complex if np.iscomplexobj(freqs) else float
+        parallel = n_workers is not None and n_workers > 1
+        self._impedance_buffer = self._createOutputArray(
+                (len(GreensNode.impedance_names), len(nodes)) + np.shape(freqs),
+                dtype=dtype, shared=parallel)
+        for ii, node in enumerate(nodes):
+            node.setImpedanceBuffer(freqs, self._impedance_buffer[:,ii])
             node.rescaleLengthRadius()
-            node.setImpedance(freqs, channel_storage=self.channel_storage)
-        # recursion
-        self._impedanceFromLeaf(self.leafs[0], self.leafs[1:], pprint=pprint)
-        self._impedanceFromRoot(self.root)
-        # clean
-        for node in self:
-            node.counter = 0
-            node.setImpedanceArrays()
-
-    def _impedanceFromLeaf(self, node, leafs, pprint=False):
-        if pprint:
-            print 'Forward sweep: ' + str(node)
-        pnode = node.parent_node
-        # log how many times recursion has passed at node
-        if not self.isLeaf(node):
-            node.counter += 1
-        # if the number of childnodes of node is equal to the amount of times
-        # the recursion has passed node, the distal impedance can be set. Otherwise
-        # we start a new recursion at another leaf.
-        if node.counter == len(node.child_nodes):
-            node.setImpedanceDistal()
-            if not self.isRoot(node):
-                self._impedanceFromLeaf(pnode, leafs, pprint=pprint)
-        elif len(leafs) > 0:
-                self._impedanceFromLeaf(leafs[0], leafs[1:], pprint=pprint)
-
-    def _impedanceFromRoot(self, node):
-        if node != self.root:
-            node.setImpedanceProximal()
-        for cnode in node.child_nodes:
-            self._impedanceFromRoot(cnode)
+        # the sweeps proceed on arrays of shape (n_node, n_freq)
+        coeffs, profiles = self._getMembraneAdmittanceTerms(arr, freqs)
+        g_m = np.dot(coeffs, profiles)
+        buf = self._impedance_buffer.reshape(
+                                self._impedance_buffer.shape[:2] + (-1,))
+        tanh_ = self._createOutputArray(buf.shape[1:], dtype=dtype,
+                                        shared=parallel)
+        cosh_ = self._createOutputArray(buf.shape[1:], dtype=dtype,
+                                        shared=parallel)
+        def sweep(f0, f1):
+            self._sweepImpedances(arr, buf[:,:,f0:f1], g_m[:,f0:f1],
+                                  tanh_[:,f0:f1], cosh_[:,f0:f1],
+                                  pprint=pprint)
+        self._mapFrequencyBlocks(sweep, buf.shape[-1],
+                                 freq_block_size=freq_block_size,
+                                 n_workers=n_workers)
+        state.clear()
+        state.update(array_tree=arr, freqs=np.array(freqs, copy=True),
+                     tanh=tanh_, cosh=cosh_)
+        self._storeParameterState(arr, state)
+        cache['freqs'] = np.array(freqs, copy=True)
+
+    def _storeParameterState(self, arr, state, rows=None):
+        '''
+        Stores the parameters of the nodes for which the impedances have been
+        computed, to find the modified nodes at the next evaluation. If `rows`
+        is given, only the parameters of the nodes in these rows have changed.
+        '''
+        columns = state.get('columns')
+        if rows is None or set(columns) != set(arr.columns):
+            state['columns'] = {key: np.array(column, copy=True) \
+                                for key, column in arr.columns.iteritems()}
+        else:
+            for key, column in arr.columns.iteritems():
+                columns[key][rows] = column[rows]
+        if rows is None:
+            state['expansion_points'] = [dict(node.expansion_points) \
+                                         for node in arr.nodes]
+        else:
+            for row in rows:
+                state['expansion_points'][row] = \
+                        dict(arr.nodes[row].expansion_points)
+
+    def _getModifiedRows(self, arr, freqs, state):
+        '''
+        Returns the rows of the nodes whose parameters differ from those
+        for which the impedances have last been computed, or ``None`` if the
+        impedances can not be updated incrementally
+        '''
+        if state.get('array_tree') is not arr or \
+           np.shape(state['freqs']) != np.shape(freqs) or \
+           not np.array_equal(state['freqs'], freqs):
+            return None
+        n_node = len(arr.nodes)
+        modified = np.zeros(n_node, dtype=bool)
+        columns, columns_ = arr.columns, state['columns']
+        for key in set(columns) | set(columns_):
+            # columns of channels that are not present are zero
+            diff = np.not_equal(columns.get(key, 0.), columns_.get(key, 0.))
+            modified |= np.any(diff.reshape(n_node, -1), axis=1)
+        for ii, (node, eps_) in enumerate(zip(arr.nodes,
+                                              state['expansion_points'])):
+            eps = node.expansion_points
+            if set(eps) != set(eps_) or \
+               any(eps[key] is not eps_[key] for key in eps):
+                modified[ii] = True
+        return np.where(modified)[0]
+
+    def _updateImpedance(self, arr, freqs, rows, state):
+        '''
+        Updates the impedances in place after the parameters of the nodes in
+        the given rows have been modified
+        '''
+        for row in rows:
+            arr.nodes[row].rescaleLengthRadius()
+        coeffs, profiles = self._getMembraneAdmittanceTerms(arr, freqs,
+                                                            rows=rows)
+        buf = self._impedance_buffer.reshape(
+                                self._impedance_buffer.shape[:2] + (-1,))
+        self._sweepImpedances(arr, buf, np.dot(coeffs, profiles),
+                              state['tanh'], state['cosh'], rows=rows)
+        self._storeParameterState(arr, state, rows=rows)
+
+    def _mapFrequencyBlocks(self, task, n_freq, freq_block_size=None,
+                                  n_workers=None):
+        '''
+        Execute `task(f0, f1)` for consecutive blocks of frequencies, in a pool
+        of forked worker processes if `n_workers` is larger than one. The
+        workers inherit the tree, and the task should write its results to
+        memory that is shared with the parent process.
+
+        Parameters
+        ----------
+        task: callable
+            called with the start and stop index of each block of frequencies
+        n_freq: int
+            the number of frequencies
+        freq_block_size: int or None
+            number of frequencies per block. If ``None``, the frequencies are
+            divided evenly over the workers.
+        n_workers: int or None
+            the number of worker processes
+        '''
+        n_workers = 1 if n_workers is None else max(n_workers, 1)
+        if freq_block_size is None:
+            freq_block_size = -(-n_freq // n_workers)
+        f_blocks = _getBlocks(n_freq, freq_block_size)
+        if n_workers == 1 or len(f_blocks) == 1:
+            for f_block in f_blocks:
+                task(*f_block)
+        else:
+            pool = multiprocessing.Pool(min(n_workers, len(f_blocks)),
+                                        initializer=_initWorker,
+                                        initargs=(task,))
+            try:
+                pool.map(_runWorker, f_blocks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+
+    def _getMembraneAdmittanceTerms(self, arr, freqs, rows=None):
+        '''
+        Returns the specific membrane admittance of all nodes as a sum of
+        frequency profiles multiplied by node specific coefficients. The
+        linearized contribution of an ion channel is evaluated once for all
+        nodes that share the same equilibrium and reversal potentials.
+
+        Parameters
+        ----------
+        arr: :class:`ArrayTree`
+            the array tree of the computational tree
+        freqs: `np.ndarray`
+            The frequencies at which the admittance is to be evaluated
+        rows: `np.ndarray` of ints or None
+            If given, the admittance is only evaluated for the nodes in these
+            rows
+
+        Returns
+        -------
+        coeffs: `np.ndarray` (``shape=(n_node, n_term)``)
+            The coefficients of the terms at each (selected) node
+        profiles: `np.ndarray` (``shape=(n_term, freqs.size)``)
+            The frequency profiles of the terms, the specific membrane
+            admittance (uS/cm^2) is ``np.dot(coeffs, profiles)``
+        '''
+        sel = slice(None) if rows is None else rows
+        nodes = arr.nodes if rows is None else [arr.nodes[row] for row in rows]
+        n_node = len(nodes)
+        e_eq = arr['e_eq'][sel]
+        freqs_ = np.reshape(freqs, (1, -1))
+        # capacitive and leak term
+        coeffs = [arr['c_m'][sel], arr['g_L'][sel]]
+        profiles = [freqs_, np.ones_like(freqs_)]
+        channel_names = set()
+        for node in nodes: channel_names.update(node.currents.keys())
+        for channel_name in sorted(channel_names - set('L')):
+            g = arr['g_' + channel_name][sel]; e = arr['e_' + channel_name][sel]
+            rows = np.where(g > 1e-10)[0]
+            if len(rows) == 0:
+                continue
+            channel = nodes[rows[0]].getCurrent(channel_name,
+                                        channel_storage=self.channel_storage)
+            svs = [nodes[row].expansion_points[channel_name] for row in rows]
+            asymptotic = np.array([sv is None for sv in svs], dtype=bool)
+            # nodes linearized around the asymptotic state variables, grouped
+            # by equilibrium and reversal potential
+            rows_a = rows[asymptotic]
+            v_e = np.array([e_eq[rows_a], e[rows_a]]).T
+            v_e_unique, inds = np.unique(v_e, axis=0, return_inverse=True)
+            for kk, (v, e_rev) in enumerate(v_e_unique):
+                coeff = np.zeros(n_node)
+                coeff[rows_a[inds == kk]] = -g[rows_a[inds == kk]]
+                coeffs.append(coeff)
+                profiles.append(np.reshape(
+                        channel.computeLinSum(v, freqs, e_rev), (1, -1)))
+            # nodes with their own expansion point
+            for row, sv in zip(rows[~asymptotic],
+                               [sv for sv in svs if sv is not None]):
+                coeff = np.zeros(n_node)
+                coeff[row] = -g[row]
+                coeffs.append(coeff)
+                profiles.append(np.reshape(
+                        channel.computeLinSum(e_eq[row], freqs, e[row],
+                                              statevars=sv), (1, -1)))
+        return np.array(coeffs).T, np.concatenate(profiles, axis=0)
+
+    def _sweepImpedances(self, arr, buf, g_m, tanh_, cosh_, rows=None,
+                               pprint=False):
+        '''
+        Computes the frequency dependent quantities of all nodes. The sweeps
+        are formulated in terms of admittances, so that leafs have a zero
+        distal admittance instead of an infinite distal impedance. The
+        admittances are derived from the boundary impedances in the buffer
+        when they are needed, so that the sweeps only visit the nodes whose
+        quantities change.
+
+        Parameters
+        ----------
+        arr: :class:`ArrayTree`
+            the array tree of the computational tree
+        buf: `np.ndarray` (``shape=(n_quantity, n_node, n_freq)``)
+            The impedance buffer in which the quantities are stored
+        g_m: `np.ndarray` (``shape=(n_node, n_freq)``)
+            The specific membrane admittance of the nodes (uS/cm^2)
+        tanh_, cosh_: `np.ndarray` (``shape=(n_node, n_freq)``)
+            The hyperbolic functions of ``gamma * L`` of the nodes, zero for
+            the soma
+        rows: `np.ndarray` of ints or None
+            If given, the sorted rows of the nodes whose parameters have been
+            modified, and `g_m` only contains these rows. The buffer, `tanh_`
+            and `cosh_` should then contain the quantities of the previous
+            evaluation, which are updated in place: the node specific
+            quantities for the modified nodes, the distal boundary impedances
+            for their ancestors, and the proximal boundary impedances for the
+            nodes where they change, i.e. the subtrees of the modified nodes
+            and of the nodes that branch off their paths to the root.
+        pprint: bool (default ``False``)
+            whether or not to print info on the progression of the algorithm
+        '''
+        buf = dict(zip(GreensNode.impedance_names, buf))
+        n_node = len(buf['z_m'])
+        if rows is None:
+            sel, dsel = slice(None), slice(1, None)
+        else:
+            sel, dsel = rows, rows[rows > 0]
+        # node specific impedances, the soma only has a membrane impedance,
+        # rescaled for the soma surface instead of the cylinder radius
+        R_ = arr['R'][sel,None] * 1e-4 # to cm
+        z_m = buf['z_m']
+        z_m[sel] = 1. / (2. * np.pi * R_ * g_m)
+        if rows is None or rows[0] == 0:
+            z_m[0] /= 2. * R_[0]
+        R_ = arr['R'][dsel,None] * 1e-4; L_ = arr['L'][dsel,None] * 1e-4
+        z_a = buf['z_a'][dsel] = arr['r_a'][dsel,None] / (np.pi * R_**2)
+        gamma = buf['gamma'][dsel] = np.sqrt(z_a / z_m[dsel])
+        buf['z_c'][dsel] = z_a / gamma
+        gammaL = buf['gammaL'][dsel] = gamma * L_
+        # hyperbolic functions of gamma * L, from exp(-2 gamma L) to avoid
+        # overflow and cancellation
+        em1 = np.expm1(-2. * gammaL)
+        tanh_[dsel] = -em1 / (2. + em1)
+        with np.errstate(divide='ignore', over='ignore'):
+            cosh_[dsel] = (2. + em1) / (2. * np.exp(-gammaL))
+        z_c = buf['z_c']
+        def impedanceTerms(r):
+            # z_c tanh(gamma L) and tanh(gamma L) / z_c of the rows r > 0
+            return z_c[r] * tanh_[r], tanh_[r] / z_c[r]
+        def distalAdmittance(r):
+            y_d = np.zeros_like(buf['z_distal'][r])
+            np.divide(1., buf['z_distal'][r], out=y_d,
+                      where=np.isfinite(buf['z_distal'][r]))
+            return y_d
+        def rootAdmittance(r):
+            # admittance of the subtree of the nodes in the rows r > 0,
+            # collapsed to their proximal end
+            zt, yt = impedanceTerms(r); y_d = distalAdmittance(r)
+            return (y_d + yt) / (1. + zt * y_d)
+        def leafAdmittance(r):
+            # admittance of the tree without the subtree of the nodes in the
+            # rows r, collapsed to their distal end
+            y_l = np.empty((len(r),) + z_m.shape[1:], dtype=z_m.dtype)
+            soma = r == 0
+            y_l[soma] = 1. / z_m[0]
+            zt, yt = impedanceTerms(r[~soma])
+            y_p = 1. / buf['z_proximal'][r[~soma]]
+            y_l[~soma] = (y_p + yt) / (1. + zt * y_p)
+            return y_l
+        # the subtree admittance changes for the modified nodes and their
+        # ancestors, the distal admittance for the ancestors only
+        n_child = arr.getNChildren()
+        swept = np.zeros(n_node, dtype=bool)
+        if rows is None:
+            swept[:] = True
+            arows = np.where(n_child > 0)[0]
+            buf['z_distal'][:] = np.infty
+        else:
+            swept[rows] = True
+            ancestor = np.zeros(n_node, dtype=bool)
+            arows = [rows[:0]]
+            prows = np.unique(arr.parent[rows[rows > 0]])
+            while len(prows) > 0:
+                prows = prows[~ancestor[prows]]
+                ancestor[prows] = True
+                arows.append(prows)
+                prows = np.unique(arr.parent[prows[prows > 0]])
+            arows = np.concatenate(arows)
+            swept[arows] = True
+        # ancestors grouped per level, from the leafs to the root
+        arows = arows[np.argsort(arr.depth[arows], kind='mergesort')]
+        depths = arr.depth[arows]
+        for prows in np.split(arows, np.flatnonzero(np.diff(depths)) + 1)[::-1]:
+            if len(prows) == 0:
+                continue
+            if pprint:
+                print 'Forward sweep: level ' + str(arr.depth[prows[0]] + 1)
+            crows = arr.child_ind[morphtree._concatenateRanges(
+                                        arr.child_ptr[prows], n_child[prows])]
+            # all child nodes have been passed, so the distal admittance of
+            # the nodes can be set
+            y_distal = np.add.reduceat(rootAdmittance(crows),
+                                np.cumsum(n_child[prows]) - n_child[prows],
+                                axis=0)
+            z_distal = np.full_like(y_distal, np.infty)
+            np.divide(1., y_distal, out=z_distal, where=y_distal != 0.)
+            buf['z_distal'][prows] = z_distal
+        # the proximal admittance changes for all nodes below a node whose
+        # leaf admittance has changed, and for the siblings of modified nodes
+        # and their ancestors
+        n_swept_child = np.bincount(arr.parent[1:][swept[1:]],
+                                    minlength=n_node)
+        changed = swept if rows is None else np.zeros(n_node, dtype=bool)
+        changed[sel] = True
+        active = np.array([0])
+        while len(active) > 0:
+            crows = arr.child_ind[morphtree._concatenateRanges(
+                                        arr.child_ptr[active], n_child[active])]
+            prows = arr.parent[crows]
+            prox = changed[prows] | (n_swept_child[prows] > swept[crows])
+            crows_, prows_ = crows[prox], prows[prox]
+            buf['z_proximal'][crows_] = 1. / (leafAdmittance(prows_) + \
+                    distalAdmittance(prows_) - rootAdmittance(crows_))
+            changed[crows_] = True
+            active = crows[changed[crows] | swept[crows]]
+        # quantities for the evaluation of the transfer impedances
+        orows = np.where(changed | swept)[0]
+        orows = orows[orows > 0]
+        y_p = 1. / buf['z_proximal'][orows]; y_d = distalAdmittance(orows)
+        zt, yt = impedanceTerms(orows)
+        buf['z_cp'][orows] = z_cp = z_c[orows] * y_p
+        buf['z_cd'][orows] = z_cd = z_c[orows] * y_d
+        denom = y_p + y_d + yt + zt * y_p * y_d
+        buf['wrongskian'][orows] = cosh_[orows] * denom
+        buf['z_00'][orows] = (1. + z_cd * tanh_[orows]) / denom
+        buf['z_11'][orows] = (1. + z_cp * tanh_[orows]) / denom
+        buf['z_01'][orows] = 1. / buf['wrongskian'][orows]
+        # input impedance of the soma
+        if swept[0]:
+            y_d = distalAdmittance(np.array([0]))[0]
+            buf['z_00'][0] = 1. / (1. / z_m[0] + y_d)
 
     @morphtree.computationalTreetypeDecorator
     def calcZF(self, loc1, loc2):
@@ -348,17 +812,47 @@ class GreensTree(PhysTree):
         return z_f
 
     @morphtree.computationalTreetypeDecorator
-    def calcImpedanceMatrix(self, locarg):
+    def calcImpedanceMatrix(self, locarg, block_size=None, freq_block_size=None,
+                                  out=None, filename=None, n_workers=None):
         '''
         Computes the impedance matrix of a given set of locations for each
         frequency stored in `self.freqs`.
 
+        The transfer impedance between two locations is the product of a
+        factor for each location and a factor for the lowest common ancestor
+        of their nodes, the factors are derived from prefix products of the
+        voltage attenuations along the nodes from the root, evaluated in log
+        space. Each pair thus costs a single lookup per frequency. For large
+        sets, the matrix can be computed in blocks of rows and of frequencies,
+        and written to a given array or to a memory-mapped file. The blocks
+        of frequencies can be distributed over a pool of worker processes.
+
         Parameters
         ----------
-        locarg: `list` of locations or string
-            if `list` of locations, specifies the locations for which the
-            impedance matrix is evaluated, if ``string``, specifies the
-            name under which a set of location is stored
+        locarg: `list` of locations, :class:`LocArray` or string
+            if `list` of locations or :class:`LocArray`, specifies the
+            locations for which the impedance matrix is evaluated, if
+            ``string``, specifies the name under which a set of location is
+            stored
+        block_size: int or None
+            number of rows computed at once. If ``None``, all rows are
+            computed at once.
+        freq_block_size: int or None
+            number of frequencies computed at once. If ``None``, all
+            frequencies are computed at once, or divided evenly over the
+            workers.
+        out: `np.ndarray` or None
+            complex array of shape ``(n_freq, n_loc, n_loc)`` in which the
+            impedance matrix is written, e.g. a `numpy.memmap`. Without
+            workers, any array-like that supports assignment to slices can be
+            given, e.g. a dataset of a chunked on-disk store.
+        filename: string or None
+            if given and `out` is ``None``, the impedance matrix is written to
+            a memory-mapped ``.npy`` file with this name
+        n_workers: int or None
+            if larger than one, the blocks of frequencies are computed by this
+            number of forked worker processes, that write into the
+            memory-mapped file or into an array in shared memory
 
         Returns
         -------
@@ -367,26 +861,197 @@ class GreensTree(PhysTree):
             frequency, second and third dimensions contain the impedance
             matrix at that frequency
         '''
-        if isinstance(locarg, list):
-            locs = [MorphLoc(loc, self) for loc in locarg]
+        arr, rows, xs = self._getLocRows(locarg)
+        n_loc = len(rows)
+        buf = self._impedance_buffer.reshape(
+                                self._impedance_buffer.shape[:2] + (-1,))
+        n_freq = buf.shape[-1]
+        parallel = n_workers is not None and n_workers > 1
+        if out is None:
+            z_mat = self._createOutputArray((n_freq, n_loc, n_loc), filename,
+                                            dtype=complex, shared=parallel)
+        elif parallel and not isinstance(out, np.memmap):
+            # the workers can not write to the memory of the given array
+            z_mat = self._createOutputArray(out.shape, dtype=out.dtype,
+                                            shared=True)
+        else:
+            z_mat = out
+        def fill(f0, f1):
+            for i0, i1, z_block in self._iterImpedanceBlocks(arr,
+                                        buf[:,:,f0:f1], rows, xs, block_size):
+                z_mat[f0:f1,i0:i1] = z_block
+        self._mapFrequencyBlocks(fill, n_freq, freq_block_size=freq_block_size,
+                                 n_workers=n_workers)
+        if out is None:
+            out = z_mat
+        elif out is not z_mat:
+            out[:] = z_mat
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out
+
+    @morphtree.computationalTreetypeDecorator
+    def iterImpedanceMatrix(self, locarg, block_size=None,
+                                  freq_block_size=None):
+        '''
+        Iterate over blocks of the impedance matrix of a given set of
+        locations, for impedance matrices that do not fit in memory. The
+        blocks are computed as in :func:`GreensTree.calcImpedanceMatrix` when
+        they are requested, looping over blocks of rows within each block of
+        frequencies.
+
+        Parameters
+        ----------
+        locarg: `list` of locations, :class:`LocArray` or string
+            if `list` of locations or :class:`LocArray`, specifies the
+            locations for which the impedance matrix is evaluated, if
+            ``string``, specifies the name under which a set of location is
+            stored
+        block_size: int or None
+            number of rows per block. If ``None``, blocks contain all rows.
+        freq_block_size: int or None
+            number of frequencies per block. If ``None``, blocks contain all
+            frequencies.
+
+        Yields
+        ------
+        f_slice: `slice`
+            the frequencies of the block
+        loc_slice: `slice`
+            the rows of the block
+        z_block: `np.ndarray` (``dtype = complex``, ``ndim = 3``)
+            the block of the impedance matrix, of shape
+            ``(n_freq_block, n_row_block, n_loc)``
+        '''
+        # the locations are resolved before iterating, as the treetype is
+        # only set for the duration of this call
+        arr, rows, xs = self._getLocRows(locarg)
+        buf = self._impedance_buffer.reshape(
+                                self._impedance_buffer.shape[:2] + (-1,))
+        return self._iterImpedanceMatrix(arr, buf, rows, xs, block_size,
+                                         freq_block_size)
+
+    def _iterImpedanceMatrix(self, arr, buf, rows, xs, block_size,
+                                   freq_block_size):
+        for f0, f1 in _getBlocks(buf.shape[-1], freq_block_size):
+            for i0, i1, z_block in self._iterImpedanceBlocks(arr,
+                                        buf[:,:,f0:f1], rows, xs, block_size):
+                yield slice(f0, f1), slice(i0, i1), z_block
+
+    def _getLocRows(self, locarg):
+        '''
+        The array tree, and the rows of the nodes and the x-coordinates of a
+        set of locations
+        '''
+        if isinstance(locarg, (list, LocArray)):
+            locs = LocArray(locarg, self)
+            nids, xs = locs['node'], locs['x']
         elif isinstance(locarg, str):
-            locs = self.getLocs(locarg)
+            self._tryName(locarg)
+            nids, xs = self.nids[locarg], self.xs[locarg]
         else:
             raise IOError('`locarg` should be list of locs or string')
-        z_mat = np.zeros((len(self.freqs), len(locs), len(locs)), dtype=complex)
-        for ii, loc0 in enumerate(locs):
-            jj = 0
-            while jj < ii:
-                loc1 = locs[jj]
-                z_f = self.calcZF(loc0, loc1)
-                z_mat[:,ii,jj] = z_f
-                z_mat[:,jj,ii] = z_f
-                jj += 1
-            z_f = self.calcZF(loc0, loc0)
-            z_mat[:,ii,ii] = z_f
+        arr = self.getArrayTree()
+        return arr, arr.getRows(nids), np.asarray(xs, dtype=float)
 
-        return z_mat
+    def _iterImpedanceBlocks(self, arr, buf, rows, xs, block_size=None):
+        '''
+        Iterate over blocks of rows of the impedance matrix for a block of
+        frequencies of the impedance buffer, yields the start and stop row and
+        the block of shape ``(n_freq_block, n_row_block, n_loc)``
+        '''
+        log_z_d, log_z_p, log_z_w, z_prox, z_dist = \
+                self._getTransferFactors(arr, buf, rows, xs)
+        for i0, i1 in _getBlocks(len(rows), block_size):
+            rows1 = rows[i0:i1,None]; rows2 = rows[None,:]
+            rows_w = arr.getLCA(rows1, rows2)
+            # locations whose node is the common ancestor are connected
+            # through the distal end of their node, the other locations
+            # through the proximal end
+            log_z1 = np.where((rows_w == rows1)[:,:,None],
+                              log_z_d[i0:i1,None,:], log_z_p[i0:i1,None,:])
+            log_z2 = np.where((rows_w == rows2)[:,:,None],
+                              log_z_d[None,:,:], log_z_p[None,:,:])
+            z_block = np.exp(log_z1 + log_z2 + log_z_w[rows_w])
+            # pairs of locations on the same node
+            ii, jj = np.nonzero(rows1 == rows2)
+            ii_ = ii + i0
+            prox = np.where(xs[ii_] <= xs[jj], ii_, jj)
+            dist = np.where(xs[ii_] <= xs[jj], jj, ii_)
+            z_block[ii,jj] = z_prox[prox] * z_dist[dist]
+            yield i0, i1, np.moveaxis(z_block, -1, 0)
+
+    def _getTransferFactors(self, arr, buf, rows, xs):
+        '''
+        Factors from which the transfer impedances between locations are
+        composed. With `e` the end of the node of a location through which
+        the path to the other location passes, and `w` the lowest common
+        ancestor of both nodes, the transfer impedance is
 
+            Z(x1, e1) Z(x2, e2) Z(e1, e2) / (Z(e1, e1) Z(e2, e2))
 
+        where the transfer impedance between the node ends is a product of
+        voltage attenuations ``z_01 / z_11`` along the path, written as
+        ratios of their prefix products from the root.
 
+        Parameters
+        ----------
+        arr: :class:`ArrayTree`
+            the array tree of the computational tree
+        buf: `np.ndarray` (``shape=(n_quantity, n_node, n_freq)``)
+            (a block of frequencies of) the impedance buffer
+        rows: `np.ndarray` of ints
+            the rows of the nodes of the locations
+        xs: `np.ndarray` of floats
+            the x-coordinates of the locations
 
+        Returns
+        -------
+        log_z_d, log_z_p: `np.ndarray` (``shape=(n_loc, n_freq)``)
+            log of the location factors if the path passes through resp. the
+            distal or the proximal end of the node
+        log_z_w: `np.ndarray` (``shape=(n_node, n_freq)``)
+            log of the factor of the common ancestors
+        z_prox, z_dist: `np.ndarray` (``shape=(n_loc, n_freq)``)
+            factors for the transfer impedance between two locations on the
+            same node, the transfer impedance is the product of the factor
+            `z_prox` of the proximal location and `z_dist` of the distal one
+        '''
+        buf = dict(zip(GreensNode.impedance_names,
+                       np.asarray(buf, dtype=complex)))
+        xs = xs[:,None]
+        prows = arr.parent[rows]
+        soma = rows == 0
+        # log of the input impedances at the distal ends of the nodes, and of
+        # the prefix products of the voltage attenuations along the nodes
+        log_z_in = np.empty_like(buf['z_11'])
+        log_z_in[0] = np.log(buf['z_00'][0])
+        log_z_in[1:] = np.log(buf['z_11'][1:])
+        # the attenuation z_01 / z_11 along a node equals
+        # 1 / (cosh(gamma L) + z_cp sinh(gamma L)), its log is evaluated
+        # from exp(-2 gamma L) to avoid underflow. The soma has no
+        # attenuation.
+        gammaL_ = buf['gammaL'][1:]; em = np.exp(-2. * gammaL_)
+        log_att = np.zeros_like(buf['z_11'])
+        log_att[1:] = -gammaL_ - np.log(.5 * (1. + em) + \
+                                        .5 * buf['z_cp'][1:] * (1. - em))
+        log_att = arr.accumulateDown(log_att)
+        log_z_w = -log_z_in - 2. * log_att
+        # voltage profiles along the nodes
+        gammaL = buf['gammaL'][rows]
+        z_cp = buf['z_cp'][rows]; z_cd = buf['z_cd'][rows]
+        v_p = z_cp * np.sinh(gammaL * xs) + np.cosh(gammaL * xs)
+        v_d = z_cd * np.sinh(gammaL * (1. - xs)) + np.cosh(gammaL * (1. - xs))
+        v_p1 = z_cp * np.sinh(gammaL) + np.cosh(gammaL)
+        v_d0 = z_cd * np.sinh(gammaL) + np.cosh(gammaL)
+        # the soma is a single point
+        v_p[soma] = 1.; v_d[soma] = 1.; v_p1[soma] = 1.; v_d0[soma] = 1.
+        log_z_d = np.log(v_p / v_p1) + log_z_in[rows] + log_att[rows]
+        log_z_p = np.log(v_d / v_d0) + log_z_in[prows] + log_att[prows]
+        log_z_p[soma] = log_z_d[soma]
+        # transfer impedances on the same node
+        z_prox = v_p
+        z_dist = np.empty_like(v_d)
+        z_dist[~soma] = v_d[~soma] / buf['wrongskian'][rows[~soma]]
+        z_dist[soma] = buf['z_00'][0]
+        return log_z_d, log_z_p, log_z_w, z_prox, z_dist
@@ -2,8 +2,10 @@
 File contains:
 
     - :class:`MorphLoc`
+    - :class:`LocArray`
     - :class:`MorphNode`
     - :class:`MorphTree`
+    - :class:`MorphTreeView`
 
 Authors: B. Torben-Nielsen (legacy code) and W. Wybo
 """
@@ -19,31 +21,53 @@ from mpl_toolkits.mplot3d import Axes3D
 
 import warnings
 import copy
-from collections import Counter
+import os
+import re
+import hashlib
+import threading
+import functools
+import contextlib
+import ctypes
+import multiprocessing
+import multiprocessing.sharedctypes
+from collections import Counter, deque
 
 from stree import SNode, STree
 from compartmenttree import CompartmentNode, CompartmentTree
+from spatialindex import SegmentIndex
+
+
+# treetypes that are active in the current thread, as a map from the id of a
+# tree to its treetype (see :func:`MorphTree.treetypeContext`)
+_treetype_overrides = threading.local()
+
+def _getTreetypeOverrides():
+    try:
+        return _treetype_overrides.trees
+    except AttributeError:
+        _treetype_overrides.trees = {}
+        return _treetype_overrides.trees
 
 
 def originalTreetypeDecorator(fun):
     '''
     Decorator that provides the safety that the treetype is set to
-    'original' inside the functions it decorates
+    'original' inside the functions it decorates. The treetype is only set for
+    the calling thread, so that other threads can keep using the tree.
     '''
     # wrapper to access self
+    @functools.wraps(fun)
     def wrapped(self, *args, **kwargs):
-        current_treetype = self.treetype
-        self.treetype = 'original'
-        res = fun(self, *args, **kwargs)
-        self.treetype = current_treetype
-        return res
+        with self.treetypeContext('original'):
+            return fun(self, *args, **kwargs)
     return wrapped
 
 def computationalTreetypeDecorator(fun):
     '''
     Decorator that provides the safety that the treetype is set to
-    'computational' inside the functions it decorates. This decorator also
-    checks if a computational tree has been defined.
+    'computational' inside the functions it decorates. The treetype is only
+    set for the calling thread, so that other threads can keep using the tree.
+    This decorator also checks if a computational tree has been defined.
 
     Raises
     ------
@@ -52,6 +76,7 @@ def computationalTreetypeDecorator(fun):
             defined
     '''
     # wrapper to access self
+    @functools.wraps(fun)
     def wrapped(self, *args, **kwargs):
         if self._computational_root == None:
             raise AttributeError('No computational tree has been defined, ' + \
@@ -59,14 +84,107 @@ def computationalTreetypeDecorator(fun):
                                   ':func:`MorphTree.setCompTree()` or its ' + \
                                   'overwritten version in one of the derived' + \
                                   'classes')
-        current_treetype = self.treetype
-        self.treetype = 'computational'
-        res = fun(self, *args, **kwargs)
-        self.treetype = current_treetype
-        return res
+        with self.treetypeContext('computational'):
+            return fun(self, *args, **kwargs)
     return wrapped
 
 
+def getSWCHash(file_n):
+    '''
+    Returns a hash of the contents of a morphology file, to be used as a key
+    for cached trees (see :func:`MorphTree.writeNPZTreeToFile`)
+
+    Parameters
+    ----------
+        file_n: string
+            name of the file
+
+    Returns
+    -------
+        string
+    '''
+    with open(file_n, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+def _concatenateRanges(starts, counts):
+    '''
+    Returns the concatenation of the ranges ``starts[i]:starts[i]+counts[i]``
+    '''
+    starts = np.asarray(starts, dtype=int); counts = np.asarray(counts, dtype=int)
+    offsets = np.cumsum(counts) - counts
+    return np.arange(np.sum(counts)) + np.repeat(starts - offsets, counts)
+
+
+def _getRowsNearDistalEnd(arr, cum_l, row, dx):
+    '''
+    Returns the rows of the nodes of which one of the ends is within a distance
+    `dx` of the distal end of the node at `row`, given the array tree and the
+    cumulative lengths. Only the part of the tree within `dx` is visited: first
+    the ancestors whose distal end is within `dx`, and then, level by level,
+    the children of the nodes whose distal end is within `dx`.
+    '''
+    chain = [row]
+    while arr.parent[chain[-1]] >= 0 and \
+          cum_l[row] - cum_l[arr.parent[chain[-1]]] < dx:
+        chain.append(arr.parent[chain[-1]])
+    chain = np.array(chain, dtype=int)
+    # the distance between the distal ends of `row` and a node below the
+    # ancestor `a` is ``cum_l[row] - 2 cum_l[a] + cum_l[node]``
+    near = [chain]
+    prows, base = chain, cum_l[row] - 2. * cum_l[chain]
+    # the ancestors in the chain are reached from their parents already
+    skip = np.concatenate(([-1], chain[:-1]))
+    while len(prows) > 0:
+        n_child = arr.child_ptr[prows+1] - arr.child_ptr[prows]
+        crows = arr.child_ind[_concatenateRanges(arr.child_ptr[prows], n_child)]
+        base = np.repeat(base, n_child)
+        if skip is not None:
+            off_chain = crows != np.repeat(skip, n_child)
+            crows, base, skip = crows[off_chain], base[off_chain], None
+        # the proximal end of the children is within `dx`
+        near.append(crows)
+        within = base + cum_l[crows] < dx
+        prows, base = crows[within], base[within]
+    return np.concatenate(near)
+
+
+def _getArgminTable(vals):
+    '''
+    Sparse table for range minimum queries on an array, row ``k`` contains
+    the position of the first minimum of ``vals[i:i+2**k]`` for each ``i``.
+    '''
+    n_val = len(vals)
+    n_k = max(1, int(n_val).bit_length())
+    table = np.zeros((n_k, n_val), dtype=int)
+    table[0] = np.arange(n_val)
+    for kk in xrange(1, n_k):
+        hh = 2**(kk-1)
+        i0 = table[kk-1,:n_val-hh]; i1 = table[kk-1,hh:]
+        table[kk,:n_val-hh] = np.where(vals[i1] < vals[i0], i1, i0)
+        table[kk,n_val-hh:] = table[kk-1,n_val-hh:]
+    return table
+
+
+def _queryArgmin(vals, table, i0, i1):
+    '''
+    Returns the positions of the first minimum of ``vals[i0:i1]`` for arrays
+    of ranges, ``-1`` for empty ranges.
+    '''
+    i0 = np.asarray(i0, dtype=int); i1 = np.asarray(i1, dtype=int)
+    nonempty = i1 > i0
+    if len(vals) == 0 or not np.any(nonempty):
+        return -np.ones(i0.shape, dtype=int)
+    # the ranges are covered by two, possibly overlapping, intervals of length
+    # 2**kk, with kk = floor(log2(i1-i0))
+    kk = np.frexp(np.where(nonempty, i1 - i0, 1))[1] - 1
+    j0 = np.where(nonempty, i0, 0)
+    j1 = np.where(nonempty, i1 - 2**kk, 0)
+    pos0 = table[kk,j0]; pos1 = table[kk,j1]
+    pos = np.where(vals[pos1] < vals[pos0], pos1, pos0)
+    return np.where(nonempty, pos, -1)
+
+
 class MorphLoc(object):
     '''
     Stores a location on the morphology. The location is initialized starting
@@ -101,6 +219,9 @@ class MorphLoc(object):
             ValueError
                 If x-coordinate of location is not in ``[0,1]``
         '''
+        if isinstance(reftree, MorphTreeView):
+            # locations always refer to the underlying tree
+            reftree = reftree.getTree()
         self.reftree = reftree
 
         if isinstance(loc, tuple):
@@ -184,54 +305,273 @@ class MorphLoc(object):
 
     def _setComputationalLoc(self):
         if self.loc['node'] != 1:
-            current_treetype = self.reftree.treetype
-            self.reftree.treetype = 'original'
-            node = self.reftree[self.loc['node']]
-            # find the computational nodes that are resp. up and down from the node
-            node_start = self.reftree._findCompnodeUp(node.parent_node)
-            node_stop  = self.reftree._findCompnodeDown(node)
-            # length between loc and parent computational node to compute segment
-            # length
-            L = self.reftree.pathLength({'node': node_start.index, 'x': 1.},
-                                         self.loc)
-            # get the computational nodes' length
-            self.reftree.treetype = 'computational'
-            L_cn = self.reftree[node_stop.index].L
-            self.reftree.treetype = 'original'
-            # set the computational loc
-            self.comp_loc = {'node': node_stop.index, 'x': L/L_cn}
-            # reset treetype to its former value
-            self.reftree.treetype = current_treetype
+            nids, xs = self.reftree._convertLocsToComputational(
+                                        [self.loc['node']], [self.loc['x']])
+            self.comp_loc = {'node': int(nids[0]), 'x': float(xs[0])}
         else:
             self.comp_loc = copy.deepcopy(self.loc)
 
     def _setOriginalLoc(self):
         if self.comp_loc['node'] != 1:
-            current_treetype = self.reftree.treetype
-            self.reftree.treetype = 'computational'
-            compnode = self.reftree[self.comp_loc['node']]
-            self.reftree.treetype = 'original'
-            node = self.reftree[self.comp_loc['node']]
-            # find the computational node that is down from the original node
-            pcnode = self.reftree._findCompnodeUp(node.parent_node)
-            # find the node index and x-coordinate of the original location
-            path = self.reftree.pathBetweenNodes(pcnode, node)
-            L0 = 0. ; found = False
-            for pathnode in path[1:]:
-                L1 = L0 + pathnode.L
-                Lloc = self.comp_loc['x']*compnode.L
-                if Lloc > L0 and Lloc <= L1:
-                    self.loc = {'node': pathnode.index,
-                                'x': (Lloc-L0-1e-8) / pathnode.L}
-                L0 = L1
-            if self.loc['x'] > 1. or self.loc['x'] < 0.:
-                raise ValueError('x-value should be in [0,1]')
-            # reset treetype to its former value
-            self.reftree.treetype = current_treetype
+            nids, xs = self.reftree._convertLocsToOriginal(
+                                [self.comp_loc['node']], [self.comp_loc['x']])
+            self.loc = {'node': int(nids[0]), 'x': float(xs[0])}
         else:
             self.loc = copy.deepcopy(self.comp_loc)
 
 
+class LocArray(object):
+    '''
+    Stores a set of locations on the morphology as arrays of node indices and
+    x-coordinates. As for :class:`MorphLoc`, the locations are initialized on
+    the original morphology (or on the computational morphology if
+    `set_as_comploc` is ``True``), and the coordinates on the other tree are
+    computed for all locations at once. Which coordinates are returned depends
+    on the `treetype` of the reference tree.
+
+    A :class:`LocArray` behaves as a sequence of :class:`MorphLoc`, so that it
+    can be used wherever a list of locations is accepted. Indexing with an
+    integer returns a :class:`MorphLoc`, indexing with a slice or an index array
+    returns a new :class:`LocArray`, while indexing with 'node' or 'x' returns
+    the array of node indices or x-coordinates.
+
+    The sequence is read-only: it implements `index` and `count`, but not the
+    list methods that modify it (`append`, `extend`, ...). Use
+    :func:`LocArray.tolist` to obtain a modifiable list of locations.
+    '''
+
+    def __init__(self, locs, reftree, set_as_comploc=False):
+        '''
+        Initializes a :class:`LocArray` object
+
+        Parameters
+        ----------
+            locs: dict, :class:`LocArray` or iterable of locations
+                if dict: {'node': array of node indices, 'x': array of x-values}
+                if iterable: dicts, tuples or :class:`MorphLoc`
+            reftree: :class:`MorphTree`
+            set_as_comploc: bool
+                if True, assumes the coordinates provided in `locs` are
+                coordinates on the computational tree. Doing this while no
+                computational tree has been initialized in `reftree` will
+                result in an error. Defaults to False
+
+        Raises
+        ------
+            ValueError
+                If x-coordinates of the locations are not in ``[0,1]``
+        '''
+        if isinstance(reftree, MorphTreeView):
+            # locations always refer to the underlying tree
+            reftree = reftree.getTree()
+        self.reftree = reftree
+        self._nids_comp = None; self._xs_comp = None
+        if isinstance(locs, LocArray):
+            self._nids_orig = locs._nids_orig.copy()
+            self._xs_orig = locs._xs_orig.copy()
+            if locs._nids_comp is not None and locs.reftree is reftree:
+                self._nids_comp = locs._nids_comp.copy()
+                self._xs_comp = locs._xs_comp.copy()
+            return
+        elif isinstance(locs, dict):
+            nids = np.array(locs['node'], dtype=int).reshape(-1)
+            xs = np.array(locs['x'], dtype=float).reshape(-1)
+        else:
+            nids, xs = [], []
+            for loc in locs:
+                if isinstance(loc, MorphLoc):
+                    if not set_as_comploc:
+                        loc = loc.loc
+                    else:
+                        if not hasattr(loc, 'comp_loc'):
+                            loc._setComputationalLoc()
+                        loc = loc.comp_loc
+                if isinstance(loc, tuple):
+                    nids.append(loc[0]); xs.append(loc[1])
+                elif isinstance(loc, dict):
+                    nids.append(loc['node']); xs.append(loc['x'])
+                else:
+                    raise TypeError('Not a valid location type, should be ' + \
+                                    'tuple, dict or :class:`MorphLoc`')
+            nids = np.array(nids, dtype=int)
+            xs = np.array(xs, dtype=float)
+        if len(nids) != len(xs):
+            raise ValueError('Node indices and x-values should have the ' + \
+                             'same length')
+        if np.any(xs > 1.) or np.any(xs < 0.):
+            raise ValueError('x-value should be in [0,1]')
+        if set_as_comploc:
+            self._nids_comp = nids; self._xs_comp = xs
+            self._setOriginalLocs()
+        else:
+            self._nids_orig = nids; self._xs_orig = xs
+
+    def _setComputationalLocs(self):
+        self._nids_comp, self._xs_comp = \
+            self.reftree._convertLocsToComputational(self._nids_orig,
+                                                     self._xs_orig)
+
+    def _setOriginalLocs(self):
+        self._nids_orig, self._xs_orig = \
+            self.reftree._convertLocsToOriginal(self._nids_comp, self._xs_comp)
+
+    def _getArrays(self):
+        if self.reftree.treetype == 'computational':
+            if self._nids_comp is None:
+                self._setComputationalLocs()
+            return self._nids_comp, self._xs_comp
+        else:
+            return self._nids_orig, self._xs_orig
+
+    def getNodeIndices(self):
+        '''
+        Returns the node indices of the locations, on the tree that is the
+        current `treetype` of the reference tree
+
+        Returns
+        -------
+            numpy.array of ints
+        '''
+        return self._getArrays()[0]
+
+    def getXCoords(self):
+        '''
+        Returns the x-coordinates of the locations, on the tree that is the
+        current `treetype` of the reference tree
+
+        Returns
+        -------
+            numpy.array of floats
+        '''
+        return self._getArrays()[1]
+
+    def __len__(self):
+        return len(self._nids_orig)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            nids, xs = self._getArrays()
+            if key == 'node':
+                return nids
+            elif key == 'x':
+                return xs
+            else:
+                raise KeyError(key)
+        elif isinstance(key, (int, np.integer)):
+            loc = MorphLoc({'node': int(self._nids_orig[key]),
+                            'x': float(self._xs_orig[key])}, self.reftree)
+            if self._nids_comp is not None:
+                loc.comp_loc = {'node': int(self._nids_comp[key]),
+                                'x': float(self._xs_comp[key])}
+            return loc
+        else:
+            if isinstance(key, list):
+                key = np.array(key, dtype=int)
+            new_locs = LocArray.__new__(LocArray)
+            new_locs.reftree = self.reftree
+            new_locs._nids_orig = self._nids_orig[key]
+            new_locs._xs_orig = self._xs_orig[key]
+            if self._nids_comp is not None:
+                new_locs._nids_comp = self._nids_comp[key]
+                new_locs._xs_comp = self._xs_comp[key]
+            else:
+                new_locs._nids_comp = None; new_locs._xs_comp = None
+            return new_locs
+
+    def __iter__(self):
+        for ii in xrange(len(self)):
+            yield self[ii]
+
+    def _matchLoc(self, loc):
+        '''
+        Boolean array indicating which locations are equal to `loc`, with the
+        same criterion as :func:`MorphLoc.__eq__`
+        '''
+        loc = LocArray([loc], self.reftree)
+        nid, x = loc._nids_orig[0], loc._xs_orig[0]
+        match = self._nids_orig == nid
+        if nid != 1:
+            match &= np.isclose(self._xs_orig, x)
+        return match
+
+    def __contains__(self, loc):
+        return bool(np.any(self._matchLoc(loc)))
+
+    def index(self, loc):
+        '''
+        Returns the index of the first location that is equal to `loc`
+
+        Parameters
+        ----------
+            loc: tuple, dict or :class:`MorphLoc`
+
+        Returns
+        -------
+            int
+
+        Raises
+        ------
+            ValueError
+                If `loc` is not in the set of locations
+        '''
+        inds = np.where(self._matchLoc(loc))[0]
+        if len(inds) == 0:
+            raise ValueError('Location is not in the set of locations')
+        return int(inds[0])
+
+    def count(self, loc):
+        '''
+        Returns the number of locations that are equal to `loc`
+
+        Parameters
+        ----------
+            loc: tuple, dict or :class:`MorphLoc`
+
+        Returns
+        -------
+            int
+        '''
+        return int(np.sum(self._matchLoc(loc)))
+
+    def __add__(self, other):
+        other = LocArray(other, self.reftree)
+        new_locs = LocArray.__new__(LocArray)
+        new_locs.reftree = self.reftree
+        new_locs._nids_orig = np.concatenate((self._nids_orig, other._nids_orig))
+        new_locs._xs_orig = np.concatenate((self._xs_orig, other._xs_orig))
+        if self._nids_comp is not None and other._nids_comp is not None:
+            new_locs._nids_comp = np.concatenate((self._nids_comp,
+                                                  other._nids_comp))
+            new_locs._xs_comp = np.concatenate((self._xs_comp,
+                                                other._xs_comp))
+        else:
+            new_locs._nids_comp = None; new_locs._xs_comp = None
+        return new_locs
+
+    def __radd__(self, other):
+        return LocArray(other, self.reftree) + self
+
+    def __copy__(self):
+        '''
+        Copy the arrays of the location set, the `reftree` attribute still
+        refers to the original tree
+        '''
+        return LocArray(self, self.reftree)
+
+    def tolist(self):
+        '''
+        Returns the locations as a list of :class:`MorphLoc`
+
+        Returns
+        -------
+            list of :class:`MorphLoc`
+        '''
+        return [loc for loc in self]
+
+    def __str__(self):
+        return '[' + ', '.join([str(loc) for loc in self]) + ']'
+
+
 class MorphNode(SNode):
     '''
     Node associated with :class:`MorphTree`. Stores the geometrical information
@@ -250,6 +590,8 @@ class MorphNode(SNode):
         L: float
             The length of the node (um)
     '''
+    __slots__ = ('xyz', 'R', 'swc_type', 'used_in_comptree', 'L')
+
     def __init__(self, index, p3d=None):
         super(MorphNode, self).__init__(index)
         if p3d != None:
@@ -332,7 +674,9 @@ class MorphTree(STree):
     'computational' for the computational morphology). Lookup operations will
     often use the primary tree. Using nodes from the other tree for lookup
     operations is unsafe and should be avoided, it is better to set the proper
-    tree to primary first.
+    tree to primary first. To query both trees concurrently, e.g. from
+    different threads, use the immutable views returned by
+    :func:`MorphTree.getView` instead of changing the `treetype`.
 
     Attributes
     ----------
@@ -342,6 +686,8 @@ class MorphTree(STree):
 
     def __init__(self, file_n=None, types=[1,3,4]):
         self._treetype = 'original' # alternative 'computational'
+        # index maps of the original and the computational tree
+        self._index_map_orig = None; self._index_map_comp = None
         if file_n != None:
             self.readSWCTreeFromFile(file_n, types=types)
             # self._original_root = self.root
@@ -352,24 +698,28 @@ class MorphTree(STree):
         self.locs = {}
         self._nids_orig = {}; self._nids_comp = {}
         self._xs_orig = {}; self._xs_comp = {}
-        self.d2s = {}
-        self.d2b = {}
-        self.leafinds = {}
 
     def __getitem__(self, index, skip_inds=(2,3)):
         '''
         Returns the node with given index, if no such node is in the tree, None
-        is returned.
+        is returned. The lookup uses the index map associated with the current
+        `treetype`, and thus takes constant time.
 
         Parameters
         ----------
             index: int
                 the index of the node to be found
+            skip_inds: tuple of ints
+                Indices of the nodes that are not returned. Defaults to
+                ``(2,3)``, the nodes that contain extra geometrical information
+                on the soma.
 
         Returns:
             :class:`SNode` or None
         '''
-        return self._findNode(self.root, index, skip_inds=skip_inds)
+        if index in skip_inds:
+            return None
+        return self._getIndexMap().get(index, None)
 
     def _findNode(self, node, index, skip_inds=(2,3)):
         """
@@ -388,17 +738,68 @@ class MorphTree(STree):
         -------
             :class:`SNode`
         """
-        stack = [];
-        stack.append(node)
-        while len(stack) != 0:
-            for cnode in stack:
-                if cnode.index == index:
-                    return cnode
-                else:
-                    stack.remove(cnode)
-                    stack.extend(cnode.getChildNodes(skip_inds=skip_inds))
+        queue = deque([node])
+        while len(queue) != 0:
+            cnode = queue.popleft()
+            if cnode.index == index:
+                return cnode
+            else:
+                queue.extend(cnode.getChildNodes(skip_inds=skip_inds))
         return None # Not found!
 
+    def _getIndexMapStore(self):
+        if self.treetype == 'original':
+            return self._index_map_orig
+        else:
+            return self._index_map_comp
+
+    def _setIndexMapStore(self, index_map):
+        if self.treetype == 'original':
+            self._index_map_orig = index_map
+        else:
+            self._index_map_comp = index_map
+
+    _index_map = property(_getIndexMapStore, _setIndexMapStore)
+
+    def _getCache(self):
+        if self.treetype == 'original':
+            if getattr(self, '_cache_orig', None) is None:
+                self._cache_orig = {}
+            return self._cache_orig
+        else:
+            if getattr(self, '_cache_comp', None) is None:
+                self._cache_comp = {}
+            return self._cache_comp
+
+    _cache = property(_getCache)
+
+    def _resetComputationalCaches(self):
+        '''
+        Removes the index map and the cached quantities associated with the
+        computational tree, and increases the structural revision of the tree
+        '''
+        self._index_map_comp = None
+        self._cache_comp = None
+        self.bumpRevision('structure')
+
+    def getD2S(self):
+        return self.getRevisionCache('d2s', kinds=('structure',))
+
+    def getD2B(self):
+        return self.getRevisionCache('d2b', kinds=('structure',))
+
+    def getLeafInds(self):
+        return self.getRevisionCache('leafinds', kinds=('structure',))
+
+    def _setLocCache(self, illegal):
+        raise AttributeError("location caches are read-only attributes")
+
+    # distances to soma and bifurcation and leaf indices of stored locations,
+    # emptied when the tree structure changes
+    d2s = property(getD2S, _setLocCache)
+    d2b = property(getD2B, _setLocCache)
+    leafinds = property(getLeafInds, _setLocCache)
+
     def __iter__(self, node=None, skip_inds=(2,3)):
         '''
         Overloaded iterator from parent class that avoids iterating over the
@@ -420,11 +821,11 @@ class MorphTree(STree):
         '''
         if node is None:
             node = self.root
-        if node is not None:
-            if node.index not in skip_inds: yield node
-            for cnode in node.getChildNodes(skip_inds=skip_inds):
-                for inode in self.__iter__(cnode, skip_inds=skip_inds):
-                    if node.index not in skip_inds: yield inode
+        if node is None or node.index in skip_inds:
+            return iter([])
+        if node is self.root and tuple(skip_inds) == (2,3):
+            return iter(self.getOrderedNodes())
+        return self._iterDepthFirst(node, skip_inds=skip_inds)
 
     def getRoot(self):
         if self.treetype == 'original':
@@ -435,9 +836,15 @@ class MorphTree(STree):
     def setRoot(self, node):
         if self.treetype == 'original':
             node.parent_node = None
+            if node is not getattr(self, '_original_root', None):
+                self._resetIndexMap()
+                self._resetStructureCaches()
             self._original_root = node
         else:
             node.parent_node = None
+            if node is not self._computational_root:
+                self._resetIndexMap()
+                self._resetStructureCaches()
             self._computational_root = node
 
     root = property(getRoot, setRoot)
@@ -452,6 +859,8 @@ class MorphTree(STree):
         ----------
             recompute_flag: bool
                 whether or not to re-evaluate the node list. Defaults to False.
+                The node list is also re-evaluated when the tree structure
+                changes.
             skip_inds: tuple of ints
                 Indices of the nodes that are skipped by the iterator. Defaults
                 to ``(2,3)``, the nodes that contain extra geometrical
@@ -461,18 +870,11 @@ class MorphTree(STree):
         -------
             list of :class:`MorphNode`
         '''
-        if self.treetype == 'original':
-            if not hasattr(self, '_nodes_orig') or recompute_flag:
-                self._nodes_orig = []
-                self._gatherNodes(self.root, self._nodes_orig,
-                                   skip_inds=skip_inds)
-            return self._nodes_orig
-        else:
-            if not hasattr(self, '_nodes_comp') or recompute_flag:
-                self._nodes_comp = []
-                self._gatherNodes(self.root, self._nodes_comp,
-                                   skip_inds=skip_inds)
-            return self._nodes_comp
+        if tuple(skip_inds) != (2,3):
+            return list(self.__iter__(skip_inds=skip_inds))
+        if 'nodes' not in self._cache or recompute_flag:
+            self._cache['nodes'] = list(self.getOrderedNodes())
+        return self._cache['nodes']
 
     def setNodes(self, illegal):
         raise AttributeError("`nodes` is a read-only attribute")
@@ -489,33 +891,44 @@ class MorphTree(STree):
             node: :class:`MorphNode`
             node_list: list of :class:`MorphNode`
         '''
-        if node.index not in skip_inds: node_list.append(node)
-        for cnode in node.getChildNodes(skip_inds=skip_inds):
-            self._gatherNodes(cnode, node_list=node_list, skip_inds=skip_inds)
+        node_list.extend(self.__iter__(node, skip_inds=skip_inds))
 
-    def getLeafs(self, recompute_flag=0):
+    def _getNodeColumns(self, nodes):
         '''
-        Overloads the :func:`getLeafs` of the parent class to return the leafs
-        in the current `treetype`.
+        Collects the geometrical node attributes ('xyz', 'R', 'L' and
+        'swc_type') as columns for the :class:`ArrayTree`
 
         Parameters
         ----------
-            recompute_flag: bool
-                Whether to force recomputing the leaf list. Defaults to 0.
-        '''
-        if self.treetype == 'original':
-            if not hasattr(self, '_leafs_orig') or recompute_flag:
-                self._leafs_orig = [node for node in self if self.isLeaf(node)]
-            return self._leafs_orig
-        else:
-            if not hasattr(self, '_leafs_comp') or recompute_flag:
-                self._leafs_comp = [node for node in self if self.isLeaf(node)]
-            return self._leafs_comp
+            nodes: list of :class:`MorphNode`
+                the nodes of the tree in depth-first order
 
-    def setLeafs(self, illegal):
-        raise AttributeError("`leafs` is a read-only attribute")
-
-    leafs = property(getLeafs, setLeafs)
+        Returns
+        -------
+            dict of numpy.array
+        '''
+        columns = super(MorphTree, self)._getNodeColumns(nodes)
+        columns['xyz'] = np.array([node.xyz for node in nodes],
+                                  dtype=float).reshape(len(nodes), 3)
+        columns['R'] = np.array([node.R for node in nodes], dtype=float)
+        columns['L'] = np.array([node.L for node in nodes], dtype=float)
+        columns['swc_type'] = np.array([node.swc_type for node in nodes],
+                                       dtype=int)
+        return columns
+
+    def _getNodesWithSWCType(self, swc_type):
+        '''
+        Returns the nodes with the given swc type. The nodes of all types are
+        grouped in a single pass over the tree, the groups are cached and
+        recomputed when the tree structure changes. A copy of the cached list
+        is returned.
+        '''
+        if 'nodes_by_swc_type' not in self._cache:
+            nodes_by_type = {}
+            for node in self:
+                nodes_by_type.setdefault(node.swc_type, []).append(node)
+            self._cache['nodes_by_swc_type'] = nodes_by_type
+        return list(self._cache['nodes_by_swc_type'].get(swc_type, []))
 
     def getNodesInBasalSubtree(self):
         '''
@@ -526,7 +939,7 @@ class MorphTree(STree):
             list of :class:`MorphNode`
                 List of all nodes in the basal subtree
         '''
-        return [node for node in self if node.swc_type in [3]]
+        return self._getNodesWithSWCType(3)
 
     def getNodesInApicalSubtree(self):
         '''
@@ -537,38 +950,92 @@ class MorphTree(STree):
             list of :class:`MorphNode`
                 List of all nodes in the apical subtree
         '''
-        return [node for node in self if node.swc_type in [4]]
+        return self._getNodesWithSWCType(4)
 
     def getNodesInAxonalSubtree(self):
         '''
-        Return the nodes associated with the apical subtree
+        Return the nodes associated with the axonal subtree
 
         Returns
         -------
             list of :class:`MorphNode`
-                List of all nodes in the apical subtree
+                List of all nodes in the axonal subtree
         '''
-        return [node for node in self if node.swc_type in [2]]
+        return self._getNodesWithSWCType(2)
 
-    def setTreetype(self, treetype):
-        if treetype == 'original':
-            self._treetype = treetype
-            self.root = self._original_root
-        elif treetype == 'computational':
-            if self._computational_root != None:
-                self._treetype = treetype
-                self.root = self._computational_root
-            else:
+    def _checkTreetype(self, treetype):
+        if treetype == 'computational':
+            if self._computational_root == None:
                 raise ValueError('no computational tree has been defined, \
                                 `treetype` can only be \'original\'')
-        else:
+        elif treetype != 'original':
             raise ValueError('`treetype` can be \'original\' or \'computational\'')
 
+    def setTreetype(self, treetype):
+        self._checkTreetype(treetype)
+        overrides = _getTreetypeOverrides()
+        if id(self) in overrides:
+            # only change the treetype that is active in the present thread
+            overrides[id(self)] = treetype
+        else:
+            self._treetype = treetype
+
     def getTreetype(self):
-        return self._treetype
+        return _getTreetypeOverrides().get(id(self), self._treetype)
 
     treetype = property(getTreetype, setTreetype)
 
+    @contextlib.contextmanager
+    def treetypeContext(self, treetype):
+        '''
+        Context in which the tree has the given `treetype`. The treetype is
+        only set for the calling thread, and is restored to its previous value
+        when the context is exited. Other threads are thus free to use the tree
+        in another treetype.
+
+        Parameters
+        ----------
+            treetype: 'original' or 'computational'
+                the treetype inside the context
+
+        Raises
+        ------
+            ValueError
+                If `treetype` is 'computational' and no computational tree has
+                been defined
+        '''
+        self._checkTreetype(treetype)
+        overrides = _getTreetypeOverrides()
+        key = id(self)
+        previous = overrides.get(key, None)
+        overrides[key] = treetype
+        try:
+            yield self
+        finally:
+            if previous is None:
+                del overrides[key]
+            else:
+                overrides[key] = previous
+
+    def getView(self, treetype):
+        '''
+        Returns an immutable view on this tree with a fixed `treetype`. All
+        attribute lookups and method calls on the view are evaluated in that
+        treetype, without changing the treetype of the tree itself, so that
+        e.g. queries on the original and on the computational tree can be run
+        concurrently from different threads.
+
+        Parameters
+        ----------
+            treetype: 'original' or 'computational'
+                the treetype of the view
+
+        Returns
+        -------
+            :class:`MorphTreeView`
+        '''
+        return MorphTreeView(self, treetype)
+
     def createCorrespondingNode(self, node_index, p3d=None):
         '''
         Creates a node with the given index corresponding to the tree class.
@@ -600,29 +1067,28 @@ class MorphTree(STree):
         types: list of ints
             NeuroMorpho.org segment types to be included
         '''
+        # read all samples from the file in a single pass
+        swc = self._loadSWCArray(file_n)
         # check soma-representation: 3-point soma or a non-standard representation
-        soma_type = self._determineSomaType(file_n)
-
-        file = open(file_n,'r')
+        soma_type = self._determineSomaType(swc[:,1].astype(int))
+        # retain the samples of the included types, sorted by index
+        swc = swc[np.in1d(swc[:,1].astype(int), types)]
+        swc = swc[np.argsort(swc[:,0], kind='mergesort')]
+        indices = swc[:,0].astype(int).tolist()
+        swc_types = swc[:,1].astype(int).tolist()
+        radii = swc[:,5].tolist()
+        parent_indices = swc[:,6].astype(int).tolist()
+        xyz = swc[:,2:5].copy()
+        # create the nodes
         all_nodes = dict()
-        for line in file :
-            if not line.startswith('#') :
-                split = line.split()
-                index = int(split[0].rstrip())
-                swc_type = int(split[1].rstrip())
-                x = float(split[2].rstrip())
-                y = float(split[3].rstrip())
-                z = float(split[4].rstrip())
-                radius = float(split[5].rstrip())
-                parent_index = int(split[6].rstrip())
-                # create the nodes
-                if swc_type in types:
-                    p3d = (np.array([x,y,z]), radius, swc_type)
-                    node = self.createCorrespondingNode(index, p3d)
-                    all_nodes[index] = (swc_type, node, parent_index)
+        for ii, index in enumerate(indices):
+            p3d = (xyz[ii], radii[ii], swc_types[ii])
+            node = self.createCorrespondingNode(index, p3d)
+            all_nodes[index] = (swc_types[ii], node, parent_indices[ii])
 
         if soma_type == 1:
-            for index, (swc_type, node, parent_index) in all_nodes.items() :
+            for index in indices:
+                swc_type, node, parent_index = all_nodes[index]
                 if index == 1:
                     self.setRoot(node)
                 elif index in (2,3):
@@ -640,7 +1106,8 @@ class MorphTree(STree):
             # get all some info
             soma_cylinders = []
             connected_to_root = []
-            for index, (swc_type, node, parent_index) in all_nodes.items() :
+            for index in indices:
+                swc_type, node, parent_index = all_nodes[index]
                 if swc_type == 1 and not index == 1:
                     soma_cylinders.append((node, parent_index))
                     if index > 1 :
@@ -656,7 +1123,8 @@ class MorphTree(STree):
             self.addNodeWithParent(s_node_2,self._root)
 
             # add the other points
-            for index, (swc_type, node, parent_index) in all_nodes.items() :
+            for index in indices:
+                swc_type, node, parent_index = all_nodes[index]
                 if swc_type == 1:
                     pass
                 else:
@@ -667,15 +1135,44 @@ class MorphTree(STree):
                         self.addNodeWithParent(node, parent_node)
 
         # set the lengths of the nodes
-        for node in self:
-            if node.parent_node != None:
-                L = np.sqrt(np.sum((node.parent_node.xyz - node.xyz)**2))
-            else:
-                L = 0.
-            node.setLength(L)
+        nodes = self.getOrderedNodes()
+        if len(nodes) > 0:
+            n_xyz = np.array([node.xyz for node in nodes])
+            p_xyz = np.array([node.xyz if node.parent_node is None else \
+                              node.parent_node.xyz for node in nodes])
+            lengths = np.sqrt(np.sum((p_xyz - n_xyz)**2, axis=1))
+            for node, L in zip(nodes, lengths.tolist()):
+                node.setLength(L)
 
         return self
 
+    def _loadSWCArray(self, file_n):
+        '''
+        Load the samples of an SWC file in a single pass
+
+        Parameters
+        ----------
+        file_n: string
+            Name of the file containing the SWC description
+
+        Returns
+        -------
+        numpy.ndarray (``shape=(n_sample, 7)``)
+            The columns are the index, the type, the x, y and z coordinates,
+            the radius and the parent index of each sample
+        '''
+        with open(file_n, 'r') as file:
+            text = re.sub(r'#[^\n]*', '', file.read())
+        n_line = sum(1 for line in text.splitlines() if line.strip())
+        swc = np.fromstring(text, sep=' ')
+        if swc.size != 7 * n_line:
+            # lines with additional columns, parse them line by line
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', UserWarning)
+                swc = np.loadtxt(file_n, comments='#', usecols=range(7),
+                                 ndmin=2)
+        return swc.reshape(-1, 7)
+
     def _makeSomaFromCylinders(self, soma_cylinders, all_nodes):
         # Construct 3-point soma
         # Step 1: calculate surface of all cylinders
@@ -685,29 +1182,29 @@ class MorphTree(STree):
             nxyz = node.xyz
             pxyz = all_nodes[parent_index][1].xyz
             H = np.sqrt(np.sum((nxyz-pxyz)**2))
-            surf = 2*np.pi*p.radius*H
+            surf = 2*np.pi*node.R*H
             total_surf = total_surf+surf
 
         # define apropriate radius
         radius = np.sqrt(total_surf/(4*np.pi))
         rp = self.root.xyz
-        rp1 = np.array([rp.x, rp.y - radius, rp.z])
-        rp2 = np.array([rp.x, rp.y + radius, rp.z])
+        rp1 = rp + np.array([0., -radius, 0.])
+        rp2 = rp + np.array([0., radius, 0.])
         # create the soma nodes
         s_node_1 = self.createCorrespondingNode(2, (rp1, radius, 1))
         s_node_2 = self.createCorrespondingNode(3, (rp2, radius, 1))
 
         return s_node_1, s_node_2
 
-    def _determineSomaType(self, file_n):
+    def _determineSomaType(self, swc_types):
         '''
-        Costly method to determine the soma type used in the SWC file.
-        This method searches the whole file for soma entries.
+        Determine the soma type used in the SWC file from the types of all
+        samples in the file.
 
         Parameters
         ----------
-        file_n: string
-            Name of the file containing the SWC description
+        swc_types: numpy.array of ints
+            The SWC types of the samples in the file
 
         Returns
         -------
@@ -716,16 +1213,7 @@ class MorphTree(STree):
             1: Default three-point soma, 2: multiple cylinder description,
             3: otherwise [not suported in btmorph]
         '''
-        file = open(file_n, 'r')
-        somas = 0
-        for line in file:
-            if not line.startswith('#') :
-                split = line.split()
-                index = int(split[0].rstrip())
-                s_type = int(split[1].rstrip())
-                if s_type == 1 :
-                    somas = somas +1
-        file.close()
+        somas = np.sum(np.asarray(swc_types) == 1)
         if somas == 3:
             return 1
         elif somas < 3:
@@ -733,6 +1221,194 @@ class MorphTree(STree):
         else:
             return 2
 
+    def writeNPZTreeToFile(self, file_n, swc_file=None):
+        '''
+        Write the tree to a binary ``.npz`` file, from which it can be
+        reconstructed with :func:`MorphTree.readNPZTreeFromFile` without
+        parsing the SWC file or recomputing the computational tree. Stores the
+        node attributes, the topology of the original and the computational
+        tree and the stored sets of locations.
+
+        Parameters
+        ----------
+            file_n: string
+                name of the file
+            swc_file: string (optional)
+                name of the SWC file from which the tree was constructed. If
+                given, a hash of its contents is stored, which is checked when
+                the tree is read.
+
+        Examples
+        --------
+        Cache a tree under the hash of its SWC file
+
+        >>> fname = os.path.join(cache_dir, getSWCHash(swc_file) + '.npz')
+        >>> if os.path.exists(fname):
+        >>>     tree = PhysTree()
+        >>>     tree.readNPZTreeFromFile(fname, swc_file=swc_file)
+        >>> else:
+        >>>     tree = PhysTree(swc_file)
+        >>>     tree.setCompTree()
+        >>>     tree.writeNPZTreeToFile(fname, swc_file=swc_file)
+        '''
+        data = {'treetype': self.treetype}
+        if swc_file is not None:
+            data['swc_hash'] = getSWCHash(swc_file)
+        # the node attributes and topologies
+        treetypes = ['original'] if self._computational_root is None else \
+                    ['original', 'computational']
+        for treetype, key in zip(treetypes, ['orig_', 'comp_']):
+            nodes = self._getNodesWithSkipped(treetype)
+            index = np.array([node.index for node in nodes], dtype=int)
+            rowmap = {node.index: ii for ii, node in enumerate(nodes)}
+            parent = np.array([-1 if node.parent_node is None else \
+                                    rowmap[node.parent_node.index]
+                               for node in nodes], dtype=int)
+            data[key + 'index'] = index
+            data[key + 'parent'] = parent
+            for name, arr in self._getNodeState(nodes).iteritems():
+                data[key + 'state_' + name] = arr
+        # the locations
+        loc_names = sorted(self.locs.keys())
+        data['loc_names'] = np.array(loc_names, dtype=str)
+        for ii, name in enumerate(loc_names):
+            data['locs_%d_nids_orig'%ii] = self._nids_orig[name]
+            data['locs_%d_xs_orig'%ii] = self._xs_orig[name]
+            if name in self._nids_comp:
+                data['locs_%d_nids_comp'%ii] = self._nids_comp[name]
+                data['locs_%d_xs_comp'%ii] = self._xs_comp[name]
+        np.savez(file_n, **data)
+
+    def readNPZTreeFromFile(self, file_n, swc_file=None):
+        '''
+        Read a tree written by :func:`MorphTree.writeNPZTreeToFile`. Replaces
+        the present contents of the tree. The arrays in the file are only read
+        when they are needed to construct the tree.
+
+        Parameters
+        ----------
+            file_n: string
+                name of the file
+            swc_file: string (optional)
+                name of the SWC file from which the tree is expected to be
+                constructed
+
+        Raises
+        ------
+            ValueError
+                If `swc_file` is given and its contents do not match the hash
+                stored in the file
+        '''
+        with np.load(file_n) as data:
+            if swc_file is not None:
+                if 'swc_hash' not in data or \
+                   str(data['swc_hash']) != getSWCHash(swc_file):
+                    raise ValueError('\'' + file_n + '\' was not ' + \
+                                     'constructed from \'' + swc_file + '\'')
+            # remove the present contents
+            self._computational_root = None
+            self._resetComputationalCaches()
+            self._treetype = 'original'
+            self.locs = {}
+            self._nids_orig = {}; self._nids_comp = {}
+            self._xs_orig = {}; self._xs_comp = {}
+            # construct the original and computational tree
+            self._readNPZNodes(data, 'orig_')
+            if 'comp_index' in data:
+                self._computational_root = \
+                        self.createCorrespondingNode(int(data['comp_index'][0]))
+                self._resetComputationalCaches()
+                self._treetype = 'computational'
+                self._readNPZNodes(data, 'comp_',
+                                   root=self._computational_root)
+            self.treetype = str(data['treetype'])
+            # the locations, the computational coordinates are set directly
+            for ii, name in enumerate(data['loc_names'].tolist()):
+                nids = data['locs_%d_nids_orig'%ii]
+                xs = data['locs_%d_xs_orig'%ii]
+                locs = LocArray({'node': nids, 'x': xs}, self)
+                self._nids_orig[name] = locs._nids_orig
+                self._xs_orig[name] = locs._xs_orig
+                if 'locs_%d_nids_comp'%ii in data:
+                    locs._nids_comp = data['locs_%d_nids_comp'%ii]
+                    locs._xs_comp = data['locs_%d_xs_comp'%ii]
+                    self._nids_comp[name] = locs._nids_comp
+                    self._xs_comp[name] = locs._xs_comp
+                self.locs[name] = locs
+        return self
+
+    def _readNPZNodes(self, data, key, root=None):
+        '''
+        Create the nodes of the tree associated with the current `treetype`
+        from the arrays in a ``.npz`` file, with `key` the prefix of the array
+        names.
+        '''
+        index = data[key + 'index'].tolist()
+        parent = data[key + 'parent'].tolist()
+        if root is None:
+            root = self.createCorrespondingNode(index[0])
+        nodes = [root] + [self.createCorrespondingNode(ii) for ii in index[1:]]
+        self.root = root
+        for node, prow in zip(nodes[1:], parent[1:]):
+            self.addNodeWithParent(node, nodes[prow])
+        n_key = len(key + 'state_')
+        state = {name[n_key:]: data[name] for name in data.files \
+                 if name.startswith(key + 'state_')}
+        self._setNodeState(nodes, state)
+
+    def _getNodesWithSkipped(self, treetype):
+        '''
+        Returns all nodes of the tree of the given `treetype` in depth-first
+        order, including the nodes with index 2 and 3
+        '''
+        with self.treetypeContext(treetype):
+            nodes = list(self.__iter__(skip_inds=[]))
+        return nodes
+
+    def _getNodeState(self, nodes):
+        '''
+        Collects the node attributes that are stored in binary files, as arrays
+        with one entry per node.
+
+        Parameters
+        ----------
+            nodes: list of :class:`MorphNode`
+
+        Returns
+        -------
+            dict of numpy.array
+        '''
+        return {'xyz': np.array([node.xyz for node in nodes],
+                                dtype=float).reshape(len(nodes), 3),
+                'R': np.array([node.R for node in nodes], dtype=float),
+                'L': np.array([getattr(node, 'L', np.nan) for node in nodes],
+                              dtype=float),
+                'swc_type': np.array([node.swc_type for node in nodes],
+                                     dtype=int),
+                'used_in_comptree': np.array([node.used_in_comptree \
+                                              for node in nodes], dtype=bool)}
+
+    def _setNodeState(self, nodes, state):
+        '''
+        Sets the node attributes collected by :func:`MorphTree._getNodeState`
+
+        Parameters
+        ----------
+            nodes: list of :class:`MorphNode`
+            state: dict of numpy.array
+        '''
+        R = state['R'].tolist()
+        L = state['L'].tolist()
+        swc_type = state['swc_type'].tolist()
+        used_in_comptree = state['used_in_comptree'].tolist()
+        for ii, node in enumerate(nodes):
+            node.setP3D(state['xyz'][ii].copy(), R[ii], swc_type[ii])
+            if not np.isnan(L[ii]):
+                node.setLength(L[ii])
+            elif hasattr(node, 'L'):
+                del node.L
+            node.used_in_comptree = used_in_comptree[ii]
+
     def setCompTree(self, compnodes=[], set_as_primary_tree=0):
         '''
         Sets the nodes that contain computational parameters. This are a priori
@@ -751,13 +1427,18 @@ class MorphTree(STree):
         '''
         self.removeComptree()
         compnode_indices = [node.index for node in compnodes]
-        nodes = copy.deepcopy(self.nodes)
-        for node in nodes:
+        retained_nodes = []
+        for node in copy.deepcopy(self.nodes):
             if len(node.getChildNodes()) == 1 \
                       and node.parent_node != None \
                       and node.index not in compnode_indices:
                 self.removeSingleNode(node)
-            elif node.parent_node != None:
+            else:
+                retained_nodes.append(node)
+        # set the parameters of the retained nodes after all removals, so that
+        # the path arrays of the original tree are computed only once
+        for node in retained_nodes:
+            if node.parent_node != None:
                 orig_node = self[node.index]
                 # orig_bnode, _ = self.upBifurcationNode(orig_node)
                 orig_bnode = node.parent_node
@@ -774,7 +1455,8 @@ class MorphTree(STree):
                 orig_node.used_in_comptree = True
 
         self._computational_root = \
-                    next(node for node in nodes if node.index == 1)
+                    next(node for node in retained_nodes if node.index == 1)
+        self._resetComputationalCaches()
         if set_as_primary_tree:
             self.treetype = 'computational'
         # create conversion of all coordinate arrays
@@ -829,11 +1511,133 @@ class MorphTree(STree):
             node = self._findCompnodeDown(node.child_nodes[0])
         return node
 
+    def _getLocConversionArrays(self):
+        '''
+        Returns the arrays to convert locations between the original and the
+        computational tree, in the row order of the original array tree. Since
+        the rows are in depth-first order and nodes that are not in the
+        computational tree have a single child, the original nodes that make up
+        a computational node occupy consecutive rows, ending with the row of the
+        computational node itself. The cumulative node length in row order then
+        measures distances along the path within each computational node.
+
+        Returns
+        -------
+            arr: :class:`ArrayTree`
+                the array tree of the original tree
+            cum_l: numpy.array of floats
+                cumulative length of the nodes in row order
+            comp_row: numpy.array of ints
+                the row of the computational node that contains each node
+            first_row: numpy.array of ints
+                for the rows of computational nodes, the first row of the
+                original nodes they contain
+            L_comp: numpy.array of floats
+                for the rows of computational nodes, their length in the
+                computational tree
+        '''
+        cache = self.getRevisionCache('loc_conversion')
+        if 'arrays' not in cache:
+            with self.treetypeContext('original'):
+                arr = self.getArrayTree()
+            with self.treetypeContext('computational'):
+                arr_c = self.getArrayTree()
+            n_row = len(arr)
+            used = np.array([node.used_in_comptree for node in arr.nodes],
+                            dtype=bool)
+            used[0] = True
+            used_rows = np.flatnonzero(used)
+            cum_l = np.cumsum(arr['L'])
+            comp_row = used_rows[np.searchsorted(used_rows, np.arange(n_row))]
+            first_row = np.zeros(n_row, dtype=int)
+            first_row[used_rows[1:]] = used_rows[:-1] + 1
+            L_comp = np.zeros(n_row)
+            L_comp[used_rows] = \
+                    arr_c['L'][arr_c.getRows(arr.index[used_rows])]
+            cache['arrays'] = (arr, cum_l, comp_row, first_row, L_comp)
+        return cache['arrays']
+
+    def _convertLocsToComputational(self, nids, xs):
+        '''
+        Convert locations on the original tree to locations on the
+        computational tree
+
+        Parameters
+        ----------
+            nids: numpy.array of ints
+                the node indices of the locations on the original tree
+            xs: numpy.array of floats
+                the x-coordinates of the locations on the original tree
+
+        Returns
+        -------
+            (numpy.array of ints, numpy.array of floats)
+                the node indices and x-coordinates on the computational tree
+        '''
+        arr, cum_l, comp_row, first_row, L_comp = \
+                                        self._getLocConversionArrays()
+        nids = np.asarray(nids, dtype=int); xs = np.asarray(xs, dtype=float)
+        soma = nids == 1
+        rows = arr.getRows(nids)
+        crows = comp_row[rows]
+        # path length between the location and the distal end of the parent
+        # computational node
+        L = cum_l[rows] - (1. - xs) * arr['L'][rows] - \
+            cum_l[first_row[crows] - 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xs_comp = np.where(soma, xs, L / L_comp[crows])
+        nids_comp = np.where(soma, 1, arr.index[crows])
+        return nids_comp, xs_comp
+
+    def _convertLocsToOriginal(self, nids_comp, xs_comp):
+        '''
+        Convert locations on the computational tree to locations on the
+        original tree
+
+        Parameters
+        ----------
+            nids_comp: numpy.array of ints
+                the node indices of the locations on the computational tree
+            xs_comp: numpy.array of floats
+                the x-coordinates of the locations on the computational tree
+
+        Returns
+        -------
+            (numpy.array of ints, numpy.array of floats)
+                the node indices and x-coordinates on the original tree
+
+        Raises
+        ------
+            ValueError
+                If the resulting x-coordinates are not in ``[0,1]``
+        '''
+        arr, cum_l, comp_row, first_row, L_comp = \
+                                        self._getLocConversionArrays()
+        nids_comp = np.asarray(nids_comp, dtype=int)
+        xs_comp = np.asarray(xs_comp, dtype=float)
+        soma = nids_comp == 1
+        crows = arr.getRows(nids_comp)
+        start = first_row[crows]
+        # position of the locations in units of cumulative length
+        P = cum_l[start - 1] + xs_comp * L_comp[crows]
+        rows = np.searchsorted(cum_l, P, side='left')
+        rows = np.minimum(np.maximum(rows, start), crows)
+        L_n = arr['L'][rows]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xs = np.where(L_n > 0., (P - cum_l[rows] + L_n) / L_n, 1.)
+        xs = np.where(soma, xs_comp, xs)
+        if np.any(xs > 1. + 1e-8) or np.any(xs < -1e-8):
+            raise ValueError('x-value should be in [0,1]')
+        xs = np.clip(xs, 0., 1.)
+        nids = np.where(soma, 1, arr.index[rows])
+        return nids, xs
+
     def removeComptree(self):
         '''
         Removes the computational tree
         '''
         self._computational_root = None
+        self._resetComputationalCaches()
         self.treetype = 'original'
         for node in self:
             node.used_in_comptree = False
@@ -931,52 +1735,78 @@ class MorphTree(STree):
         if type(loc2) == dict or type(loc2) == tuple:
             loc2 = MorphLoc(loc2, self)
         # start path length calculation
-        if loc1['node'] == loc2['node']:
-            node = self[loc1['node']]
-            if node.index == 1:
-                L = 0. # soma is spherical and has no lenght
-            else:
-                L = node.L * np.abs(loc1['x'] - loc2['x'])
-            if compute_radius:
-                R = node.R
+        arr = self.getArrayTree()
+        rows = arr.getRows([loc1['node'], loc2['node']])
+        res = self._pathLengthFromRows(rows[0], loc1['x'], rows[1], loc2['x'],
+                                       compute_radius=compute_radius)
+        if compute_radius:
+            return float(res[0]), float(res[1])
         else:
-            node1 = self[loc1['node']]
-            node2 = self[loc2['node']]
-            path1 = self.pathToRoot(node1)[::-1]
-            path2 = self.pathToRoot(node2)[::-1]
-            path = path1 if len(path1) < len(path2) else path2
-            ind = next((ii for ii in xrange(len(path)) if path1[ii] != path2[ii]),
-                       len(path))
-            if path1[ind-1] == node1:
-                L  = node1.L * (1. - loc1['x'])
-                L += sum(node.L for node in path2[ind:-1])
-                L += node2.L * loc2['x']
-                if compute_radius:
-                    R  = node1.R * node1.L * (1. - loc1['x'])
-                    R += sum(node.R * node.L for node in path2[ind:-1])
-                    R += node2.R * node2.L * loc2['x']
-                    R /= L
-            elif path2[ind-1] == node2:
-                L  = node1.L * loc1['x']
-                L += sum(node.L for node in path1[ind:-1])
-                L += node2.L * (1. - loc2['x'])
-                if compute_radius:
-                    R  = node1.R * node1.L * loc1['x']
-                    R += sum(node.R * node.L for node in path2[ind:-1])
-                    R += node2.R * node2.L * (1. - loc2['x'])
-                    R /= L
-            else:
-                L  = node1.L * loc1['x']
-                L += sum(node.L for node in path1[ind:-1])
-                L += sum(node.L for node in path2[ind:-1])
-                L += node2.L * loc2['x']
-                if compute_radius:
-                    R  = node1.R * node1.L * loc1['x']
-                    R += sum(node.R * node.L for node in path1[ind:-1])
-                    R += sum(node.R * node.L for node in path2[ind:-1])
-                    R += node2.R * node2.L * loc2['x']
-                    R /= L
+            return float(res)
+
+    def _getCumulativeArrays(self):
+        '''
+        Returns the cumulative length and the cumulative length-weighted radius
+        along the path from the root to the distal end of each node, in the row
+        order of the array tree. The arrays are cached until the tree structure
+        changes.
+
+        Returns
+        -------
+            (numpy.array, numpy.array)
+        '''
+        if 'cumulative_arrays' not in self._cache:
+            arr = self.getArrayTree()
+            self._cache['cumulative_arrays'] = \
+                            (arr.accumulateDown(arr['L']),
+                             arr.accumulateDown(arr['L'] * arr['R']))
+        return self._cache['cumulative_arrays']
+
+    def _pathLengthFromRows(self, rows1, x1, rows2, x2, compute_radius=0):
+        '''
+        Vectorized computation of the path lengths between pairs of locations,
+        given as the rows of their nodes in the array tree and their x-coordinates.
+        The path between two locations passes through the distal end of the
+        lowest common ancestor of their nodes, unless both locations are on the
+        same node.
+
+        Parameters
+        ----------
+            rows1, rows2: int or numpy.array of ints
+                The rows of the nodes of the locations
+            x1, x2: float or numpy.array of floats
+                The x-coordinates of the locations
+            compute_radius: bool
+                if True, also computes the average weighted radius of the paths
+
+        Returns
+        -------
+        L, R (optional)
+            L: numpy.array of floats
+                length of the paths, in micron
+            R: numpy.array of floats
+                weighted average radius of the paths, in micron
+        '''
+        arr = self.getArrayTree()
+        rows1 = np.asarray(rows1, dtype=int); rows2 = np.asarray(rows2, dtype=int)
+        x1 = np.asarray(x1, dtype=float); x2 = np.asarray(x2, dtype=float)
+        cum_l, cum_lr = self._getCumulativeArrays()
+        lca = arr.getLCA(rows1, rows2)
+        same = rows1 == rows2
+        soma = arr.index[rows1] == 1
+        # distances of the locations and the branch point to the root
+        L_n1, L_n2 = arr['L'][rows1], arr['L'][rows2]
+        d1 = cum_l[rows1] - (1. - x1) * L_n1
+        d2 = cum_l[rows2] - (1. - x2) * L_n2
+        L = np.abs(d1 - cum_l[lca]) + np.abs(d2 - cum_l[lca])
+        L = np.where(same, np.where(soma, 0., L_n1 * np.abs(x1 - x2)), L)
         if compute_radius:
+            R_n1, R_n2 = arr['R'][rows1], arr['R'][rows2]
+            d1 = cum_lr[rows1] - (1. - x1) * L_n1 * R_n1
+            d2 = cum_lr[rows2] - (1. - x2) * L_n2 * R_n2
+            LR = np.abs(d1 - cum_lr[lca]) + np.abs(d2 - cum_lr[lca])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                R = np.where(same, R_n1, LR / L)
             return L, R
         else:
             return L
@@ -988,7 +1818,7 @@ class MorphTree(STree):
 
         Parameters
         ----------
-            locs: list of dicts, tuples or :class:`MorphLoc`
+            locs: list of dicts, tuples or :class:`MorphLoc`, or :class:`LocArray`
                 the locations to be stored
             name: string
                 name under which these locations are stored
@@ -998,41 +1828,43 @@ class MorphTree(STree):
             ValueError
                 If multiple locations are on the soma.
         '''
-        # copy list and store in MorphLoc if necessary
-        locs_ = []
-        n1 = 0
-        for loc in locs:
-            locs_.append(MorphLoc(loc, self))
-            if locs_[-1]['node'] == 1: n1 += 1
-        if n1 > 1:
+        # copy the locations in a location array
+        locs_ = LocArray(locs, self)
+        if np.sum(locs_['node'] == 1) > 1:
             # raise ValueError('There can only be one location on the soma, \
             #                  multiple soma location occur in input')
             warnings.warn('There are multiple locations on the soma in this set ' + \
                           'locations, this can cause issues in certain functions', UserWarning)
         self.locs[name] = locs_
-        self._nids_orig[name] = np.array([loc['node'] for loc in locs_])
-        self._xs_orig[name] = np.array([loc['x'] for loc in locs_])
+        self._nids_orig[name] = locs_['node']
+        self._xs_orig[name] = locs_['x']
+        self._resetLocIndex(name)
+        # quantities derived from a previous set of the same name
+        for cache in (self.d2s, self.d2b, self.leafinds):
+            cache.pop(name, None)
         if self._computational_root != None:
             self._storeCompLocs(name)
 
     @computationalTreetypeDecorator
     def _storeCompLocs(self, name):
-        self._nids_comp[name] = np.array([loc['node'] for loc in self.locs[name]])
-        self._xs_comp[name] = np.array([loc['x'] for loc in self.locs[name]])
+        locs = self.locs[name]
+        locs._setComputationalLocs()
+        self._nids_comp[name] = locs['node']
+        self._xs_comp[name] = locs['x']
 
-    @originalTreetypeDecorator
     def addLoc(self, loc, name):
-        loc = MorphLoc(loc, self)
-        self.locs[name].append(loc)
-        self._nids_orig[name] = np.concatenate((self._nids_orig[name], [loc['node']]))
-        self._xs_orig[name] = np.concatenate((self._xs_orig[name], [loc['x']]))
-        if self._computational_root != None:
-            self._addCompLoc(loc, name)
+        '''
+        Add a location to the set of locations of a specified name
 
-    @computationalTreetypeDecorator
-    def _addCompLoc(self, loc, name):
-        self._nids_comp[name] = np.concatenate((self._nids_comp[name], [loc['node']]))
-        self._xs_comp[name] = np.concatenate((self._xs_comp[name], [loc['x']]))
+        Parameters
+        ----------
+            loc: dict, tuple or :class:`MorphLoc`
+                the location to be added
+            name: string
+                name of the set of locations
+        '''
+        self._tryName(name)
+        self.storeLocs(self.locs[name] + [loc], name)
 
     def removeLocs(self, name):
         '''
@@ -1043,6 +1875,7 @@ class MorphTree(STree):
             name: string
                 name under which the desired list of locations is stored
         '''
+        self._resetLocIndex(name)
         try:
             del self.locs[name]
             del self._nids_orig[name]
@@ -1095,7 +1928,10 @@ class MorphTree(STree):
 
         Returns
         -------
-            list of :class:`MorphLoc`
+            :class:`LocArray`
+                The stored set of locations. It behaves as a read-only
+                sequence of :class:`MorphLoc`, use :func:`LocArray.tolist` to
+                obtain a list.
         '''
         self._tryName(name)
         return self.locs[name]
@@ -1156,6 +1992,56 @@ class MorphTree(STree):
 
     xs = property(getXs, setXs)
 
+    def _getLocIndex(self, name):
+        '''
+        Returns an index of the locations of a given name per node, in
+        compressed sparse row format. The indices of the locations on the node
+        at row ``i`` of the array tree, ordered for increasing x, are
+        ``loc_ind[loc_ptr[i]:loc_ptr[i+1]]``. Since the rows are in depth-first
+        order, the indices of the locations in the subtree of the node at row
+        ``i`` are ``loc_ind[loc_ptr[i]:loc_ptr[i+size[i]]]``. The index is
+        constructed once for each name and treetype, and is kept until the
+        locations or the tree structure change.
+
+        Parameters
+        ----------
+            name: string
+                which list of locations to consider
+
+        Returns
+        -------
+            loc_ptr: numpy.array of ints
+            loc_ind: numpy.array of ints
+        '''
+        cache = self.getRevisionCache('loc_index', kinds=('structure',))
+        key = (name, self.treetype)
+        if key not in cache:
+            self._tryName(name)
+            arr = self.getArrayTree()
+            rows = arr.getRows(self.nids[name])
+            # sort on row first and on x second, lexsort is stable
+            loc_ind = np.lexsort((self.xs[name], rows))
+            n_loc = np.bincount(rows, minlength=len(arr)) if len(rows) > 0 \
+                    else np.zeros(len(arr), dtype=int)
+            loc_ptr = np.concatenate(([0], np.cumsum(n_loc))).astype(int)
+            cache[key] = (loc_ptr, loc_ind)
+        return cache[key]
+
+    def _resetLocIndex(self, name):
+        for cache_name in ('loc_index', 'nearest_locs'):
+            cache = self.getRevisionCache(cache_name, kinds=('structure',))
+            cache.pop((name, 'original'), None)
+            cache.pop((name, 'computational'), None)
+
+    def _getLocindArrayOnNode(self, name, index):
+        loc_ptr, loc_ind = self._getLocIndex(name)
+        try:
+            row = self.getArrayTree().getRows(index)
+        except KeyError:
+            # node is not part of the tree of the present treetype
+            return loc_ind[:0]
+        return loc_ind[loc_ptr[row]:loc_ptr[row+1]]
+
     def getLocindsOnNode(self, name, node):
         '''
         Returns a list of the indices of locations in the list of a given name
@@ -1173,14 +2059,30 @@ class MorphTree(STree):
             list of ints
                 indices of locations on the path
         '''
-        self._tryName(name)
-        nids = self.nids[name]
-        xs = self.xs[name]
-        # get the locinds on the node
-        inds = np.where(nids == node.index)[0]
-        sortinds = np.argsort(xs[inds])
+        return self._getLocindArrayOnNode(name, node.index).tolist()
 
-        return inds[sortinds].tolist()
+    def getLocindsInSubtree(self, name, node):
+        '''
+        Returns a list of the indices of locations in the list of a given name
+        that are in the subtree of the input node, including the node itself.
+        Nodes are in depth-first order and within each node, locations are
+        ordered for increasing x.
+
+        Parameters
+        ----------
+            name: string
+                which list of locations to consider
+            node: :class:`MorphNode`
+                the root of the subtree
+        Returns
+        -------
+            list of ints
+                indices of locations in the subtree
+        '''
+        loc_ptr, loc_ind = self._getLocIndex(name)
+        arr = self.getArrayTree()
+        row = arr.getRows(node.index)
+        return loc_ind[loc_ptr[row]:loc_ptr[row+arr.size[row]]].tolist()
 
     def getLocindsOnNodes(self, name, node_arg):
         '''
@@ -1242,7 +2144,7 @@ class MorphTree(STree):
         if len(path) > 1:
             # first node in path
             node = path[0]
-            ninds = np.array(self.getLocindsOnNode(name, node)).astype(int)
+            ninds = self._getLocindArrayOnNode(name, node.index)
             if node.parent_node == None:
                 locinds.extend(ninds)
             else:
@@ -1257,7 +2159,7 @@ class MorphTree(STree):
                 locinds.extend(ninds[inds][sortinds])
             # middle nodes in path
             for ii, node in enumerate(path[1:-1]):
-                ninds = np.array(self.getLocindsOnNode(name, node)).astype(int)
+                ninds = self._getLocindArrayOnNode(name, node.index)
                 if node.parent_node == None:
                     locinds.extend(ninds)
                 elif path[ii+2] == node.parent_node:
@@ -1275,7 +2177,7 @@ class MorphTree(STree):
                         locinds.extend(ninds[inds])
             # last node in path
             node = path[-1]
-            ninds = np.array(self.getLocindsOnNode(name, node)).astype(int)
+            ninds = self._getLocindArrayOnNode(name, node.index)
             if node.parent_node == None:
                 locinds.extend(ninds)
             else:
@@ -1290,7 +2192,7 @@ class MorphTree(STree):
                 locinds.extend(ninds[inds][sortinds])
         elif len(path) == 1:
             node = path[0]
-            ninds = np.array(self.getLocindsOnNode(name, node)).astype(int)
+            ninds = self._getLocindArrayOnNode(name, node.index)
             if node.parent_node == None:
                 locinds.extend(ninds)
             else:
@@ -1313,7 +2215,7 @@ class MorphTree(STree):
 
         Parameters
         ----------
-            locs: list of dicts, tuples or :class:`MorphLoc`
+            locs: list of dicts, tuples or :class:`MorphLoc`, or :class:`LocArray`
                 the locations for which the nearest location index has to be
                 found
             name: string
@@ -1325,132 +2227,175 @@ class MorphTree(STree):
         Returns
         -------
             loc_indices: list of ints
-                indices of the locations closest to the given locs
+                indices of the locations closest to the given locs, ``None``
+                if no location is found in the given direction
+        '''
+        loc_indices, _ = self.getNearestLocindArrays(locs, name,
+                                                     direction=direction)
+        return [int(ind) if ind >= 0 else None for ind in loc_indices]
+
+    def getNearestLocindArrays(self, locs, name, direction=0):
+        '''
+        Batched version of :func:`MorphTree.getNearestLocinds`, that finds the
+        closest location in a stored set for all input locations at once and
+        also returns the path lengths to these locations.
+
+        With `direction` 1, the search is restricted to the stored locations on
+        the same node with smaller or equal x-coordinate and to those outside
+        the subtree of the node. With `direction` 2, the search is restricted
+        to the stored locations on the same node with larger or equal
+        x-coordinate and to those in the subtree of the node. If the input
+        location is on the soma, the stored soma location is returned in both
+        directions.
+
+        Parameters
+        ----------
+            locs: list of dicts, tuples or :class:`MorphLoc`, or :class:`LocArray`
+                the locations for which the nearest location index has to be
+                found
+            name: string
+                name under which the reference list is stored
+            direction: int
+                flag to indicate whether to search in both directions (0), only
+                in the up direction (1) or in the down direction (2).
+
+        Returns
+        -------
+            loc_indices: numpy.array of ints
+                indices of the locations closest to the given locs, ``-1``
+                if no location is found in the given direction
+            lengths: numpy.array of floats
+                path lengths between the given locs and their closest
+                locations, in micron, ``inf`` if no location is found
+
+        Raises
+        ------
+            ValueError
+                If `direction` is not 0, 1 or 2
         '''
+        if direction not in (0, 1, 2):
+            raise ValueError('`direction` should be 0, 1 or 2')
         self._tryName(name)
-        # create the locs in a desirable format
-        locs_ = []
-        for loc in locs:
-            if type(loc) == dict or type(loc) == tuple:
-                locs_.append(MorphLoc(loc, self))
-            else:
-                locs_.append(copy.deepcopy(loc))
-        locs = locs_
-        # look for the location indices
-        loc_indices = []
-        for loc in locs:
-            loc_ind1 = None; loc_ind2 = None
-            # find the location indices if necessary
-            if direction == 0 or direction == 1:
-                loc_ind1 = self._findLocsDown(loc, name)
-            if direction == 0 or direction == 2:
-                loc_ind2 = self._findLocsUp(loc, name)
-            # save the index of the closest location, if it exists and
-            # if it is asked for
-            if loc_ind1 == None and (direction == 0 or direction == 2):
-                loc_indices.append(loc_ind2)
-            elif loc_ind2 == None and (direction == 0 or direction == 1):
-                loc_indices.append(loc_ind1)
-            else:
-                L1 = self.pathLength(loc, self.locs[name][loc_ind1])
-                L2 = self.pathLength(loc, self.locs[name][loc_ind2])
-                if L1 >= L2:
-                    loc_indices.append(loc_ind2)
-                else:
-                    loc_indices.append(loc_ind1)
-        return loc_indices
-
-    def _findLocsUp(self, loc, name):
-        look_further = False
-        # look if there are locs on the same node
-        n_inds = np.where(loc['node'] == self.nids[name])[0]
-        if len(n_inds) > 0:
-            if loc['node'] == 1:
-                loc_ind = n_inds[0]
-            else:
-                x_inds = np.where(loc['x'] <= self.xs[name][n_inds])[0]
-                if len(x_inds) != 0:
-                    ind = np.argmin(self.xs[name][n_inds][x_inds])
-                    loc_ind = n_inds[x_inds[ind]]
-                else:
-                    look_further = True
-        else:
-            look_further = True
-        # if no locs on the same node, then proceed to child nodes
-        # else, return the smallest location larger than loc
-        if look_further:
-            node = self[loc['node']]
-            cnodes = node.getChildNodes()
-            loc_inds = []
-            for cnode in cnodes:
-                cloc_ind = self._findLocsUp({'node': cnode.index, 'x': 0.}, name)
-                if cloc_ind != None:
-                    loc_inds.append(cloc_ind)
-            # get the one that is closest, if they exist
-            pl_aux = 1e4
-            ind_loc = 0
-            for i, l_i in enumerate(loc_inds):
-                pl = self.pathLength({'node': loc['node'], 'x': 1.}, self.locs[name][l_i])
-                if pl < pl_aux:
-                    pl_aux = pl
-                    ind_loc = i
-            if pl_aux > 0. and len(loc_inds) > 0:
-                loc_ind = loc_inds[ind_loc]
-            elif pl_aux == 0. and node.index == 1:
-                loc_ind = loc_inds[ind_loc]
-            else:
-                loc_ind = None
-        return loc_ind
-
-    def _findLocsDown(self, loc, name):
-        look_further = False
-        # look if there are locs on the same node
-        n_inds = np.where(loc['node'] == self.nids[name] )[0]
-        if len(n_inds) > 0:
-            if loc['node'] == 1:
-                loc_ind = n_inds[0]
-            else:
-                x_inds = np.where(loc['x'] >= self.xs[name][n_inds])[0]
-                if len(x_inds) != 0:
-                    ind = np.argmax(self.xs[name][n_inds][x_inds])
-                    loc_ind = n_inds[x_inds[ind]]
-                else:
-                    look_further = True
-        else:
-            look_further = True
-        if look_further:
-            # if no locs on the same node, then proceed to resp. parent and child nodes
-            node = self[loc['node']]
-            pnode = node.getParentNode()
-            loc_inds = []
-            # check parent node
-            if pnode != None:
-                ploc_ind = self._findLocsDown({'node': pnode.index, 'x': 1.}, name)
-                if ploc_ind != None:
-                    loc_inds.append(ploc_ind)
-            # check other child nodes of parent node
-            if pnode != None:
-                ocnodes = copy.copy(pnode.getChildNodes())
-                ocnodes.remove(node)
-            else:
-                ocnodes = []
-            for cnode in ocnodes:
-                cloc_ind = self._findLocsUp({'node': cnode.index, 'x': 0.}, name)
-                if cloc_ind != None:
-                    loc_inds.append(cloc_ind)
-            # get the one that is closest, if they exist
-            pl_aux = 1e4
-            ind_loc = 0
-            for i, l_i in enumerate(loc_inds):
-                pl = self.pathLength({'node': loc['node'], 'x': 1.}, self.locs[name][l_i])
-                if pl < pl_aux:
-                    pl_aux = pl
-                    ind_loc = i
-            if pl_aux > 0. and len(loc_inds) > 0:
-                loc_ind = loc_inds[ind_loc]
-            else:
-                loc_ind = None
-        return loc_ind
+        locs = LocArray(locs, self)
+        arr = self.getArrayTree()
+        loc_ptr, loc_ind = self._getLocIndex(name)
+        rows = arr.getRows(locs['node'])
+        xs = locs['x']
+        n_q = len(rows)
+        if len(loc_ind) == 0:
+            return -np.ones(n_q, dtype=int), np.inf * np.ones(n_q)
+        d_loc, keys, first_eq, table, d_out, i_out = \
+                                    self._getNearestLocTables(name)
+        cum_l, _ = self._getCumulativeArrays()
+        L = arr['L']
+        d_q = cum_l[rows] - (1. - xs) * L[rows]
+        # since x is in [0,1], the keys order the locations on row first and
+        # on x second, as in the location index
+        q_keys = rows + .5 * xs
+        # stored soma location, which is found in both directions
+        soma = rows == 0
+        n_soma = loc_ptr[1] - loc_ptr[0]
+        i_soma = np.min(loc_ind[:n_soma]) if n_soma > 0 else -1
+        soma_loc = soma & (n_soma > 0)
+        i_down = -np.ones(n_q, dtype=int); d_down = np.inf * np.ones(n_q)
+        i_up = -np.ones(n_q, dtype=int); d_up = np.inf * np.ones(n_q)
+        if direction == 0 or direction == 1:
+            # locations with smaller x on the same node, the last one in index
+            # order has the largest x
+            pos = np.searchsorted(keys, q_keys, side='right') - 1
+            on_node = (pos >= loc_ptr[rows]) & ~soma
+            i_node = np.where(on_node,
+                              loc_ind[first_eq[np.maximum(pos, 0)]], -1)
+            i_down = np.where(on_node, i_node, i_out[rows])
+            d_down = np.where(on_node, d_q - d_loc[np.maximum(i_node, 0)],
+                                       d_out[rows] + xs * L[rows])
+            i_down[soma_loc] = i_soma; d_down[soma_loc] = 0.
+        if direction == 0 or direction == 2:
+            # locations with larger x on the same node, the first one in index
+            # order has the smallest x
+            pos = np.searchsorted(keys, q_keys, side='left')
+            on_node = (pos < loc_ptr[rows+1]) & ~soma
+            i_node = np.where(on_node,
+                              loc_ind[np.minimum(pos, len(keys)-1)], -1)
+            # locations in the subtrees of the child nodes
+            pos = _queryArgmin(d_loc[loc_ind], table, loc_ptr[rows+1],
+                               loc_ptr[rows+arr.size[rows]])
+            i_up = np.where(on_node, i_node,
+                            np.where(pos >= 0, loc_ind[pos], -1))
+            d_up = np.where(i_up >= 0, d_loc[i_up] - d_q, np.inf)
+            i_up[soma_loc] = i_soma; d_up[soma_loc] = 0.
+        # in both directions, the down location is taken only if it is strictly
+        # closer
+        use_down = d_down < d_up
+        loc_indices = np.where(use_down, i_down, i_up)
+        lengths = np.where(use_down, d_down, d_up)
+        return loc_indices, lengths
+
+    def _getNearestLocTables(self, name):
+        '''
+        Returns the arrays used in the nearest location search, constructed
+        once for each non-empty set of locations and treetype:
+
+            d_loc: the distance of each stored location to the root
+            keys, first_eq: the row plus half the x-coordinate of the stored
+                locations in the order of the location index, and the first
+                position in the index with the same row and x-coordinate
+            table: the range minimum table of the distances to the root in the
+                order of the location index
+            d_out, i_out: for the node at each row, the path length between the
+                proximal end of the node and the closest location outside its
+                subtree, and the index of that location (``-1`` if there is
+                none)
+        '''
+        cache = self.getRevisionCache('nearest_locs', kinds=('structure',))
+        key = (name, self.treetype)
+        if key not in cache:
+            arr = self.getArrayTree()
+            loc_ptr, loc_ind = self._getLocIndex(name)
+            cum_l, _ = self._getCumulativeArrays()
+            L = arr['L']
+            lrows = arr.getRows(self.nids[name])
+            lxs = np.asarray(self.xs[name], dtype=float)
+            d_loc = cum_l[lrows] - (1. - lxs) * L[lrows]
+            keys = lrows[loc_ind] + .5 * lxs[loc_ind]
+            first_eq = np.arange(len(keys))
+            first_eq[1:][keys[1:] == keys[:-1]] = 0
+            first_eq = np.maximum.accumulate(first_eq)
+            vals = d_loc[loc_ind]
+            table = _getArgminTable(vals)
+            n_node = len(arr)
+            i_out = -np.ones(n_node, dtype=int); d_out = np.inf * np.ones(n_node)
+            # closest location on the parent node, at the largest x-value, or
+            # the soma location
+            crows = np.arange(1, n_node); prows = arr.parent[crows]
+            has_p = loc_ptr[prows+1] > loc_ptr[prows]
+            i_p = np.where(has_p,
+                        loc_ind[first_eq[np.maximum(loc_ptr[prows+1]-1, 0)]], -1)
+            if loc_ptr[1] > loc_ptr[0]:
+                i_p[prows == 0] = np.min(loc_ind[loc_ptr[0]:loc_ptr[1]])
+            d_p = np.where(has_p, cum_l[prows] - d_loc[i_p], np.inf)
+            d_p[has_p & (prows == 0)] = 0.
+            # closest location in the subtrees of the sibling nodes, the
+            # siblings before the node in the location index are preferred
+            pos0 = _queryArgmin(vals, table, loc_ptr[prows+1], loc_ptr[crows])
+            pos1 = _queryArgmin(vals, table, loc_ptr[crows+arr.size[crows]],
+                                loc_ptr[prows+arr.size[prows]])
+            v0 = np.where(pos0 >= 0, vals[pos0], np.inf)
+            v1 = np.where(pos1 >= 0, vals[pos1], np.inf)
+            pos = np.where(v1 < v0, pos1, pos0)
+            i_s = np.where(pos >= 0, loc_ind[pos], -1)
+            d_s = np.minimum(v0, v1) - cum_l[prows]
+            # if there are no locations on the parent, proceed to the
+            # locations outside of the subtree of the parent
+            for rows in arr.getLevels()[1:]:
+                ii = rows - 1; prows_ = prows[ii]
+                i_par = np.where(has_p[ii], i_p[ii], i_out[prows_])
+                d_par = np.where(has_p[ii], d_p[ii], d_out[prows_] + L[prows_])
+                use_par = d_par <= d_s[ii]
+                i_out[rows] = np.where(use_par, i_par, i_s[ii])
+                d_out[rows] = np.where(use_par, d_par, d_s[ii])
+            cache[key] = (d_loc, keys, first_eq, table, d_out, i_out)
+        return cache[key]
 
     def getLeafLocinds(self, name):
         '''
@@ -1472,38 +2417,20 @@ class MorphTree(STree):
             self.leafinds[name]
         except KeyError:
             self._tryName(name)
-            self.leafinds[name] = []
-            locs = self.locs[name]
-            for ind, loc in enumerate(locs):
-                if not self._hasLocUp(loc, name):
-                    self.leafinds[name].append(ind)
+            nids = self.nids[name]; xs = self.xs[name]
+            loc_ptr, loc_ind = self._getLocIndex(name)
+            arr = self.getArrayTree()
+            rows = arr.getRows(nids)
+            # a location has a location farther from the root if there is a
+            # location with larger x on the same node, or if there is a
+            # location with x > 0 in the subtree of one of its child nodes
+            n_up = np.concatenate(([0], np.cumsum(xs[loc_ind] > 0.)))
+            has_up = n_up[loc_ptr[rows+arr.size[rows]]] > n_up[loc_ptr[rows+1]]
+            xmax = xs[loc_ind[loc_ptr[rows+1]-1]] if len(rows) > 0 else xs
+            has_up |= (xs < xmax) & (nids != 1)
+            self.leafinds[name] = np.where(~has_up)[0].tolist()
         return self.leafinds[name]
 
-    def _hasLocUp(self, loc, name):
-        look_further = False
-        # look if there are locs on the same node
-        if loc['node'] != 1:
-            n_inds = np.where(loc['node'] == self.nids[name] )[0]
-            if len(n_inds) > 0:
-                x_inds = np.where(loc['x'] < self.xs[name][n_inds])[0]
-                if len(x_inds) > 0:
-                    returnbool = True
-                else:
-                    look_further = True
-            else:
-                look_further = True
-        else:
-            look_further = True
-        # if no locs on the same node, then proceed to child nodes
-        if look_further:
-            node = self[loc['node']]
-            cnodes = node.child_nodes
-            returnbool = False
-            for cnode in cnodes:
-                if self._hasLocUp({'node': cnode.index, 'x': 0.}, name):
-                    returnbool = True
-        return returnbool
-
     def distancesToSoma(self, name):
         '''
         Compute the distance of each location in a given set to the soma
@@ -1522,11 +2449,211 @@ class MorphTree(STree):
             return self.d2s[name]
         except KeyError:
             self._tryName(name)
-            locs = self.locs[name]
-            self.d2s[name] = np.array([self.pathLength({'node': 1, 'x': 0.}, loc) \
-                                        for loc in locs])
+            self.d2s[name] = self._distancesFromNodeArrays(self.nids[name],
+                                                           self.xs[name])[0]
             return self.d2s[name]
 
+    def _getDistanceArrays(self):
+        '''
+        Returns the distances of the distal end of each node to the soma and
+        to the distal end of the nearest bifurcation in the direction of the
+        root, in the row order of the array tree. The arrays are cached until
+        the tree structure changes.
+
+        Returns
+        -------
+            (numpy.array, numpy.array)
+        '''
+        if 'distance_arrays' not in self._cache:
+            arr = self.getArrayTree()
+            cum_l, _ = self._getCumulativeArrays()
+            brows, _ = arr.getUpBifurcations()
+            d_bif = cum_l - np.where(brows >= 0, cum_l[np.maximum(brows, 0)],
+                                                 cum_l)
+            self._cache['distance_arrays'] = (cum_l, d_bif)
+        return self._cache['distance_arrays']
+
+    def _distancesFromNodeArrays(self, nids, xs):
+        '''
+        Vectorized computation of the distances of locations to the soma and
+        to the nearest bifurcation in the direction of the root, interpolated
+        from the distances of the distal ends of the nodes. Locations on the
+        soma have distance zero.
+
+        Parameters
+        ----------
+            nids: numpy.array of ints
+                the node indices of the locations
+            xs: numpy.array of floats
+                the x-coordinates of the locations
+
+        Returns
+        -------
+            (numpy.array of floats, numpy.array of floats)
+                the distances to the soma and to the nearest bifurcation
+        '''
+        arr = self.getArrayTree()
+        d_root, d_bif = self._getDistanceArrays()
+        rows = arr.getRows(np.asarray(nids, dtype=int))
+        soma = arr.parent[rows] < 0
+        dx = (1. - np.asarray(xs, dtype=float)) * arr['L'][rows]
+        d2s = np.where(soma, 0., d_root[rows] - dx)
+        d2b = np.where(soma, 0., d_bif[rows] - dx)
+        return d2s, d2b
+
+    def pathLengthMatrix(self, name, compute_radius=0, block_size=None,
+                               out=None, out_radius=None, filename=None):
+        '''
+        Compute the path lengths between all pairs of locations in a given set,
+        using the cumulative path arrays and lowest common ancestor queries of
+        the array tree. For large sets, the matrix can be computed in blocks of
+        rows and written to a given array or to a memory-mapped file.
+
+        Parameters
+        ----------
+            name: string
+                name of the set of locations
+            compute_radius: bool
+                if True, also computes the average weighted radius of the paths
+            block_size: int or None
+                number of rows computed at once. If ``None``, the full matrix is
+                computed at once.
+            out: numpy.array or None
+                array of shape ``(n_loc, n_loc)`` in which the path lengths are
+                written, e.g. a `numpy.memmap`
+            out_radius: numpy.array or None
+                array of shape ``(n_loc, n_loc)`` in which the radii are written,
+                only used if `compute_radius` is True
+            filename: string or None
+                if given and `out` is ``None``, the path lengths are written to
+                a memory-mapped ``.npy`` file with this name. The radii are
+                written to the same file name with ``'_radius'`` appended
+                before the extension (if `out_radius` is ``None``).
+
+        Returns
+        -------
+        L, R (optional)
+            L: numpy.array of floats (``shape=(n_loc, n_loc)``)
+                the path lengths between the locations, in micron
+            R: numpy.array of floats (``shape=(n_loc, n_loc)``)
+                weighted average radii of the paths, in micron
+        '''
+        self._tryName(name)
+        arr = self.getArrayTree()
+        rows = arr.getRows(self.nids[name])
+        xs = np.asarray(self.xs[name], dtype=float)
+        n_loc = len(rows)
+        if block_size is None:
+            block_size = max(n_loc, 1)
+        # output arrays
+        if out is None:
+            out = self._createOutputArray((n_loc, n_loc), filename)
+        if compute_radius and out_radius is None:
+            if filename is not None:
+                root, ext = os.path.splitext(filename)
+                filename = root + '_radius' + (ext if ext else '.npy')
+            out_radius = self._createOutputArray((n_loc, n_loc), filename)
+        # compute the matrix block by block
+        for i0 in xrange(0, n_loc, block_size):
+            i1 = min(i0 + block_size, n_loc)
+            res = self._pathLengthFromRows(rows[i0:i1,None], xs[i0:i1,None],
+                                           rows[None,:], xs[None,:],
+                                           compute_radius=compute_radius)
+            if compute_radius:
+                out[i0:i1] = res[0]
+                out_radius[i0:i1] = res[1]
+            else:
+                out[i0:i1] = res
+        for arr_ in (out, out_radius):
+            if isinstance(arr_, np.memmap):
+                arr_.flush()
+        if compute_radius:
+            return out, out_radius
+        else:
+            return out
+
+    def _createOutputArray(self, shape, filename=None, dtype=float,
+                                 shared=False):
+        '''
+        Returns an empty array, memory-mapped to a ``.npy`` file if a file name
+        is given, or in memory shared with forked worker processes if `shared`
+        is ``True``
+        '''
+        if filename is not None:
+            return np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                             shape=shape)
+        if shared:
+            dtype = np.dtype(dtype)
+            raw = multiprocessing.sharedctypes.RawArray(ctypes.c_char,
+                                    max(int(np.prod(shape)) * dtype.itemsize, 1))
+            return np.frombuffer(raw, dtype=dtype,
+                                 count=int(np.prod(shape))).reshape(shape)
+        return np.zeros(shape, dtype=dtype)
+
+    @originalTreetypeDecorator
+    def getSegmentIndex(self, max_piece_length=None):
+        '''
+        Returns a spatial index over the segments of the original tree. The
+        segment of a node runs from the 3D location of its parent (``x=0``) to
+        its own 3D location (``x=1``), and has the radius of the node. The soma
+        is represented by its center point and radius. The index is cached until
+        the tree structure changes.
+
+        Parameters
+        ----------
+            max_piece_length: float or None
+                see :class:`SegmentIndex`, if given a new index is constructed
+
+        Returns
+        -------
+            :class:`SegmentIndex`
+        '''
+        if 'segment_index' not in self._cache or max_piece_length is not None:
+            arr = self.getArrayTree()
+            xyz = arr['xyz']
+            p0 = np.where((arr.parent < 0)[:,None], xyz,
+                          xyz[np.maximum(arr.parent, 0)])
+            self._cache['segment_index'] = \
+                    SegmentIndex(p0, xyz, arr['R'],
+                                 max_piece_length=max_piece_length)
+        return self._cache['segment_index']
+
+    @originalTreetypeDecorator
+    def getNearestLocsToPoints(self, points, surface=False, name='No',
+                                     block_size=100000):
+        '''
+        Find the nearest location on the morphology for each point in a set of
+        3D points, e.g. to map synapse positions from reconstructions to
+        locations on the tree.
+
+        Parameters
+        ----------
+            points: numpy.array of floats (``shape=(n_point, 3)``)
+                the 3D points (micron)
+            surface: bool
+                if True, distances are measured to the membrane surface instead
+                of to the segment axes, see :func:`SegmentIndex.query`
+            name: string
+                the name under which the locations are stored. Defaults to 'No'
+                which means the locations are not stored
+            block_size: int
+                the number of points processed at once
+
+        Returns
+        -------
+            locs: :class:`LocArray`
+                the nearest locations
+            distances: numpy.array of floats
+                the distances between the points and the nearest locations
+                (micron)
+        '''
+        arr = self.getArrayTree()
+        rows, xs, distances = self.getSegmentIndex().query(points,
+                                    surface=surface, block_size=block_size)
+        locs = LocArray({'node': arr.index[rows], 'x': xs}, self)
+        if name != 'No': self.storeLocs(locs, name=name)
+        return locs, distances
+
     def distancesToBifurcation(self, name):
         '''
         Compute the distance of each location to the nearest bifurcation in
@@ -1547,17 +2674,8 @@ class MorphTree(STree):
             return self.d2b[name]
         except KeyError:
             self._tryName(name)
-            self.d2b[name] = []
-            locs = self.locs[name]
-            for i, loc in enumerate(locs):
-                if loc['node'] != 1:
-                    if loc['node'] != locs[i-1]['node']:
-                        node = self[loc['node']]
-                        bnode, _ = self.upBifurcationNode(node)
-                    self.d2b[name].append(self.pathLength( \
-                                          {'node': bnode.index, 'x': 1.}, loc))
-                else:
-                    self.d2b[name].append(0.)
+            self.d2b[name] = self._distancesFromNodeArrays(self.nids[name],
+                                                           self.xs[name])[1]
             return self.d2b[name]
 
     def distributeLocsOnNodes(self, d2s, node_arg=None, name='No'):
@@ -1580,24 +2698,32 @@ class MorphTree(STree):
 
         Returns
         -------
-            list of :class:`MorphLoc`
-                the list of locations
-        '''
-        # distribute the locations
-        locs = []
-        for node in self._convertNodeArgToNodes(node_arg):
-            if node.parent_node != None:
-                L0 = self.pathLength({'node': 1, 'x': 0.5},
-                                      {'node': node.index, 'x': 0.})
-                L1 = self.pathLength({'node': 1, 'x': 0.5},
-                                      {'node': node.index, 'x': 1.})
-                inds = np.where(np.logical_and(L0 < d2s, d2s <= L1))[0]
-                Ls = np.sort(d2s[inds])
-                locs.extend([MorphLoc((node.index, (L-L0)/(L1-L0)), self) \
-                                        for L in Ls if L > 1e-12])
-            elif np.any(np.abs(d2s) <= 1e-12):
-                # node is soma, append a location on the soma
-                locs.append(MorphLoc((node.index, 0.5), self))
+            :class:`LocArray`
+                the locations
+        '''
+        d2s = np.asarray(d2s, dtype=float).reshape(-1)
+        arr = self.getArrayTree()
+        cum_l, _ = self._getCumulativeArrays()
+        rows = arr.getRows([node.index for node in \
+                                    self._convertNodeArgToNodes(node_arg)])
+        soma = arr.parent[rows] < 0
+        # the distances on each node form a contiguous range of the sorted
+        # distances, a location on the soma is represented by an additional
+        # distance after the sorted ones
+        d_sorted = np.sort(d2s[d2s > 1e-12])
+        d_ext = np.concatenate((d_sorted, [0.]))
+        L1 = cum_l[rows]; L0 = L1 - arr['L'][rows]
+        i0 = np.searchsorted(d_sorted, L0, side='right')
+        i1 = np.searchsorted(d_sorted, L1, side='right')
+        i0[soma] = len(d_sorted)
+        i1[soma] = len(d_sorted) + int(np.any(np.abs(d2s) <= 1e-12))
+        n_loc = i1 - i0
+        pos = _concatenateRanges(i0, n_loc)
+        L0 = np.repeat(L0, n_loc); L_n = np.repeat(arr['L'][rows], n_loc)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xs = np.where(np.repeat(soma, n_loc), .5, (d_ext[pos] - L0) / L_n)
+        locs = LocArray({'node': np.repeat(arr.index[rows], n_loc), 'x': xs},
+                        self, set_as_comploc=self.treetype == 'computational')
         if name != 'No': self.storeLocs(locs, name=name)
         return locs
 
@@ -1622,107 +2748,146 @@ class MorphTree(STree):
 
         Returns
         -------
-            list of :class:`MorphLoc`
-                the list of locations
+            :class:`LocArray`
+                the locations
         '''
         assert dx > 0
-        # distribute the locations
-        locs = []
-        for node in self._convertNodeArgToNodes(node_arg):
-            if node.parent_node == None:
-                locs.append(MorphLoc((node.index, 0.5), self,
-                                     set_as_comploc=True))
-            else:
-                Nloc = np.round(node.L / dx)
-                xvals = np.arange(1, Nloc+1) / float(Nloc)
-                locs.extend([MorphLoc((node.index, xv), self,
-                                      set_as_comploc=True) for xv in xvals])
+        arr = self.getArrayTree()
+        rows = arr.getRows([node.index for node in \
+                                    self._convertNodeArgToNodes(node_arg)])
+        soma = arr.parent[rows] < 0
+        # number of locations on each node, one on the soma
+        n_loc = np.where(soma, 1, np.round(arr['L'][rows] / dx)).astype(int)
+        ks = _concatenateRanges(np.ones_like(n_loc), n_loc)
+        xs = np.where(np.repeat(soma, n_loc), .5,
+                      ks / np.repeat(n_loc, n_loc).astype(float))
+        locs = LocArray({'node': np.repeat(arr.index[rows], n_loc), 'x': xs},
+                        self, set_as_comploc=True)
         if name != 'No': self.storeLocs(locs, name=name)
         return locs
 
     def distributeLocsRandom(self, num, dx=0.001, node_arg=None,
-                                add_soma=1, name='No', seed=None):
+                                add_soma=1, name='No', seed=None, weights=None):
         '''
-        Returns a list of input locations randomly distributed on the tree
+        Returns a set of input locations randomly distributed on the tree.
+        Nodes are drawn with a probability proportional to their weight, and
+        the location is drawn uniformly on each drawn node.
+
+        If `dx` is a float, at most one location is put on each node, and
+        nodes within a distance `dx` of the distal end of a previously drawn
+        node are not drawn anymore. If `dx` is ``None``, nodes are drawn
+        independently, so that any number of locations can be distributed.
 
         Parameters
         ----------
             num: int
                 number of inputs
-            dx: float
-                minimal or given distance between input locations (micron)
+            dx: float or None
+                minimal distance between the nodes of the input locations
+                (micron)
             node_arg:
                 see documentation of :func:`MorphTree._convertNodeArgToNodes`
+            add_soma: bool
+                if True, a location on the soma precedes the input locations
             name: string
                 the name under which the locations are stored. Defaults to 'No'
                 which means the locations are not stored
+            seed: int or None
+                seed of a :class:`numpy.random.RandomState` that is used for
+                all draws, the global random state is not affected. Note that
+                a given seed yields different locations than in versions
+                where the global state was seeded and the nodes were drawn one
+                by one.
+            weights: None, 'length', 'area' or numpy.array of floats
+                The weights of the nodes. If ``None``, all nodes have the same
+                weight. If 'length' or 'area', the weights are proportional
+                to resp. the length or the surface of the nodes. If an array,
+                contains the weights of the nodes given by `node_arg` except the
+                soma, in the same order.
+
+        Returns
+        -------
+            :class:`LocArray`
+                the locations
 
-        output:
-            list of locs
+        Raises
+        ------
+            ValueError
+                If the weights are invalid
         '''
-        np.random.seed(seed)
+        rng = np.random.RandomState(seed)
         # use the requested subset of nodes
         nodes = [node for node in self._convertNodeArgToNodes(node_arg)
                  if node.index != 1]
-        # initialize the loclist with or without soma
-        if add_soma:
-            locs = [MorphLoc({'node': 1, 'x': 0.}, self)]
+        arr = self.getArrayTree()
+        rows = arr.getRows([node.index for node in nodes])
+        ws = self._getNodeWeights(rows, weights)
+        rows = rows[ws > 0]; ws = ws[ws > 0]
+        if len(rows) == 0:
+            inds = np.zeros(0, dtype=int)
+        elif dx is None:
+            inds = rng.choice(len(rows), size=num, p=ws / np.sum(ws))
         else:
-            locs = []
-        # add the nodes
-        for ii in xrange(num):
-            nodes_left = [node.index for node in nodes
-                            if 'tag' not in node.content]
-            if len(nodes_left) < 1:
-                break
-            index = np.random.choice(nodes_left)
-            x = np.random.random()
-            locs.append(MorphLoc((index, x), self))
-            node = self[index]
-            self._tagNodesDown(node, node, dx=dx)
-            self._tagNodesUp(node, node, dx=dx)
-        self._removeTags()
+            # sorting on log(u)/w, with u uniform in [0,1), yields the same
+            # order as drawing the nodes one by one without replacement
+            order = np.argsort(-np.log(1. - rng.random_sample(len(rows))) / ws,
+                               kind='mergesort')
+            inds = order[self._selectSeparatedRows(rows[order], dx, num)]
+        xs = rng.random_sample(len(inds))
+        nids = arr.index[rows[inds]]
+        # initialize the locations with or without soma
+        if add_soma:
+            nids = np.concatenate(([1], nids)); xs = np.concatenate(([0.], xs))
+        locs = LocArray({'node': nids, 'x': xs}, self,
+                        set_as_comploc=self.treetype == 'computational')
         # store the locations
         if name != 'No': self.storeLocs(locs, name=name)
         return locs
 
-    def _tagNodesDown(self, start_node, node, dx=0.001):
-        if 'tag' not in node.content:
-            if node.index == start_node.index:
-                length = 0.
+    def _getNodeWeights(self, rows, weights):
+        arr = self.getArrayTree()
+        if weights is None:
+            return np.ones(len(rows))
+        elif isinstance(weights, str):
+            if weights == 'length':
+                return arr['L'][rows]
+            elif weights == 'area':
+                return 2. * np.pi * arr['R'][rows] * arr['L'][rows]
             else:
-                length = self.pathLength({'node': start_node.index, 'x': 1.},
-                                          {'node': node.index, 'x': 0.})
-            if length < dx:
-                node.content['tag'] = 1
-                for cnode in node.child_nodes:
-                    self._tagNodesDown(start_node, cnode, dx=dx)
-
-    def _tagNodesUp(self, start_node, node, cnode=None, dx=0.001):
-        if node.index == start_node.index:
-            length = 0.
-        else:
-            length = self.pathLength({'node': start_node.index, 'x': 1.},
-                                      {'node': node.index, 'x': 1.})
-        if length < dx:
-            node.content['tag'] = 1
-            cnodes = node.child_nodes
-            if len(cnodes) > 1:
-                if cnode != None:
-                    cnodes = list(set(cnodes) - set([cnode]))
-                for cn in cnodes:
-                    self._tagNodesDown(start_node, cn, dx=dx)
-            pnode = node.getParentNode()
-            if pnode != None:
-                self._tagNodesUp(start_node, pnode, node, dx=dx)
-
-    def _removeTags(self):
-        for node in self:
-            if 'tag' in node.content:
-                del node.content['tag']
+                raise ValueError('`weights` should be \'length\' or \'area\' ' + \
+                                 'if given as a string')
+        ws = np.asarray(weights, dtype=float)
+        if ws.shape != (len(rows),) or np.any(ws < 0.):
+            raise ValueError('`weights` should contain a non-negative weight ' + \
+                             'for each node')
+        return ws
+
+    def _selectSeparatedRows(self, rows, dx, num):
+        '''
+        Select, in the given order, at most `num` rows of the array tree, so
+        that no selected node is within a distance `dx` of the distal end of a
+        node selected before it. The distance between a point and a node is
+        the distance to the nearest of its two ends.
+
+        Returns
+        -------
+            numpy.array of ints
+                the positions of the selected rows in `rows`
+        '''
+        arr = self.getArrayTree()
+        cum_l, _ = self._getCumulativeArrays()
+        tagged = np.zeros(len(arr), dtype=bool)
+        selected = []
+        for ii, row in enumerate(rows):
+            if len(selected) >= num:
+                break
+            if not tagged[row]:
+                selected.append(ii)
+                tagged[_getRowsNearDistalEnd(arr, cum_l, row, dx)] = True
+        return np.array(selected, dtype=int)
 
     def _parseLocArg(self, loc_arg):
-        if isinstance(loc_arg, list):
+        if isinstance(loc_arg, (list, LocArray)):
             locs = loc_arg
         elif isinstance(loc_arg, str):
             self._tryName(loc_arg)
@@ -1737,7 +2902,7 @@ class MorphTree(STree):
 
         Parameters
         ----------
-        loc_arg: list of :class:`MorphLoc` or string
+        loc_arg: list of :class:`MorphLoc`, :class:`LocArray` or string
             the locations
         name: string (optional)
             The name under which the list of bifurcation locs will be stored.
@@ -1745,23 +2910,30 @@ class MorphTree(STree):
 
         Returns
         -------
-        list of :class:`MorphLoc`
-            the bifurcation locs
+        :class:`LocArray`
+            the input locs, followed by the bifurcation locs that do not
+            coincide with an input loc
         '''
-        locs = self._parseLocArg(loc_arg)
+        locs = LocArray(self._parseLocArg(loc_arg), self)
         # get the bifurcation locs
-        nodes = [self[loc['node']] for loc in locs]
+        nodes = [self[index] for index in np.unique(locs['node'])]
         bnodes = self.getBifurcationNodes(nodes)
-        blocs = [MorphLoc((bnode.index, 1.), self) for bnode in bnodes]
-        # retain unique locs
+        blocs = LocArray({'node': [bnode.index for bnode in bnodes],
+                          'x': np.ones(len(bnodes))}, self)
         all_locs = locs + blocs
-        ii = 0
-        while ii < len(all_locs):
-            all_locs_aux = all_locs[ii+1:]
-            while all_locs[ii] in all_locs_aux:
-                all_locs_aux.remove(all_locs[ii])
-            all_locs = all_locs[:ii+1] + all_locs_aux
-            ii += 1
+        # retain unique locs, as compared on the original tree
+        with self.treetypeContext('original'):
+            nids = all_locs['node']
+            xs = np.where(nids == 1, 0., all_locs['x'])
+        order = np.lexsort((np.arange(len(nids)), xs, nids))
+        is_new = np.ones(len(order), dtype=bool)
+        is_new[1:] = (nids[order][1:] != nids[order][:-1]) | \
+                     ~np.isclose(xs[order][1:], xs[order][:-1])
+        # each group of equal locs is represented by its first occurence
+        group_start = np.maximum.accumulate(np.where(is_new,
+                                                     np.arange(len(order)), 0))
+        keep = np.unique(order[group_start])
+        all_locs = all_locs[keep]
         # store the locations
         if name != 'No': self.storeLocs(all_locs, name=name)
         return all_locs
@@ -1803,20 +2975,18 @@ class MorphTree(STree):
                 rootnode_orig = nodes[0]
                 tempnode = self._findCompnodeDown(nodes[0])
                 self.setNodeColors(rootnode_orig)
-                self.treetype = 'computational'
-                rootnode_comp = self[tempnode.index]
-                self.setNodeColors(rootnode_comp)
-                self.treetype = 'original'
+                with self.treetypeContext('computational'):
+                    rootnode_comp = self[tempnode.index]
+                    self.setNodeColors(rootnode_comp)
             else:
                 rootnode_comp = nodes[0]
                 self.setNodeColors(rootnode_comp)
-                self.treetype = 'original'
-                rootnode_orig = self[rootnode.comp.index]
-                self.setNodeColors(rootnode_orig)
-                self.treetype = 'computational'
+                with self.treetypeContext('original'):
+                    rootnode_orig = self[rootnode.comp.index]
+                    self.setNodeColors(rootnode_orig)
         else:
-            if isinstance(loc_arg, list):
-                self.storeLocs(locs, name='xaxis')
+            if isinstance(loc_arg, (list, LocArray)):
+                self.storeLocs(loc_arg, name='xaxis')
             elif isinstance(loc_arg, str):
                 self.storeLocs(self.getLocs(loc_arg), name='xaxis')
             else:
@@ -2340,13 +3510,13 @@ class MorphTree(STree):
         self._tryName(name)
         # get the node indices of nodes
         node_inds = self.getNodeIndices(name)
-        # find the paths to the root
-        paths = [set(self.pathToRoot(self[node_ind])) for node_ind in node_inds]
-        # possible roots
-        roots = list(set.intersection(*paths))
-        # return the node of highest order
-        rootind = np.argmax([self.orderOfNode(node) for node in roots])
-        return roots[rootind]
+        # the common root is the lowest common ancestor of all nodes
+        arr = self.getArrayTree()
+        rows = arr.getRows(node_inds)
+        row = rows[0]
+        for row_ in rows[1:]:
+            row = arr.getLCA(row, row_)
+        return arr.nodes[row]
 
     @originalTreetypeDecorator
     def createNewTree(self, name, fake_soma=False):
@@ -2434,6 +3604,165 @@ class MorphTree(STree):
         for cnode in node.child_nodes:
             self._addNodesToTree(cnode, new_pnode, new_tree, new_nodes, name)
 
+    @originalTreetypeDecorator
+    def createResampledTree(self, dx, electrotonic=False):
+        '''
+        Creates a new tree where the unbranched runs of nodes are resampled to
+        nodes of approximately length `dx`. Runs are merged into fewer nodes or
+        split into more nodes, and span the nodes between two nodes that are
+        always retained: the root, bifurcations, leafs and nodes where the
+        properties of the tree change (see
+        :func:`MorphTree._isResamplingBreak`). The retained nodes keep their
+        index, new nodes get indices larger than those of the original tree.
+
+        Each new node is a cylinder with the same surface and the same axial
+        resistance as the piece of the run it replaces. Because a single
+        cylinder can not preserve the electrotonic length of a piece with
+        varying radius as well, the relative error on the electrotonic length
+        of each new node is returned. Splitting nodes introduces no error.
+
+        The other attributes of a new node are copied from the original node
+        at its distal end. Stored locations are not transferred to the new
+        tree, and derived quantities (e.g. impedances) have to be recomputed.
+
+        Parameters
+        ----------
+            dx: float
+                The target length of the nodes, in micron or, if
+                `electrotonic` is ``True``, in units of the length constant
+            electrotonic: bool
+                If ``True``, the runs are resampled to a target electrotonic
+                length, which requires physiological parameters (see
+                :class:`PhysTree`)
+
+        Returns
+        -------
+            new_tree: instance of the class of this tree
+                The resampled tree
+            errors: numpy.array of floats
+                The relative error on the electrotonic length of each node of
+                the new tree, in the depth-first order of its nodes
+
+        Raises
+        ------
+            ValueError
+                If `dx` is not positive, or if `electrotonic` is ``True`` and
+                the tree has no physiological parameters
+        '''
+        if dx <= 0.:
+            raise ValueError('`dx` should be positive')
+        # the length constants are provided by trees with physiological
+        # parameters, see :func:`PhysTree._getLengthConstants`
+        if electrotonic and not hasattr(self, '_getLengthConstants'):
+            raise ValueError('Resampling to an electrotonic length requires ' + \
+                             'physiological parameters, use a :class:`PhysTree`')
+        arr = self.getArrayTree()
+        n_node = len(arr)
+        nodes = arr.nodes
+        lengths = arr['L']; radii = arr['R']; xyz = arr['xyz']
+        measure = lengths / self._getLengthConstants(nodes) if electrotonic \
+                  else lengths
+        # nodes that are always retained, the other nodes have a single child
+        n_child = arr.getNChildren()
+        retained = n_child != 1
+        retained[0] = True
+        for row in np.where(~retained)[0]:
+            retained[row] = self._isResamplingBreak(nodes[row],
+                                    nodes[arr.child_ind[arr.child_ptr[row]]])
+        # create the new tree, with the soma nodes copied from the original tree
+        new_tree = self.__class__()
+        for key, val in self.__dict__.iteritems():
+            if not key.startswith('_') and key != 'locs' and \
+               key in new_tree.__dict__:
+                new_tree.__dict__[key] = copy.deepcopy(val)
+        memo = {}
+        def createNode(index, orig_node, pnode):
+            new_node = new_tree.createCorrespondingNode(index)
+            orig_node.__copy__(new_node=new_node, memo=memo)
+            new_node.index = index
+            new_node.used_in_comptree = False
+            if pnode is not None:
+                new_node.setParentNode(pnode)
+                pnode.addChild(new_node)
+            return new_node
+        new_root = createNode(nodes[0].index, nodes[0], None)
+        for cnode in nodes[0].getChildNodes(skip_inds=[]):
+            if cnode.index in (2,3):
+                createNode(cnode.index, cnode, new_root)
+        new_nodes = {0: new_root}
+        errors = {new_root.index: 0.}
+        next_index = max(np.max(arr.index), 3) + 1
+        # the runs are contiguous in the depth-first order, and end at a
+        # retained node
+        run_ends = np.where(retained[1:])[0] + 1
+        run_starts = np.concatenate(([1], run_ends[:-1] + 1))
+        for r0, r1 in zip(run_starts.tolist(), run_ends.tolist()):
+            rows = np.arange(r0, r1+1)
+            L = lengths[rows]; R = radii[rows]
+            cum_m = np.concatenate(([0.], np.cumsum(measure[rows])))
+            n_new = max(1, int(round(cum_m[-1] / dx)))
+            ts = cum_m[-1] * np.arange(1, n_new+1) / float(n_new)
+            # surface, axial resistance, physical length and electrotonic
+            # length (up to the membrane parameters, which are constant on the
+            # run) of the pieces
+            def integrate(vals):
+                cum_v = np.concatenate(([0.], np.cumsum(vals)))
+                cum_t = np.interp(ts, cum_m, cum_v)
+                cum_t[-1] = cum_v[-1]
+                return np.diff(np.concatenate(([0.], cum_t)))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                S = integrate(2. * np.pi * R * L)
+                A = integrate(L / (np.pi * R**2))
+                E = integrate(L / np.sqrt(R))
+                # the cylinder with the same surface and axial resistance
+                R_eq = (S / (2. * np.pi**2 * A))**(1./3.)
+                L_eq = S / (2. * np.pi * R_eq)
+            # the original nodes at the distal ends of the pieces
+            ends = np.minimum(np.searchsorted(cum_m[1:], ts), len(rows) - 1)
+            ends[-1] = len(rows) - 1
+            R_eq = np.where(A > 0., R_eq, R[ends])
+            L_eq = np.where(A > 0., L_eq, 0.)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                err = np.where(E > 0., np.abs(L_eq / np.sqrt(R_eq) - E) / E, 0.)
+            p_xyz = np.concatenate((xyz[arr.parent[r0]][None,:], xyz[rows]))
+            new_xyz = np.array([np.interp(ts, cum_m, p_xyz[:,kk]) \
+                                for kk in range(3)]).T
+            new_xyz[-1] = xyz[r1]
+            pnode = new_nodes[arr.parent[r0]]
+            for jj in xrange(n_new):
+                orig_node = nodes[rows[ends[jj]]]
+                if jj == n_new - 1:
+                    new_index = orig_node.index
+                else:
+                    new_index = next_index; next_index += 1
+                new_node = createNode(new_index, orig_node, pnode)
+                new_node.setP3D(new_xyz[jj], float(R_eq[jj]), orig_node.swc_type)
+                new_node.setLength(float(L_eq[jj]))
+                errors[new_index] = float(err[jj])
+                pnode = new_node
+            new_nodes[r1] = pnode
+        new_tree.setRoot(new_root)
+        new_arr = new_tree.getArrayTree()
+        return new_tree, np.array([errors[index] for index in new_arr.index])
+
+    def _isResamplingBreak(self, node, cnode):
+        '''
+        Whether `node` has to be retained when resampling the run of nodes it
+        belongs to, given its single child `cnode`. Here, this is the case if
+        the nodes have a different `swc_type`.
+
+        Parameters
+        ----------
+            node: :class:`MorphNode`
+            cnode: :class:`MorphNode`
+                the child node of `node`
+
+        Returns
+        -------
+            bool
+        '''
+        return node.swc_type != cnode.swc_type
+
     @originalTreetypeDecorator
     def createCompartmentTree(self, locarg):
         '''
@@ -2442,10 +3771,10 @@ class MorphTree(STree):
 
         Parameters
         ----------
-        locarg: list` of locations or string
-            if `list` of locations, specifies the locations, if ``string``,
-            specifies the name under which the set of location is stored
-            that should be used to create the new tree
+        locarg: `list` of locations, :class:`LocArray` or string
+            if `list` of locations or :class:`LocArray`, specifies the
+            locations, if ``string``, specifies the name under which the set of
+            location is stored that should be used to create the new tree
 
         Returns
         -------
@@ -2453,10 +3782,9 @@ class MorphTree(STree):
                 The new tree.
         '''
         # process input argument
-        if isinstance(locarg, list):
-            locs = [MorphLoc(loc, self) for loc in locarg]
+        if isinstance(locarg, (list, LocArray)):
             name = 'comp_locs'
-            self.storeLocs(locs, name=name)
+            self.storeLocs(locarg, name=name)
         elif isinstance(locarg, str):
             name = locarg
             self._tryName(name)
@@ -2518,19 +3846,20 @@ class MorphTree(STree):
         for cnode in node.child_nodes:
             self._addCompNodesToTree(cnode, new_pnode, new_tree, new_nodes, name)
 
-    def __copy__(self, new_tree=None):
+    def __copy__(self, new_tree=None, deep=True):
         '''
-        experimental, untested
-
         Fill the ``new_tree`` with it's corresponding nodes in the same
         structure as ``self``, and copies all node variables that both tree
-        classes have in common
+        classes have in common. Both the original and the computational tree
+        are copied.
 
         Parameters
         ----------
         new_tree: :class:`STree` or derived class (default is ``None``)
             the tree class in which the ``self`` is copied. If ``None``,
             returns a copy of ``self``.
+        deep: bool (default is ``True``)
+            whether to deep copy the node and tree attributes
 
         Returns
         -------
@@ -2539,20 +3868,101 @@ class MorphTree(STree):
         if new_tree is None:
             new_tree = self.__class__()
 
-        current_treetype = self.treetype
-        self.treetype = 'original'
-        super(MorphTree, self).__copy__(new_tree=new_tree)
-        try:
+        with self.treetypeContext('original'):
+            super(MorphTree, self).__copy__(new_tree=new_tree, deep=deep)
+        if self._computational_root is not None:
             # set the computational tree
-            self.treetype = 'computational'
-            new_node = new_tree.createCorrespondingNode(self.root.index)
-            self.root.__copy__(new_node=new_node)
-            new_tree._computational_root = new_node
-            new_tree.treetype = 'computational'
-            self._recurseCopy(self.root, new_tree)
-        except ValueError:
-            pass
-        self.treetype = current_treetype
-        new_tree.treetype = current_treetype
+            new_tree._computational_root = self._copyNodes(
+                            self._computational_root,
+                            create_node=new_tree.createCorrespondingNode,
+                            deep=deep)
+            new_tree._resetComputationalCaches()
+        new_tree.treetype = self.treetype
 
         return new_tree
+
+
+class MorphTreeView(object):
+    '''
+    Immutable view on a :class:`MorphTree` (or on an instance of a derived
+    class) with a fixed `treetype`. The view shares all nodes and data with the
+    underlying tree. Attribute lookups and method calls on the view are
+    evaluated with the treetype of the view, which is set for the calling
+    thread only, so that different threads can query the original and the
+    computational tree concurrently. Functions that modify the tree remain
+    available, but should not be called concurrently with other queries.
+
+    Views are obtained with :func:`MorphTree.getView`.
+
+    Attributes
+    ----------
+        treetype: 'original' or 'computational'
+            The treetype of the view
+    '''
+    __slots__ = ('_tree', '_view_treetype')
+
+    def __init__(self, tree, treetype):
+        if isinstance(tree, MorphTreeView):
+            tree = tree.getTree()
+        tree._checkTreetype(treetype)
+        object.__setattr__(self, '_tree', tree)
+        object.__setattr__(self, '_view_treetype', treetype)
+
+    def getTree(self):
+        '''
+        Returns the underlying tree
+
+        Returns
+        -------
+            :class:`MorphTree`
+        '''
+        return self._tree
+
+    def getTreetype(self):
+        return self._view_treetype
+
+    treetype = property(getTreetype)
+
+    def _context(self):
+        return self._tree.treetypeContext(self._view_treetype)
+
+    def __getattr__(self, name):
+        tree = self._tree
+        with self._context():
+            attr = getattr(tree, name)
+        if getattr(attr, '__self__', None) is tree:
+            # bind the method to the treetype of the view
+            context = self._context
+            @functools.wraps(attr)
+            def method(*args, **kwargs):
+                with context():
+                    return attr(*args, **kwargs)
+            return method
+        return attr
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Tree views are immutable, set attributes on ' + \
+                             'the underlying tree')
+
+    def __delattr__(self, name):
+        raise AttributeError('Tree views are immutable, delete attributes ' + \
+                             'on the underlying tree')
+
+    def __getitem__(self, index, **kwargs):
+        with self._context():
+            return self._tree.__getitem__(index, **kwargs)
+
+    def __iter__(self, *args, **kwargs):
+        with self._context():
+            return iter(list(self._tree.__iter__(*args, **kwargs)))
+
+    def __len__(self, *args, **kwargs):
+        with self._context():
+            return self._tree.__len__(*args, **kwargs)
+
+    def __str__(self, *args, **kwargs):
+        with self._context():
+            return self._tree.__str__(*args, **kwargs)
+
+    def __repr__(self):
+        return '<%s view on %r>'%(self._view_treetype, self._tree)
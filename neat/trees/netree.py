@@ -100,6 +100,9 @@ class Kernel(object):
 
 
 class NETNode(SNode):
+    __slots__ = ('loc_inds', 'newloc_inds', '_z_kernel', '_comps', '_node_inds',
+                 '_root_ind', '_z_comp', '_z_root')
+
     def __init__(self, index, loc_inds, newloc_inds=[], z_kernel=None):
         super(NETNode, self).__init__(index)
         # location indices that node integrates
@@ -158,6 +161,25 @@ class NET(STree):
     def __init__(self, root=None):
         super(NET, self).__init__(root)
 
+    def createCorrespondingNode(self, node_index, loc_inds=[], newloc_inds=[],
+                                      z_kernel=0.):
+        '''
+        Creates a node with the given index corresponding to the tree class.
+
+        Parameters
+        ----------
+            node_index: int
+                index of the new node
+            loc_inds: list of ints
+                the location indices that the node integrates
+            newloc_inds: list of ints
+                the location indices that are new for the node
+            z_kernel: see :class:`Kernel`
+                the impedance kernel of the node
+        '''
+        return NETNode(node_index, loc_inds, newloc_inds=newloc_inds,
+                       z_kernel=z_kernel)
+
     def __str__(self):
         string = 'NET\n'
         for node in self:
@@ -398,8 +420,9 @@ class NET(STree):
         '''
         self._computeTentativeCompartments(Iz=Iz)
         # determine the nodes that contain the eventual compartments and
-        # remove the rest
-        net = copy.deepcopy(self)
+        # remove the rest, only the tree structure is modified so the nodes
+        # of the copy can share their attributes with the original nodes
+        net = self.__copy__(deep=False)
         self._removeNonCompartments(net.leafs, net=net)
         # get the compartment nodes
         comp_nodes = self._setCompartmentsLeafbased(net.leafs, net)
@@ -10,13 +10,38 @@ Author: W. Wybo
 import numpy as np
 
 import warnings
+import json
+import importlib
+import weakref
+import contextlib
 
 import morphtree
 from morphtree import MorphNode, MorphTree
 from neat.channels import channelcollection
 
 
+def _importChannelClass(path):
+    '''
+    Import an ion channel class from its path ``'module.ClassName'``
+    '''
+    module_name, _, class_name = path.rpartition('.')
+    try:
+        return getattr(importlib.import_module(module_name), class_name)
+    except (ImportError, AttributeError, ValueError):
+        raise ImportError('Ion channel class \'' + path + \
+                          '\' can not be imported')
+
+
 class PhysNode(MorphNode):
+    '''
+    Node with physiological parameters. When the parameters are modified
+    through the methods of the node, the node notifies the :class:`PhysTree`
+    that has used its parameters, so that the tree increases its parameter
+    revision.
+    '''
+    __slots__ = ('currents', 'concmechs', 'c_m', 'r_a', 'g_shunt', 'e_eq',
+                 '_owner')
+
     def __init__(self, index, p3d=None,
                        c_m=1., r_a=100*1e-6, g_shunt=0., e_eq=-75.):
         super(PhysNode, self).__init__(index, p3d)
@@ -44,6 +69,22 @@ class PhysNode(MorphNode):
         self.c_m = c_m # uF/cm^2
         self.r_a = r_a # MOhm*cm
         self.g_shunt = g_shunt
+        self._setModified()
+
+    def _setModified(self):
+        '''
+        Notify the tree that owns the node of a modification of its parameters
+        '''
+        owner = getattr(self, '_owner', None)
+        tree = None if owner is None else owner()
+        if tree is not None:
+            tree._nodeModified()
+
+    def __getstate__(self):
+        # the reference to the owning tree is not copied
+        state = super(PhysNode, self).__getstate__()
+        state.pop('_owner', None)
+        return state
 
     def addCurrent(self, channel_name, g_max, e_rev=None, channel_storage=None):
         '''
@@ -62,6 +103,7 @@ class PhysNode(MorphNode):
         if e_rev is None:
             e_rev = channelcollection.E_REV_DICT[channel_name]
         self.currents[channel_name] = (g_max, e_rev)
+        self._setModified()
         if channel_name is not 'L' and \
            channel_storage is not None and \
            channel_name not in channel_storage:
@@ -80,6 +122,7 @@ class PhysNode(MorphNode):
             parameters for the concentration mechanism (only used for NEURON model)
         '''
         self.concmechs[ion] = params
+        self._setModified()
 
     def getCurrent(self, channel_name, channel_storage=None):
         '''
@@ -109,6 +152,7 @@ class PhysNode(MorphNode):
             the equilibrium potential (mV)
         '''
         self.e_eq = e_eq
+        self._setModified()
 
     def fitLeakCurrent(self, e_eq_target=-75., tau_m_target=10., channel_storage=None):
         gsum = 0.
@@ -133,6 +177,7 @@ class PhysNode(MorphNode):
         e_l = e_eq_target - i_eq / g_l
         self.currents['L'] = (g_l, e_l)
         self.e_eq = e_eq_target
+        self._setModified()
 
     def getGTot(self, v=None, channel_storage=None):
         '''
@@ -189,6 +234,45 @@ class PhysTree(MorphTree):
             node.setPhysiology(1.0, 100./1e6)
         self.channel_storage = {}
 
+    def _setNodeOwner(self, nodes):
+        '''
+        Register the tree as the owner of the nodes, which is notified when
+        their parameters are modified through their methods. To be called by
+        the functions that derive quantities from the node parameters.
+
+        Parameters
+        ----------
+            nodes: list of :class:`PhysNode`
+        '''
+        owner = weakref.ref(self)
+        for node in nodes:
+            node._owner = owner
+
+    def _nodeModified(self):
+        '''
+        Called by the nodes owned by the tree when their parameters have been
+        modified, increases the parameter revision unless the nodes are
+        modified by a function of the tree (see
+        :func:`PhysTree._modifyingNodes`)
+        '''
+        if not getattr(self, '_n_modifying', 0):
+            self.bumpRevision('parameter')
+
+    @contextlib.contextmanager
+    def _modifyingNodes(self):
+        '''
+        Context in which a function of the tree modifies node parameters. The
+        parameter revision is increased once on exit, instead of for each
+        modified node.
+        '''
+        self._n_modifying = getattr(self, '_n_modifying', 0) + 1
+        try:
+            yield
+        finally:
+            self._n_modifying -= 1
+            if self._n_modifying == 0:
+                self.bumpRevision('parameter')
+
     def createCorrespondingNode(self, node_index, p3d=None,
                                       c_m=1., r_a=100*1e-6, g_shunt=0., e_eq=-75.):
         '''
@@ -201,6 +285,155 @@ class PhysTree(MorphTree):
         '''
         return PhysNode(node_index, p3d=p3d)
 
+    def _getNodeColumns(self, nodes):
+        '''
+        Collects the physiological node attributes as columns for the
+        :class:`ArrayTree`, in addition to the geometrical ones. For each ion
+        channel current, the conductance and reversal are stored as resp.
+        'g_' and 'e_' followed by the channel name, the conductance is zero at
+        nodes where the current is not present.
+
+        Parameters
+        ----------
+            nodes: list of :class:`PhysNode`
+                the nodes of the tree in depth-first order
+
+        Returns
+        -------
+            dict of numpy.array
+        '''
+        columns = super(PhysTree, self)._getNodeColumns(nodes)
+        # the columns are updated when the node parameters are modified
+        self._setNodeOwner(nodes)
+        for key in ['c_m', 'r_a', 'g_shunt', 'e_eq']:
+            columns[key] = np.array([getattr(node, key) for node in nodes],
+                                    dtype=float)
+        channel_names = set()
+        for node in nodes: channel_names.update(node.currents.keys())
+        for channel_name in channel_names:
+            g_e = np.array([node.currents.get(channel_name, (0., 0.)) \
+                            for node in nodes], dtype=float).reshape(len(nodes), 2)
+            columns['g_' + channel_name] = g_e[:,0]
+            columns['e_' + channel_name] = g_e[:,1]
+        return columns
+
+    def _getNodeState(self, nodes):
+        '''
+        Collects the physiological node attributes that are stored in binary
+        files, in addition to the geometrical ones. For each ion channel
+        current, the conductance, the reversal and the nodes where the current
+        is present are stored as resp. 'g_', 'e_' and 'has_' followed by the
+        channel name, and the import path of the ion channel class as 'class_'
+        followed by the channel name.
+
+        Parameters
+        ----------
+            nodes: list of :class:`PhysNode`
+
+        Returns
+        -------
+            dict of numpy.array
+
+        Raises
+        ------
+            ValueError
+                If the class of an ion channel can not be imported by its
+                module and class name, so that it could not be reconstructed
+                when the file is read
+        '''
+        state = super(PhysTree, self)._getNodeState(nodes)
+        for key in ['c_m', 'r_a', 'g_shunt', 'e_eq']:
+            state[key] = np.array([getattr(node, key) for node in nodes],
+                                  dtype=float)
+        channel_names = set()
+        for node in nodes: channel_names.update(node.currents.keys())
+        for channel_name in channel_names:
+            g_e = np.array([node.currents.get(channel_name, (0., 0.)) \
+                            for node in nodes], dtype=float).reshape(len(nodes), 2)
+            state['g_' + channel_name] = g_e[:,0]
+            state['e_' + channel_name] = g_e[:,1]
+            state['has_' + channel_name] = np.array([channel_name in node.currents \
+                                                     for node in nodes], dtype=bool)
+            if channel_name != 'L':
+                state['class_' + channel_name] = \
+                        np.array(self._getChannelClassPath(channel_name), dtype=str)
+        state['concmechs'] = np.array([json.dumps(node.concmechs, default=float) \
+                                       for node in nodes], dtype=str)
+        return state
+
+    def _setNodeState(self, nodes, state):
+        '''
+        Sets the node attributes collected by :func:`PhysTree._getNodeState`
+
+        Parameters
+        ----------
+            nodes: list of :class:`PhysNode`
+            state: dict of numpy.array
+        '''
+        super(PhysTree, self)._setNodeState(nodes, state)
+        phys = [state[key].tolist() for key in ['c_m', 'r_a', 'g_shunt', 'e_eq']]
+        concmechs = state['concmechs'].tolist()
+        for ii, node in enumerate(nodes):
+            node.setPhysiology(phys[0][ii], phys[1][ii], g_shunt=phys[2][ii])
+            node.setEEq(phys[3][ii])
+            node.currents = {}
+            node.concmechs = {str(ion): {str(key): val \
+                                         for key, val in params.iteritems()} \
+                              for ion, params in \
+                              json.loads(concmechs[ii]).iteritems()}
+        for key in state:
+            if key.startswith('class_'):
+                channel_name = key[6:]
+                if channel_name not in self.channel_storage:
+                    self.channel_storage[channel_name] = \
+                            _importChannelClass(str(state[key]))()
+        for key in state:
+            if key.startswith('has_'):
+                channel_name = key[4:]
+                has_channel = state[key]
+                g_max = state['g_' + channel_name]
+                e_rev = state['e_' + channel_name]
+                for ii in np.where(has_channel)[0]:
+                    nodes[ii].addCurrent(channel_name, float(g_max[ii]),
+                                         float(e_rev[ii]),
+                                         channel_storage=self.channel_storage)
+        self.bumpRevision('parameter')
+
+    def _getChannelClassPath(self, channel_name):
+        '''
+        Returns the import path ``'module.ClassName'`` of the class of an ion
+        channel, taken from `self.channel_storage` or else from
+        :mod:`neat.channels.channelcollection`
+
+        Parameters
+        ----------
+            channel_name: string
+                the name of the ion channel
+
+        Returns
+        -------
+            string
+
+        Raises
+        ------
+            ValueError
+                If the ion channel class can not be imported from its module
+        '''
+        if channel_name in self.channel_storage:
+            cls = type(self.channel_storage[channel_name])
+        else:
+            cls = getattr(channelcollection, channel_name, None)
+        path = None if cls is None else cls.__module__ + '.' + cls.__name__
+        try:
+            if path is None or _importChannelClass(path) is not cls:
+                raise ImportError
+        except ImportError:
+            raise ValueError('The class of ion channel \'' + channel_name + \
+                             '\' can not be imported from its module, ' + \
+                             'define it at module level or add it to ' + \
+                             '`channel_storage`')
+        return path
+
     def addCurrent(self, channel_name, g_max_distr, e_rev=None, node_arg=None):
         '''
         Adds a channel to the morphology.
@@ -220,21 +453,85 @@ class PhysTree(MorphTree):
                 see documentation of :func:`MorphTree._convertNodeArgToNodes`.
                 Defaults to None
         '''
+        nodes = self._convertNodeArgToNodes(node_arg)
+        # get the ion channel conductances
+        g_maxs = self._evaluateDistribution(g_max_distr, nodes,
+                                            name='g_max_distr')
         # add the ion channel to the nodes
-        for node in self._convertNodeArgToNodes(node_arg):
-            # get the ion channel conductance
-            if type(g_max_distr) == float:
-                g_max = g_max_distr
-            elif type(g_max_distr) == dict:
-                g_max = g_max_distr[node.index]
-            elif hasattr(g_max_distr, '__call__'):
-                d2s = self.pathLength({'node': node.index, 'x': .5}, (1., 0.5))
-                g_max = g_max_distr(d2s)
-            else:
-                raise TypeError('`g_max_distr` argument should be a float, dict \
-                                or a callable')
-            node.addCurrent(channel_name, g_max, e_rev,
-                            channel_storage=self.channel_storage)
+        with self._modifyingNodes():
+            for node, g_max in zip(nodes, g_maxs):
+                node.addCurrent(channel_name, g_max, e_rev,
+                                channel_storage=self.channel_storage)
+
+    def _evaluateDistribution(self, distr, nodes, name='distr'):
+        '''
+        Evaluate a parameter distribution at a list of nodes
+
+        Parameters
+        ----------
+            distr: float, dict or :func:`float -> float`
+                If float, the value is returned. If it is a function, the input
+                is the distance from the soma (micron) of the node center. The
+                function is called once with the array of distances of all
+                nodes, and for each node separately if this raises a
+                `TypeError` or `ValueError` or does not return an array of the
+                same shape. If it is a dict, keys are the node indices.
+            nodes: list of :class:`PhysNode`
+            name: string
+                name of the distribution argument, for the error message
+
+        Returns
+        -------
+            list of floats
+        '''
+        if type(distr) == float:
+            return [distr for _ in nodes]
+        elif type(distr) == dict:
+            return [distr[node.index] for node in nodes]
+        elif hasattr(distr, '__call__'):
+            d2s = self._distancesFromNodeArrays(
+                                [node.index for node in nodes],
+                                .5 * np.ones(len(nodes)))[0]
+            try:
+                vals = distr(d2s)
+            except (TypeError, ValueError):
+                # raised by functions that only accept scalar distances, e.g.
+                # through `math` functions or comparisons with the distance
+                vals = None
+            if vals is None or np.shape(vals) != d2s.shape:
+                vals = [distr(d2) for d2 in d2s]
+            return np.asarray(vals, dtype=float).tolist()
+        else:
+            raise TypeError('`' + name + '` argument should be a float, dict \
+                            or a callable')
+
+    def setPhysiology(self, c_m_distr, r_a_distr, g_s_distr=None, node_arg=None):
+        '''
+        Set the specific membrane capacitance, the axial resistance and
+        optionally the point-like shunt conductance of the nodes.
+
+        Parameters
+        ----------
+            c_m_distr: float, dict or :func:`float -> float`
+                specific membrane capacitance (uF/cm^2), see `g_max_distr` of
+                :func:`PhysTree.addCurrent` for the types of distribution
+            r_a_distr: float, dict or :func:`float -> float`
+                axial resistance (MOhm*cm)
+            g_s_distr: float, dict, :func:`float -> float` or ``None``
+                point-like shunt conductance (uS). If ``None``, the shunts of
+                the nodes are retained.
+            node_arg:
+                see documentation of :func:`MorphTree._convertNodeArgToNodes`.
+                Defaults to None
+        '''
+        nodes = self._convertNodeArgToNodes(node_arg)
+        c_ms = self._evaluateDistribution(c_m_distr, nodes, name='c_m_distr')
+        r_as = self._evaluateDistribution(r_a_distr, nodes, name='r_a_distr')
+        g_ss = [node.g_shunt for node in nodes] if g_s_distr is None else \
+               self._evaluateDistribution(g_s_distr, nodes, name='g_s_distr')
+        with self._modifyingNodes():
+            for node, c_m, r_a, g_s in zip(nodes, c_ms, r_as, g_ss):
+                node.setPhysiology(c_m, r_a, g_shunt=g_s)
 
     def addConcMech(self, ion, params={}):
         '''
@@ -247,7 +544,8 @@ class PhysTree(MorphTree):
         params: dict
             parameters for the concentration mechanism (only used for NEURON model)
         '''
-        for node in self: node.addConcMech(ion, params=params)
+        with self._modifyingNodes():
+            for node in self: node.addConcMech(ion, params=params)
 
     def fitLeakCurrent(self, e_eq_target=-75., tau_m_target=10.):
         '''
@@ -262,28 +560,86 @@ class PhysTree(MorphTree):
                 The target membrane time-scale (ms). Defaults to 10 ms.
         '''
         assert tau_m_target > 0.
-        for node in self:
-            node.fitLeakCurrent(e_eq_target=e_eq_target,
-                                  tau_m_target=tau_m_target)
+        with self._modifyingNodes():
+            for node in self:
+                node.fitLeakCurrent(e_eq_target=e_eq_target,
+                                    tau_m_target=tau_m_target)
 
     def computeEquilibirumPotential(self):
         pass
 
+    def _hasEqualPhysiology(self, node, pnode, eps=1e-8):
+        '''
+        Whether the physiological parameters (`r_a`, `c_m` and the ion channel
+        currents) of two nodes are the same
+
+        Parameters
+        ----------
+            node, pnode: :class:`PhysNode`
+            eps: float
+                tolerance on the parameter values
+
+        Returns
+        -------
+            bool
+        '''
+        return np.abs(node.r_a - pnode.r_a) < eps and \
+               np.abs(node.c_m - pnode.c_m) < eps and \
+               set(node.currents.keys()) == set(pnode.currents.keys()) and \
+               not sum([sum([np.abs(curr[0] - pnode.currents[key][0]) > eps,
+                             np.abs(curr[1] - pnode.currents[key][1]) > eps])
+                        for key, curr in node.currents.iteritems()])
+
     def setCompTree(self, eps=1e-8):
         comp_nodes = []
         for node in self.nodes[1:]:
             pnode = node.parent_node
             # check if parameters are the same
-            if not( np.abs(node.r_a - pnode.r_a) < eps and \
-                np.abs(node.c_m - pnode.c_m) < eps and \
-                np.abs(node.R - pnode.R) < eps and \
-                set(node.currents.keys()) == set(pnode.currents.keys()) and
-                not sum([sum([np.abs(curr[0] - pnode.currents[key][0]) > eps,
-                              np.abs(curr[1] - pnode.currents[key][1]) > eps])
-                         for key, curr in node.currents.iteritems()])):
+            if not (np.abs(node.R - pnode.R) < eps and \
+                    self._hasEqualPhysiology(node, pnode, eps=eps)):
                 comp_nodes.append(pnode)
         super(PhysTree, self).setCompTree(compnodes=comp_nodes)
 
+    def _isResamplingBreak(self, node, cnode):
+        '''
+        Whether `node` has to be retained when resampling the run of nodes it
+        belongs to, given its single child `cnode`. In addition to the
+        conditions of :func:`MorphTree._isResamplingBreak`, this is the case if
+        the physiological parameters of the nodes differ.
+
+        Parameters
+        ----------
+            node: :class:`PhysNode`
+            cnode: :class:`PhysNode`
+                the child node of `node`
+
+        Returns
+        -------
+            bool
+        '''
+        return super(PhysTree, self)._isResamplingBreak(node, cnode) or \
+               not self._hasEqualPhysiology(cnode, node)
+
+    def _getLengthConstants(self, nodes):
+        '''
+        Returns the length constants of the nodes, computed from their total
+        membrane conductance at the equilibrium potential
+
+        Parameters
+        ----------
+            nodes: list of :class:`PhysNode`
+
+        Returns
+        -------
+            numpy.array of floats
+                the length constants (micron)
+        '''
+        R = np.array([node.R for node in nodes]) * 1e-4 # um to cm
+        r_a = np.array([node.r_a for node in nodes])
+        g_m = np.array([node.getGTot(channel_storage=self.channel_storage) \
+                        for node in nodes])
+        return np.sqrt(R / (2. * g_m * r_a)) * 1e4 # cm to um
+
     # @morphtree.originalTreetypeDecorator
     # def _calcFdMatrix(self, dx=10.):
     #     matdict = {}
@@ -10,11 +10,11 @@ Author: W. Wybo
 
 import numpy as np
 
-import itertools
 import copy
 
 import morphtree
 from morphtree import MorphLoc
+from morphtree import LocArray
 from phystree import PhysNode, PhysTree
 from netree import NETNode, NET, Kernel
 
@@ -27,11 +27,15 @@ def consecutive(data, stepsize=1):
 
 
 class SOVNode(PhysNode):
+    __slots__ = ('g_m', 'R_sov', 'L_sov', 'tau_m', 'eps_m', 'tau_0', 'z_a',
+                 'lambda_m', 'g_inf_m', 'q_m', 'mu_m', 'dq_dp_m', 'dmu_dp_m',
+                 'poles', 'pmultiplicities', 'kappa_m', 'mu_vals_m',
+                 'q_vals_m')
+
     def __init__(self, index, p3d=None):
         super(SOVNode, self).__init__(index, p3d)
 
     def setSOV(self, tau_0=0.02):
-        self.counter = 0
         # segment parameters
         self.g_m        = self.getGTot() # uS/cm^2
         # parameters for SOV approach
@@ -159,11 +163,13 @@ class SomaSOVNode(SOVNode):
         :function:`setQVals`
         :function:`_findLocalPoles`
     '''
+    __slots__ = ('A', 'c_s', 'g_s', 'prefactors', 'f_transc', 'dN_dp', 'zeros',
+                 'zmultiplicities')
+
     def __init__(self, index, p3d=None):
         super(SOVNode, self).__init__(index, p3d)
 
     def setSOV(self, tau_0=0.02):
-        self.counter = 0
         # convert to cm
         self.R_sov      = self.R * 1e-4 # convert um to cm
         self.L_sov      = self.L * 1e-4 # convert um to cm
@@ -278,7 +284,7 @@ class SOVTree(PhysTree):
 
         Parameters
         ----------
-            locs: list of locations
+            locs: list of locations or :class:`LocArray`
             name: None or string
                 One of the keyword arguments ``locs``, ``sov_data`` or ``name``
                 must not be ``None``. If ``locs`` is not ``None``, the importance
@@ -306,26 +312,28 @@ class SOVTree(PhysTree):
         zeros      = self.root.zeros
         prefactors = self.root.prefactors
         alphas     = zeros**2 / (self.tau_0*1e3)
+        locs       = LocArray(locs, self)
+        nids, xs   = locs['node'], locs['x']
         gammas     = np.zeros((len(alphas), len(locs)), dtype=complex)
-        # fill the matrix of prefactors
-        for ii, loc in enumerate(locs):
-            loc_ = MorphLoc(loc, self)
-            if loc_['node'] == 1:
-                x = 0.
+        # fill the matrix of prefactors, with the columns of all locations on
+        # the same node at once
+        for index in np.unique(nids):
+            inds = np.where(nids == index)[0]
+            if index == 1:
+                x = np.zeros(len(inds))
                 node = self.root.child_nodes[0]
             else:
-                x = loc_['x']
-                node = self[loc_['node']]
-            # fill a column of the matrix, corresponding to current loc
-            gammas[:, ii] = node.kappa_m * \
-               (np.cos(node.q_vals_m*(1.-x)*node.L_sov/node.lambda_m) + \
-               node.mu_vals_m * np.sin(node.q_vals_m*(1.-x)*node.L_sov/node.lambda_m)) / \
-               np.sqrt(prefactors*1e3)
+                x = xs[inds]
+                node = self[index]
+            arg = np.outer(node.q_vals_m / node.lambda_m, (1.-x)*node.L_sov)
+            gammas[:, inds] = (node.kappa_m / np.sqrt(prefactors*1e3))[:,None] * \
+               (np.cos(arg) + node.mu_vals_m[:,None] * np.sin(arg))
         # return the matrices
         return alphas, gammas
 
     @morphtree.computationalTreetypeDecorator
-    def calcSOVEquations(self, maxspace_freq=500., pprint=False):
+    def calcSOVEquations(self, maxspace_freq=500., pprint=False,
+                               recompute_flag=False):
         '''
         Calculate the timescales and spatial functions of the separation of
         variables approach, using the algorithm by (Major, 1994).
@@ -334,50 +342,48 @@ class SOVTree(PhysTree):
         equation) are stored in the somanode.
         The spatial factors are stored in each (computational) node.
 
+        The equations are only recomputed if `maxspace_freq` or the revision of
+        the tree have changed since the last call (see
+        :func:`STree.getRevision`).
+
         Parameters
         ----------
             maxspace_freq: float (default is 500)
                 roughly corresponds to the maximal spatial frequency of the
                 smallest time-scale mode
+            recompute_flag: bool (default is ``False``)
+                force recomputing the equations. Parameters modified through
+                the methods of the tree or the nodes are detected, node
+                attributes that are assigned directly require a call to
+                :func:`STree.bumpRevision`.
         '''
+        cache = self.getRevisionCache('sov_equations')
+        if not recompute_flag and cache.get('maxspace_freq') == maxspace_freq:
+            return
         self.tau_0 = np.pi#1.
+        # the equations are recomputed when the node parameters are modified
+        self._setNodeOwner(self)
         for node in self: node.setSOV(tau_0=self.tau_0)
-        # start the recursion through the tree
-        self._SOVFromLeaf(self.leafs[0], self.leafs[1:],
-                            maxspace_freq=maxspace_freq, pprint=pprint)
+        # sweep through the tree
+        self.sweep(self._SOVFromLeaf, order='postorder',
+                   maxspace_freq=maxspace_freq, pprint=pprint)
         # zeros are now found, set the kappa factors
         zeros = self.root.zeros
-        self._SOVFromRoot(self.root, zeros)
-        # clean
-        for node in self: node.counter = 0
+        self.sweep(self._SOVFromRoot, order='preorder', zeros=zeros)
+        cache['maxspace_freq'] = maxspace_freq
 
-    def _SOVFromLeaf(self, node, leafs, count=0,
-                        maxspace_freq=500., pprint=False):
+    def _SOVFromLeaf(self, node, maxspace_freq=500., pprint=False):
         if pprint:
             print 'Forward sweep: ' + str(node)
-        pnode = node.parent_node
-        # log how many times recursion has passed at node
-        if not self.isLeaf(node):
-            node.counter += 1
-        # if the number of childnodes of node is equal to the amount of times
-        # the recursion has passed node, the mu functions can be set. Otherwise
-        # we start a new recursion at another leaf.
-        if node.counter == len(node.child_nodes):
-            node.setMuFunctions()
-            node.setZerosPoles(maxspace_freq=maxspace_freq)
-            if not self.isRoot(node):
-                self._SOVFromLeaf(pnode, leafs, count=count+1,
-                                maxspace_freq=maxspace_freq, pprint=pprint)
-        elif len(leafs) > 0:
-                self._SOVFromLeaf(leafs[0], leafs[1:], count=count+1,
-                                maxspace_freq=maxspace_freq, pprint=pprint)
+        # all child nodes have been passed, so the mu functions can be set
+        node.setMuFunctions()
+        node.setZerosPoles(maxspace_freq=maxspace_freq)
 
     def _SOVFromRoot(self, node, zeros):
-        for cnode in node.child_nodes:
-            cnode.setKappaFactors(zeros)
-            cnode.setMuVals(zeros)
-            cnode.setQVals(zeros)
-            self._SOVFromRoot(cnode, zeros)
+        if node != self.root:
+            node.setKappaFactors(zeros)
+            node.setMuVals(zeros)
+            node.setQVals(zeros)
 
     def getModeImportance(self, locs=None, sov_data=None, name=None,
                                 importance_type='relative'):
@@ -485,7 +491,8 @@ class SOVTree(PhysTree):
         return alphas[inds_sort], gammas[inds_sort,:]
 
     def calcImpedanceMatrix(self, locs=None, sov_data=None, name=None,
-                                  eps=1e-4, mem_limit=500, freqs=None):
+                                  eps=1e-4, mem_limit=500, freqs=None,
+                                  block_size=None, out=None, filename=None):
         '''
         Compute the impedance matrix for a set of locations
 
@@ -505,12 +512,21 @@ class SOVTree(PhysTree):
                 the cutoff threshold in relative importance below which modes
                 are truncated
             mem_limit: int
-                parameter governs whether the fast (but memory intense) method
-                or the slow method is used
+                default number of rows of the impedance matrix that are
+                computed at once
             freqs: np.ndarray of complex or None (default)
                 if ``None``, returns the steady state impedance matrix, if
                 a array of complex numbers, returns the impedance matrix for
                 each Fourrier frequency in the array
+            block_size: int or None
+                number of rows of the impedance matrix that are computed at
+                once, defaults to `mem_limit`
+            out: np.ndarray or None
+                array in which the impedance matrix is written, e.g. a
+                `numpy.memmap`
+            filename: string or None
+                if given and `out` is ``None``, the impedance matrix is
+                written to a memory-mapped ``.npy`` file with this name
 
         Returns
         -------
@@ -530,34 +546,39 @@ class SOVTree(PhysTree):
             raise IOError('At least one of the kwargs `locs`, `sov_data` or \
                             `name` must not be ``None``')
         n_loc = gammas.shape[1]
+        if block_size is None:
+            block_size = mem_limit
+        block_size = max(block_size, 1)
+        # the impedance matrix is computed as products of the matrix of mode
+        # functions in blocks of rows
         if freqs is None:
             # construct the 2d steady state matrix
             y_activation = 1. / alphas
-            # compute the matrix, methods depends on memory limit
-            if gammas.shape[1] < mem_limit and gammas.shape[0] < int(mem_limit/2.):
-                z_mat = np.sum(gammas[:,:,np.newaxis] * \
-                               gammas[:,np.newaxis,:] * \
-                               y_activation[:,np.newaxis,np.newaxis], 0).real
-            else:
-                z_mat = np.zeros((n_loc, n_loc))
-                for ii, jj in itertools.product(xrange(n_loc), xrange(n_loc)):
-                    z_mat[ii,jj] = np.sum(gammas[:,ii] * \
-                                          gammas[:,jj] * \
-                                          y_activation).real
+            if out is None:
+                out = self._createOutputArray((n_loc, n_loc), filename)
+            for i0 in xrange(0, n_loc, block_size):
+                i1 = min(i0 + block_size, n_loc)
+                out[i0:i1] = np.dot(gammas[:,i0:i1].T * y_activation[None,:],
+                                    gammas).real
         else:
             # construct the 3d fourrier matrix
             y_activation = 1e3 / (alphas[np.newaxis,:]*1e3 + freqs[:,np.newaxis])
-            z_mat = np.zeros((len(freqs), n_loc, n_loc), dtype=complex)
-            for ii, jj in itertools.product(xrange(n_loc), xrange(n_loc)):
-                z_mat[:,ii,jj] = np.sum(gammas[np.newaxis,:,ii] * \
-                                        gammas[np.newaxis,:,jj] * \
-                                        y_activation, 1)
-        return z_mat
+            if out is None:
+                out = self._createOutputArray((len(freqs), n_loc, n_loc),
+                                              filename, dtype=complex)
+            for i0 in xrange(0, n_loc, block_size):
+                i1 = min(i0 + block_size, n_loc)
+                out[:,i0:i1] = np.matmul(
+                    gammas[:,i0:i1].T[None,:,:] * y_activation[:,None,:],
+                    gammas[None,:,:])
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out
 
     def constructNET(self, dz=50., dx=10., eps=1e-4,
                         use_hist=False, add_lin_terms=True,
                         improve_input_impedance=False,
-                        pprint=False):
+                        pprint=False, filename=None):
         '''
         Construct a Neural Evaluation Tree (NET) for this cell
 
@@ -576,6 +597,10 @@ class SOVTree(PhysTree):
             add_lin_terms:
                 take into account that the optained NET will be used in conjunction
                 with linear terms
+            filename: string or None
+                if given, the impedance matrix from which the NET is derived is
+                stored in a memory-mapped ``.npy`` file with this name, for
+                sets of locations whose impedance matrix does not fit in memory
 
         Returns
             :class:`NETree`
@@ -584,7 +609,8 @@ class SOVTree(PhysTree):
         self.distributeLocsUniform(dx=dx, name='NET_eval')
         # compute the z_mat matrix
         alphas, gammas = self.getImportantModes(name='NET_eval', eps=eps)
-        z_mat = self.calcImpedanceMatrix(sov_data=(alphas, gammas))
+        z_mat = self.calcImpedanceMatrix(sov_data=(alphas, gammas),
+                                         filename=filename)
         # derive the NET
         net = NET()
         self._addLayerA(net, None,
@@ -0,0 +1,170 @@
+"""
+File contains:
+
+    - :class:`SegmentIndex`
+
+Author: W. Wybo
+"""
+
+import numpy as np
+import scipy.spatial as ss
+
+
+class SegmentIndex(object):
+    '''
+    Spatial index over the straight segments of a morphology, to find the
+    nearest point on the morphology for large numbers of points in 3D space.
+
+    Segments are cut in pieces of at most `max_piece_length`, and the centers
+    of the pieces are stored in a KD-tree. For each query point, the pieces
+    with the nearest centers are projected on, and the number of pieces is
+    increased until no other piece can be closer, so that the result is exact.
+
+    Not intended to be constructed directly, use
+    :func:`MorphTree.getSegmentIndex`.
+
+    Attributes
+    ----------
+        p0, p1: numpy.array of floats (``shape=(n_seg, 3)``)
+            The start (``x=0``) and end (``x=1``) points of the segments
+        radius: numpy.array of floats
+            The radius of each segment
+        piece_seg: numpy.array of ints
+            The segment of each piece
+        kdtree: :class:`scipy.spatial.cKDTree`
+            The KD-tree of the centers of the pieces
+    '''
+
+    def __init__(self, p0, p1, radius, max_piece_length=None):
+        '''
+        Parameters
+        ----------
+            p0, p1: numpy.array of floats (``shape=(n_seg, 3)``)
+                The start and end points of the segments. Segments where both
+                points coincide, e.g. the soma, are treated as points.
+            radius: numpy.array of floats
+                The radius of each segment
+            max_piece_length: float or None
+                Maximal length of the pieces (micron). Defaults to the median
+                length of the segments.
+        '''
+        self.p0 = np.asarray(p0, dtype=float).reshape(-1, 3)
+        self.p1 = np.asarray(p1, dtype=float).reshape(-1, 3)
+        self.radius = np.asarray(radius, dtype=float)
+        dp = self.p1 - self.p0
+        lengths = np.sqrt(np.sum(dp**2, axis=1))
+        if max_piece_length is None:
+            max_piece_length = np.median(lengths[lengths > 0.]) \
+                               if np.any(lengths > 0.) else 1.
+        # cut the segments in pieces
+        n_piece = np.maximum(np.ceil(lengths / max_piece_length), 1).astype(int)
+        self.piece_seg = np.repeat(np.arange(len(lengths)), n_piece)
+        offsets = np.cumsum(n_piece) - n_piece
+        kk = np.arange(len(self.piece_seg)) - np.repeat(offsets, n_piece)
+        t_mid = (kk + .5) / np.repeat(n_piece, n_piece)
+        centers = self.p0[self.piece_seg] + t_mid[:,None] * dp[self.piece_seg]
+        self.kdtree = ss.cKDTree(centers)
+        # maximal distance between a point on a piece and its center
+        self.max_half_length = np.max(.5 * lengths / n_piece) \
+                               if len(lengths) > 0 else 0.
+        self.max_radius = np.max(self.radius) if len(lengths) > 0 else 0.
+
+    def __len__(self):
+        return len(self.p0)
+
+    def project(self, points, segs):
+        '''
+        Project points on segments
+
+        Parameters
+        ----------
+            points: numpy.array of floats (``shape=(..., 3)``)
+            segs: numpy.array of ints (``shape=(...)``)
+                The segments on which to project, broadcasted against `points`
+
+        Returns
+        -------
+            ts: numpy.array of floats
+                The coordinates of the projections along the segments, between
+                0 and 1, ``.5`` for segments that are points
+            ds: numpy.array of floats
+                The distances between the points and their projections
+        '''
+        p0 = self.p0[segs]; dp = self.p1[segs] - p0
+        dp2 = np.sum(dp**2, axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ts = np.clip(np.sum((points - p0) * dp, axis=-1) / dp2, 0., 1.)
+        ts = np.where(dp2 > 0., ts, .5)
+        ds = np.sqrt(np.sum((points - p0 - ts[...,None] * dp)**2, axis=-1))
+        return ts, ds
+
+    def query(self, points, surface=False, k=8, block_size=100000):
+        '''
+        Find the nearest segment for each point
+
+        Parameters
+        ----------
+            points: numpy.array of floats (``shape=(n_point, 3)``)
+                The query points
+            surface: bool
+                If False, distances are measured to the segment axes. If True,
+                distances are measured to the surfaces of the segments, i.e.
+                the radius of a segment is subtracted from the distance to its
+                axis, and points inside segments have distance zero.
+            k: int
+                The initial number of pieces projected on for each point
+            block_size: int
+                The number of points processed at once
+
+        Returns
+        -------
+            segs: numpy.array of ints
+                The index of the nearest segment
+            ts: numpy.array of floats
+                The coordinate of the nearest point on the segment, between 0
+                and 1
+            ds: numpy.array of floats
+                The distance to the nearest segment
+        '''
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        n_point = len(points)
+        segs = -np.ones(n_point, dtype=int)
+        ts = np.zeros(n_point); ds = np.inf * np.ones(n_point)
+        if len(self) == 0:
+            return segs, ts, ds
+        for i0 in xrange(0, n_point, block_size):
+            i1 = min(i0 + block_size, n_point)
+            segs[i0:i1], ts[i0:i1], ds[i0:i1] = \
+                            self._queryBlock(points[i0:i1], surface, k)
+        if surface:
+            ds = np.maximum(ds, 0.)
+        return segs, ts, ds
+
+    def _queryBlock(self, points, surface, k):
+        n_piece = self.kdtree.n
+        n_point = len(points)
+        segs = -np.ones(n_point, dtype=int)
+        ts = np.zeros(n_point); ds = np.inf * np.ones(n_point)
+        todo = np.arange(n_point)
+        k = min(max(k, 1), n_piece)
+        while len(todo) > 0:
+            d_c, i_c = self.kdtree.query(points[todo], k=k)
+            d_c = d_c.reshape(len(todo), k); i_c = i_c.reshape(len(todo), k)
+            # project on the segments of the nearest pieces
+            seg_c = self.piece_seg[i_c]
+            t_c, dist_c = self.project(points[todo,None,:], seg_c)
+            if surface:
+                dist_c = dist_c - self.radius[seg_c]
+            jj = np.argmin(dist_c, axis=1)
+            rr = np.arange(len(todo))
+            segs[todo] = seg_c[rr,jj]; ts[todo] = t_c[rr,jj]
+            ds[todo] = dist_c[rr,jj]
+            # the pieces that were not projected on are at least this far
+            bound = d_c[:,-1] - self.max_half_length
+            if surface:
+                bound -= self.max_radius
+            if k == n_piece:
+                break
+            todo = todo[ds[todo] > bound]
+            k = min(2 * k, n_piece)
+        return segs, ts, ds
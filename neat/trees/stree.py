@@ -3,6 +3,7 @@ File contains:
 
     - :class:`SNode`
     - :class:`STree`
+    - :class:`SubTreeView`
 
 Authors: B. Torben-Nielsen (legacy code), W. Wybo
 """
@@ -11,13 +12,22 @@ import numpy as np
 
 import warnings
 import copy
-from collections import Counter
+from collections import Counter, deque
+
+from arraytree import ArrayTree
 
 class SNode(object):
     '''
     Simple Node for use with a simple Tree (STree)
     By design, the ``content`` attribute should be a dictionary.
+
+    Nodes store their attributes in ``__slots__`` and have no per-instance
+    ``__dict__``, derived node classes declare their additional attributes in
+    their own ``__slots__``. Arbitrary data can be stored in the ``content``
+    dictionary. A derived class that needs dynamic attributes can opt in by
+    adding ``'__dict__'`` to its ``__slots__``.
     '''
+    __slots__ = ('index', '_parent_node', '_child_nodes', 'pval', '_content')
 
     def __init__(self, index):
         self.index = index
@@ -79,39 +89,68 @@ class SNode(object):
                             str([str(cnode) for cnode in self.child_nodes])
         return node_string
 
-    # def __copy__(self) : # customization of copy.copy
-    #     ret = SNode(self.index)
-    #     for child in self._child_nodes :
-    #         ret.addChild(child)
-    #     try:
-    #         ret.content = self.content
-    #     except AttributeError:
-    #         # no content variable set
-    #         pass
-    #     ret.setParentNode(self._parent_node)
-    #     return ret
-
-    def __copy__(self, new_node=None):
+    def __copy__(self, new_node=None, memo=None, deep=True):
         '''
-        experimental, untested
+        Without `new_node`, returns a shallow copy of the node that has the same
+        parent and children as the original node.
+
+        With `new_node`, copies all attributes that both node classes have in
+        common, except for the parent and the children, to `new_node`
+
+        Parameters
+        ----------
+            new_node: :class:`SNode` or derived class (optional)
+                the node to which the attributes are copied
+            memo: dict (optional)
+                memo dictionary passed to `copy.deepcopy`, sharing it between
+                nodes preserves objects that are shared between nodes
+            deep: bool
+                if ``True``, the attributes are deep copied, otherwise the new
+                node refers to the same attribute values
+
+        Returns
+        -------
+            :class:`SNode`
         '''
         if new_node is None:
-            # new_node = self.__class__(self.index)
-            for child in self._child_nodes :
-                ret.addChild(child)
-            try:
-                ret.content = self.content
-            except AttributeError:
-                # no content variable set
-                pass
-            ret.setParentNode(self._parent_node)
+            new_node = self.__class__.__new__(self.__class__)
+            new_node.__setstate__(self.__getstate__())
+            new_node._child_nodes = list(self._child_nodes)
+            return new_node
         else:
-            orig_keys = set(self.__dict__.keys()) - {'_parent_node', '_child_nodes'}
-            copy_keys = orig_keys.intersection(set(new_node.__dict__.keys()))
+            orig_keys = set(self._getAttributeNames()) - {'_parent_node', '_child_nodes'}
+            # attributes set on the new node and slots of its class
+            new_keys = set(new_node._getAttributeNames())
+            copy_keys = [key for key in orig_keys \
+                         if key in new_keys or hasattr(type(new_node), key)]
             for key in copy_keys:
-                new_node.__dict__[key] = copy.deepcopy(self.__dict__[key])
+                val = getattr(self, key)
+                setattr(new_node, key,
+                        copy.deepcopy(val, memo) if deep else val)
             return new_node
 
+    def _getAttributeNames(self):
+        '''
+        Returns the names of the attributes that are set on the node, i.e. the
+        slots of its class hierarchy and the keys of its ``__dict__`` if the
+        node has one
+        '''
+        names = []
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if name not in ('__dict__', '__weakref__') and \
+                   hasattr(self, name):
+                    names.append(name)
+        names.extend(getattr(self, '__dict__', {}).keys())
+        return names
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self._getAttributeNames()}
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
 
 class STree(object):
     '''
@@ -133,7 +172,8 @@ class STree(object):
     def __getitem__(self, index, **kwargs):
         '''
         Returns the node with given index, if no such node is in the tree, None
-        is returned.
+        is returned. The lookup uses the index map of the tree, and thus takes
+        constant time.
 
         Parameters
         ----------
@@ -143,7 +183,193 @@ class STree(object):
         Returns:
             :class:`SNode` or None
         '''
-        return self._findNode(self.root, index)
+        return self._getIndexMap().get(index, None)
+
+    def _getIndexMap(self):
+        '''
+        Returns the map from node index to node. The map is constructed when it
+        does not exist yet, and is kept up to date by the functions that
+        modify the tree structure.
+
+        Returns
+        -------
+            dict {int: :class:`SNode`}
+        '''
+        index_map = getattr(self, '_index_map', None)
+        if index_map is None:
+            # fill the map before publishing it, so that concurrent readers
+            # never see a partially constructed map
+            index_map = {}
+            stack = [] if self.root is None else [self.root]
+            while stack:
+                node_ = stack.pop()
+                index_map[node_.index] = node_
+                stack.extend(node_._child_nodes)
+            self._index_map = index_map
+        return index_map
+
+    def _resetIndexMap(self):
+        '''
+        Removes the index map, so that it is reconstructed at the next lookup
+        '''
+        self._index_map = None
+
+    def _addToIndexMap(self, node):
+        '''
+        Add a node and all nodes in its subtree to the index map, if the map
+        exists.
+
+        Parameters
+        ----------
+            node: :class:`SNode`
+        '''
+        index_map = getattr(self, '_index_map', None)
+        if index_map is not None:
+            stack = [node]
+            while stack:
+                node_ = stack.pop()
+                index_map[node_.index] = node_
+                stack.extend(node_._child_nodes)
+
+    def _removeFromIndexMap(self, node, subtree=True):
+        '''
+        Remove a node, and if requested all nodes in its subtree, from the index
+        map, if the map exists. Only entries that refer to the given nodes
+        themselves are removed.
+
+        Parameters
+        ----------
+            node: :class:`SNode`
+            subtree: bool
+                whether to also remove the nodes in the subtree of `node`
+        '''
+        index_map = getattr(self, '_index_map', None)
+        if index_map is not None:
+            stack = [node]
+            while stack:
+                node_ = stack.pop()
+                if index_map.get(node_.index, None) is node_:
+                    del index_map[node_.index]
+                if subtree:
+                    stack.extend(node_._child_nodes)
+
+    def _isInIndexMap(self, node):
+        '''
+        Check whether the index map exists and contains the given node
+        '''
+        index_map = getattr(self, '_index_map', None)
+        return index_map is not None and \
+               index_map.get(node.index, None) is node
+
+    def _getCache(self):
+        if getattr(self, '_cache_dict', None) is None:
+            self._cache_dict = {}
+        return self._cache_dict
+
+    _cache = property(_getCache)
+
+    def _resetStructureCaches(self):
+        '''
+        Removes all cached quantities that are derived from the tree structure,
+        to be called whenever the tree structure is modified. Increases the
+        structural revision of the tree.
+        '''
+        self._cache.clear()
+        self.bumpRevision('structure')
+
+    def _getRevisions(self):
+        if getattr(self, '_revisions', None) is None:
+            self._revisions = {'structure': 0, 'parameter': 0}
+        return self._revisions
+
+    def getRevision(self, kinds=('structure', 'parameter')):
+        '''
+        Returns the revision of the tree. The structural revision is increased
+        whenever the tree structure is modified, the parameter revision
+        whenever node parameters are modified through the functions of the
+        tree. Node attributes that are modified directly are not tracked, call
+        :func:`STree.bumpRevision` after doing so.
+
+        Parameters
+        ----------
+            kinds: string or tuple of strings ('structure', 'parameter')
+                The kinds of revision to return
+
+        Returns
+        -------
+            int or tuple of ints
+                The revision of each kind
+        '''
+        revisions = self._getRevisions()
+        if isinstance(kinds, str):
+            return revisions[kinds]
+        return tuple(revisions[kind] for kind in kinds)
+
+    def bumpRevision(self, kind='parameter'):
+        '''
+        Increase the revision of the given kind and notify the observers of
+        the tree. Caches obtained through :func:`STree.getRevisionCache` are
+        invalidated at their next access.
+
+        Parameters
+        ----------
+            kind: string ('structure' or 'parameter')
+        '''
+        revisions = self._getRevisions()
+        if kind not in revisions:
+            raise ValueError('`kind` can be \'structure\' or \'parameter\'')
+        revisions[kind] += 1
+        for observer in getattr(self, '_observers', []):
+            observer(self, kind)
+
+    def addObserver(self, observer):
+        '''
+        Register a function that is called as ``observer(tree, kind)`` every
+        time a revision of the tree is increased
+
+        Parameters
+        ----------
+            observer: callable
+        '''
+        if getattr(self, '_observers', None) is None:
+            self._observers = []
+        self._observers.append(observer)
+
+    def removeObserver(self, observer):
+        '''
+        Remove a function registered with :func:`STree.addObserver`
+
+        Parameters
+        ----------
+            observer: callable
+        '''
+        self._observers.remove(observer)
+
+    def getRevisionCache(self, name, kinds=('structure', 'parameter')):
+        '''
+        Returns a dictionary to store quantities derived from the tree. The
+        dictionary is registered against the given kinds of revision and is
+        emptied at the first access after one of these revisions has changed.
+
+        Parameters
+        ----------
+            name: string
+                The name of the cache
+            kinds: tuple of strings ('structure', 'parameter')
+                The kinds of revision on which the cached quantities depend
+
+        Returns
+        -------
+            dict
+        '''
+        if getattr(self, '_revision_caches', None) is None:
+            self._revision_caches = {}
+        revision = self.getRevision(kinds)
+        cache_revision, cache = self._revision_caches.get(name, (None, None))
+        if cache is None or cache_revision != revision:
+            cache = {}
+            self._revision_caches[name] = (revision, cache)
+        return cache
 
     def _findNode(self, node, index):
         """
@@ -162,21 +388,21 @@ class STree(object):
         -------
             :class:`SNode`
         """
-        stack = [];
-        stack.append(node)
-        while len(stack) != 0:
-            for cnode in stack:
-                if cnode.index == index:
-                    return cnode
-                else:
-                    stack.remove(cnode)
-                    stack.extend(cnode.getChildNodes())
+        queue = deque([node])
+        while len(queue) != 0:
+            cnode = queue.popleft()
+            if cnode.index == index:
+                return cnode
+            else:
+                queue.extend(cnode.getChildNodes())
         return None # Not found!
 
     def __len__(self, node=None):
         '''
         Return the number of nodes in the tree. If an input node is specified,
-        the number of nodes in the subtree of the input node is returned
+        the number of nodes in the subtree of the input node is returned. The
+        number of nodes in the full tree is obtained from the cached traversal
+        order.
 
         Parameters
         ----------
@@ -187,30 +413,162 @@ class STree(object):
         -------
             int
         '''
-        self._node_count = 0
+        if node is None or node is self.root:
+            return len(self.getOrderedNodes())
+        n_node = 0
         for node in self.__iter__(node=node):
-            self._node_count += 1
-        return self._node_count
+            n_node += 1
+        return n_node
 
     def __iter__(self, node=None, **kwargs):
         '''
-        Iterate over the nodes in the subtree of the given node. Beware, if
-        the given node is not in the tree, it will simply iterate over the
-        subtree of the given node.
+        Iterate over the nodes in the subtree of the given node, in depth-first
+        order. Beware, if the given node is not in the tree, it will simply
+        iterate over the subtree of the given node.
+
+        Iteration over the full tree uses the cached preorder node list, for
+        iteration over subtrees an explicit stack is used.
 
         Parameters
         ----------
             node: :class:`SNode` (optional)
                 The starting node. Defaults to the root
         '''
-        if node is None:
-            node = self.root
-        if node is not None:
+        if node is None or node is self.root:
+            return iter(self.getOrderedNodes())
+        return self._iterDepthFirst(node)
+
+    def _iterDepthFirst(self, node, **kwargs):
+        '''
+        Iterate over the subtree of the given node in depth-first order
+        (preorder), using an explicit stack instead of recursion
+
+        Parameters
+        ----------
+            node: :class:`SNode`
+                The starting node
+            kwargs:
+                keyword arguments for the `getChildNodes()` function of the
+                nodes
+        '''
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.getChildNodes(**kwargs)[::-1])
+
+    def _iterBreadthFirst(self, node, **kwargs):
+        '''
+        Iterate over the subtree of the given node in breadth-first order
+
+        Parameters
+        ----------
+            node: :class:`SNode`
+                The starting node
+            kwargs:
+                keyword arguments for the `getChildNodes()` function of the
+                nodes
+        '''
+        queue = deque([node])
+        while queue:
+            node = queue.popleft()
             yield node
-            if node is not None:
-                for cnode in node.getChildNodes():
-                    for inode in self.__iter__(cnode):
-                        yield inode
+            queue.extend(node.getChildNodes(**kwargs))
+
+    def _listPostorder(self, node, **kwargs):
+        '''
+        List the nodes in the subtree of the given node so that the children
+        precede their parent and the subtrees of the children appear in the
+        order of the children (postorder)
+
+        Parameters
+        ----------
+            node: :class:`SNode`
+                The starting node
+            kwargs:
+                keyword arguments for the `getChildNodes()` function of the
+                nodes
+        '''
+        # a preorder that visits the children in reverse, reversed
+        nodes = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(node.getChildNodes(**kwargs))
+        return nodes[::-1]
+
+    def getOrderedNodes(self, order='preorder'):
+        '''
+        Returns the nodes of the tree in the requested order. The node lists
+        are cached and recomputed when the tree structure changes. The returned
+        list should not be modified.
+
+        Parameters
+        ----------
+            order: string ('preorder', 'postorder' or 'bfs')
+                'preorder' is the depth-first order in which parents precede
+                their children (the iteration order), 'postorder' the
+                depth-first order in which children precede their parent and
+                'bfs' the breadth-first order
+
+        Returns
+        -------
+            list of :class:`SNode`
+        '''
+        key = 'nodes_' + order
+        if key not in self._cache:
+            if order not in ('preorder', 'postorder', 'bfs'):
+                raise ValueError('`order` can be \'preorder\', \'postorder\' ' + \
+                                 'or \'bfs\'')
+            root = self.root
+            if root is None:
+                nodes = []
+            elif order == 'preorder':
+                nodes = list(self._iterDepthFirst(root))
+            elif order == 'postorder':
+                nodes = self._listPostorder(root)
+            else:
+                nodes = list(self._iterBreadthFirst(root))
+            self._cache[key] = nodes
+        return self._cache[key]
+
+    def sweep(self, func, order='postorder', batch=False, **kwargs):
+        '''
+        Apply a function to all nodes of the tree in a single pass, either from
+        the leafs to the root (children are processed before their parent) or
+        from the root to the leafs (parents are processed before their
+        children). Replaces recursions that propagate quantities along the
+        tree.
+
+        Parameters
+        ----------
+            func: callable
+                Called as ``func(node, **kwargs)``, or as ``func(nodes, **kwargs)``
+                with a list of nodes if `batch` is ``True``
+            order: string ('postorder' or 'preorder')
+                'postorder' for a leaf-to-root sweep, 'preorder' for a
+                root-to-leaf sweep
+            batch: bool
+                If ``True``, `func` is called once for each depth level of the
+                tree with all nodes at that level, starting at the deepest level
+                for a 'postorder' sweep and at the root for a 'preorder' sweep.
+                The nodes at one level belong to independent subtrees.
+            kwargs:
+                Additional keyword arguments passed to `func`
+        '''
+        if order not in ('postorder', 'preorder'):
+            raise ValueError('`order` can be \'postorder\' or \'preorder\'')
+        if batch:
+            arr = self.getArrayTree()
+            levels = arr.getLevels()
+            if order == 'postorder':
+                levels = levels[::-1]
+            for rows in levels:
+                func([arr.nodes[row] for row in rows], **kwargs)
+        else:
+            for node in self.getOrderedNodes(order=order):
+                func(node, **kwargs)
 
     def __str__(self, node=None):
         '''
@@ -251,8 +609,7 @@ class STree(object):
             list of :class:`Snode`
         '''
         if not hasattr(self, '_nodes') or recompute_flag:
-            self._nodes = []
-            self._gatherNodes(self.root, self._nodes)
+            self._nodes = list(self.getOrderedNodes())
         return self._nodes
 
     def setNodes(self, illegal):
@@ -273,41 +630,102 @@ class STree(object):
         -------
             list of :class:`Snode`
         '''
+        row = self._getArrayRow(node)
+        if row is not None:
+            # the subtree is a contiguous range of the preorder node list
+            arr = self.getArrayTree()
+            return arr.nodes[row:row+arr.size[row]]
         nodes = []
         self._gatherNodes(node, nodes)
         return nodes
 
     def _gatherNodes(self, node, node_list=[]):
         '''
-        Append node to list and recurse to its child nodes
+        Append the nodes in the subtree of node to the list, in depth-first
+        order
 
         Parameters
         ----------
             node: :class:`SNode`
             node_list: list of :class:`SNode`
         '''
-        node_list.append(node)
-        for cnode in node.child_nodes:
-            self._gatherNodes(cnode, node_list=node_list)
+        node_list.extend(self.__iter__(node))
 
-    def getLeafs(self, recompute_flag=1):
+    def getLeafs(self, recompute_flag=0):
         '''
-        Get all leaf nodes in the tree.
+        Get all leaf nodes in the tree. The leaf list is cached and recomputed
+        when the tree structure changes, a copy of it is returned.
+
+        Note that the cache is only invalidated by the structural methods of
+        the tree (e.g. :func:`STree.addNodeWithParent`,
+        :func:`STree.removeSingleNode`). When the structure is modified
+        directly on the nodes (e.g. :func:`SNode.addChild`,
+        :func:`SNode.setChildNodes`), `recompute_flag` has to be set.
 
         Parameters
         ----------
             recompute_flag: bool
-                Whether to force recomputing the leaf list. Defaults to 1.
+                Whether to force recomputing the leaf list. Defaults to 0
+                (previously the list was recomputed on every call).
         '''
-        if not hasattr(self, '_leafs') or recompute_flag:
-            self._leafs = [node for node in self if self.isLeaf(node)]
-        return self._leafs
+        if 'leafs' not in self._cache or recompute_flag:
+            self._cache['leafs'] = [node for node in self if self.isLeaf(node)]
+        return list(self._cache['leafs'])
 
     def setLeafs(self, illegal):
         raise AttributeError("`leafs` is a read-only attribute")
 
     leafs = property(getLeafs, setLeafs)
 
+    def getArrayTree(self, recompute_flag=0):
+        '''
+        Returns the array representation of the tree, see :class:`ArrayTree`.
+        The array tree is stored and reconstructed when the tree structure
+        changes. Its columns contain a copy of the node attributes, which is
+        updated when the parameter revision of the tree has changed (see
+        :func:`STree.getRevision`).
+
+        Parameters
+        ----------
+            recompute_flag: bool
+                Whether to force recomputing the array tree. Defaults to 0.
+
+        Returns
+        -------
+            :class:`ArrayTree`
+        '''
+        revision = self.getRevision('parameter')
+        if 'array_tree' not in self._cache or recompute_flag:
+            nodes = [node for node in self]
+            self._cache['array_tree'] = \
+                    ArrayTree(nodes, columns=self._getNodeColumns(nodes))
+        elif self._cache['array_tree_revision'] != revision:
+            arr = self._cache['array_tree']
+            arr.columns = self._getNodeColumns(arr.nodes)
+        self._cache['array_tree_revision'] = revision
+        return self._cache['array_tree']
+
+    def setArrayTree(self, illegal):
+        raise AttributeError("`array_tree` is a read-only attribute")
+
+    array_tree = property(getArrayTree, setArrayTree)
+
+    def _getNodeColumns(self, nodes):
+        '''
+        Collect the node attributes that are stored as columns in the
+        :class:`ArrayTree`. To be overwritten by derived classes.
+
+        Parameters
+        ----------
+            nodes: list of :class:`SNode`
+                the nodes of the tree in depth-first order
+
+        Returns
+        -------
+            dict of numpy.array
+        '''
+        return {}
+
     def setRoot(self, node):
         '''
         Set the root node of the tree
@@ -319,6 +737,8 @@ class STree(object):
         '''
         node.parent_node = None
         self._root = node
+        self._resetIndexMap()
+        self._resetStructureCaches()
 
     def getRoot(self):
         return self._root
@@ -399,6 +819,9 @@ class STree(object):
         if pnode is not None:
             node.setParentNode(pnode)
             pnode.addChild(node)
+            if self._isInIndexMap(pnode):
+                self._addToIndexMap(node)
+            self._resetStructureCaches()
         else:
             warnings.warn('`pnode` was `None`, did nothing.')
 
@@ -414,6 +837,8 @@ class STree(object):
                 node to be removed
         '''
         node.getParentNode().removeChild(node)
+        self._removeFromIndexMap(node)
+        self._resetStructureCaches()
 
     def removeNode(self, node):
         '''
@@ -425,13 +850,16 @@ class STree(object):
                 node to be removed
         '''
         node.getParentNode().removeChild(node)
+        self._removeFromIndexMap(node)
+        self._resetStructureCaches()
         self._deepRemove(node)
 
     def _deepRemove(self, node):
-        cnodes = node.getChildNodes()
-        node.makeEmpty()
-        for cnode in cnodes:
-            self._deepRemove(cnode)
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.getChildNodes())
+            node.makeEmpty()
 
     def removeSingleNode(self, node):
         '''
@@ -448,6 +876,8 @@ class STree(object):
         cnodes = node.getChildNodes()
         pnode = node.getParentNode()
         pnode.removeChild(node)
+        self._removeFromIndexMap(node, subtree=False)
+        self._resetStructureCaches()
         for cnode in cnodes:
             cnode.setParentNode(pnode)
             pnode.addChild(cnode)
@@ -482,6 +912,9 @@ class STree(object):
                                               + str(pnode) + ', ignoring it')
             node.setParentNode(pnode)
             pnode.addChild(node)
+            if self._isInIndexMap(pnode):
+                self._addToIndexMap(node)
+            self._resetStructureCaches()
         if pnode == None:
             cnode = self.root
             cnode.setParentNode(node)
@@ -495,24 +928,72 @@ class STree(object):
         '''
         for ind, node in enumerate(self):
             node.index = ind+n
+        self._resetIndexMap()
+        self._resetStructureCaches()
 
-    def getSubTree(self, node):
+    def getSubTree(self, node, view=False):
         '''
-        Get the subtree of the specified node. The root of the subtree is a new
-        node with the same children as the original node, but None instead of a
-        parent. The other nodes are retained.
+        Get the subtree of the specified node. By default, the subtree is a new
+        tree that contains copies of the nodes in the subtree of `node`.
+        Alternatively, a read-only view can be returned that shares the nodes
+        with the present tree, and hence requires no copying.
 
         Parameters
         ----------
             node: :class:`SNode`
                 root of the sub tree
+            view: bool
+                if ``True``, returns a :class:`SubTreeView`, otherwise returns
+                an :class:`STree` with copies of the nodes
+
+        Returns
+        -------
+            :class:`STree` or :class:`SubTreeView`
         '''
+        if view:
+            return SubTreeView(self, node)
         subtree = STree()
-        cp = copy.copy(node)
-        cp.setParentNode(None)
-        subtree.setRoot(cp)
+        subtree.setRoot(self._copyNodes(node))
         return subtree
 
+    def _copyNodes(self, root, create_node=None, deep=True):
+        '''
+        Copy the subtree of `root` in a single iterative pass. The new nodes are
+        linked directly, without adding them one by one to a tree, and their
+        attributes are copied with a memo dictionary that is shared between
+        all nodes
+
+        Parameters
+        ----------
+            root: :class:`SNode`
+                the root of the subtree to be copied
+            create_node: callable (optional)
+                function that returns a new node given a node index, defaults
+                to `self.createCorrespondingNode`
+            deep: bool
+                whether to deep copy the node attributes
+
+        Returns
+        -------
+            :class:`SNode`
+                the root of the new subtree, which has no parent
+        '''
+        if create_node is None:
+            create_node = self.createCorrespondingNode
+        memo = {}
+        new_root = create_node(root.index)
+        root.__copy__(new_node=new_root, memo=memo, deep=deep)
+        stack = [(root, new_root)]
+        while stack:
+            node, new_node = stack.pop()
+            for cnode in node.getChildNodes(skip_inds=[]):
+                new_cnode = create_node(cnode.index)
+                cnode.__copy__(new_node=new_cnode, memo=memo, deep=deep)
+                new_cnode.setParentNode(new_node)
+                new_node.addChild(new_cnode)
+                stack.append((cnode, new_cnode))
+        return new_root
+
     def degreeOfNode(self, node):
         '''
         Compute the degree (number of leafs in its subtree) of a node.
@@ -553,14 +1034,99 @@ class STree(object):
                 and last node is the root
         '''
         nodes = []
-        self._goUpFrom(node, nodes)
+        while node is not None:
+            nodes.append(node)
+            node = node.getParentNode()
         return nodes
 
-    def _goUpFrom(self, node, nodes):
-        nodes.append(node)
-        pnode = node.getParentNode()
-        if pnode != None :
-            self._goUpFrom(pnode, nodes)
+    def _getArrayRow(self, node):
+        '''
+        Returns the row of `node` in the array tree, or ``None`` if `node` is
+        not represented in the array tree
+        '''
+        arr = self.getArrayTree()
+        row = arr._rowmap.get(node.index, None)
+        if row is None or arr.nodes[row] is not node:
+            return None
+        return row
+
+    def isInSubtree(self, node, subtree_root):
+        '''
+        Check whether a node is in the subtree of another node, which includes
+        the node itself. The check compares the entry and exit times of both
+        nodes in an Euler tour of the tree, and thus takes constant time.
+
+        Parameters
+        ----------
+            node: :class:`SNode`
+            subtree_root: :class:`SNode`
+
+        Returns
+        -------
+            bool
+        '''
+        row, row_ = self._getArrayRow(node), self._getArrayRow(subtree_root)
+        if row is None or row_ is None:
+            return subtree_root in self.pathToRoot(node)
+        return bool(self.getArrayTree().isAncestor(row_, row))
+
+    def getCommonAncestor(self, node1, node2):
+        '''
+        Find the lowest common ancestor of two nodes, i.e. the node furthest
+        from the root that is on the paths of both nodes to the root. Uses the
+        ancestor table of the array tree, so that the query does not depend on
+        the length of the paths.
+
+        Parameters
+        ----------
+            node1: :class:`SNode`
+            node2: :class:`SNode`
+
+        Returns
+        -------
+            :class:`SNode`
+        '''
+        row1, row2 = self._getArrayRow(node1), self._getArrayRow(node2)
+        if row1 is None or row2 is None:
+            # nodes that are not iterated over, compare paths to root
+            path2 = set(self.pathToRoot(node2))
+            return next(node for node in self.pathToRoot(node1) \
+                        if node in path2)
+        arr = self.getArrayTree()
+        return arr.nodes[arr.getLCA(row1, row2)]
+
+    def isOnPath(self, node, from_node, to_node):
+        '''
+        Check whether a node is on the path between two other nodes (inclusive)
+
+        Parameters
+        ----------
+            node: :class:`SNode`
+            from_node: :class:`SNode`
+            to_node: :class:`SNode`
+
+        Returns
+        -------
+            bool
+        '''
+        arr = self.getArrayTree()
+        rows = [self._getArrayRow(n_) for n_ in (node, from_node, to_node)]
+        if None in rows:
+            return node in self.pathBetweenNodes(from_node, to_node)
+        row, row1, row2 = rows
+        lca = arr.getLCA(row1, row2)
+        return bool(arr.isAncestor(lca, row) and \
+                    (arr.isAncestor(row, row1) or arr.isAncestor(row, row2)))
+
+    def _pathUpTo(self, node, ancestor):
+        '''
+        Path from `node` up to `ancestor`, both included
+        '''
+        path = [node]
+        while node is not ancestor:
+            node = node.getParentNode()
+            path.append(node)
+        return path
 
     def pathBetweenNodes(self, from_node, to_node):
         '''
@@ -578,12 +1144,10 @@ class STree(object):
                 and ``to_node``, which are respectively the first and last nodes
                 in the list.
         '''
-        path1 = self.pathToRoot(from_node)[::-1]
-        path2 = self.pathToRoot(to_node)[::-1]
-        path = path1 if len(path1) < len(path2) else path2
-        ind = next((ii for ii in xrange(len(path)) if path1[ii] != path2[ii]),
-                   len(path))
-        return path1[ind:][::-1] + path2[ind-1:]
+        anode = self.getCommonAncestor(from_node, to_node)
+        path1 = self._pathUpTo(from_node, anode)
+        path2 = self._pathUpTo(to_node, anode)
+        return path1 + path2[-2::-1]
 
     def pathBetweenNodesDepthFirst(self, from_node, to_node):
         '''
@@ -602,12 +1166,10 @@ class STree(object):
                 and ``to_node``, which are respectively the first and last nodes
                 in the list.
         '''
-        path1 = self.pathToRoot(from_node)[::-1]
-        path2 = self.pathToRoot(to_node)[::-1]
-        path = path1 if len(path1) < len(path2) else path2
-        ind = next((ii for ii in xrange(len(path)) if path1[ii] != path2[ii]),
-                   len(path))
-        return path1[ind-1:] + path2[ind:]
+        anode = self.getCommonAncestor(from_node, to_node)
+        path1 = self._pathUpTo(from_node, anode)
+        path2 = self._pathUpTo(to_node, anode)
+        return path1[::-1] + path2[-2::-1]
 
     def getNodesInSubtree(self, ref_node, subtree_root=None):
         '''
@@ -632,6 +1194,19 @@ class STree(object):
         '''
         if subtree_root == None:
             subtree_root = self.root
+        row, row_ = self._getArrayRow(ref_node), self._getArrayRow(subtree_root)
+        if row is not None and row_ is not None:
+            arr = self.getArrayTree()
+            if not arr.isAncestor(row_, row):
+                raise ValueError('|subtree_root| not in path from |ref_node| \
+                                    root')
+            elif row == row_:
+                return [ref_node]
+            # the child of the subtree root on the path to the reference node
+            # is the last child that precedes the reference node in preorder
+            crows = arr.getChildRows(row_)
+            crow = crows[np.searchsorted(crows, row, side='right') - 1]
+            return [subtree_root] + arr.nodes[crow:crow+arr.size[crow]]
         ref_path = self.pathBetweenNodes(ref_node, subtree_root)
         if subtree_root in ref_path:
             if len(ref_path) > 1:
@@ -670,29 +1245,24 @@ class STree(object):
                 ``corresponding_children`` has exactly one leaf, the corresponding
                 element in ``sisterLeafs``
         '''
-        sleafs = [node]; cchildren = []
-        snode = self._goUpUntil(node, None, sl=sleafs, cc=cchildren)
+        snode, cnode = self.upBifurcationNode(node)
+        sleafs = [node]; cchildren = [cnode]
+        for cnode_ in snode.getChildNodes():
+            if cnode_ is not cnode:
+                sleafs.extend(self._getSubtreeLeafs(cnode_))
+                cchildren.append(cnode_)
         return snode, sleafs, cchildren
 
-    def _goUpUntil(self, node, c_node, sl=[], cc=[]):
-        c_nodes = node.getChildNodes()
-        if (c_node != None and len(c_nodes) > 1) or self.isRoot(node):
-            cc.append(c_node)
-            for c_node_ in set(c_nodes) - {c_node}:
-                self._goDownUntil(c_node_, sl=sl)
-                cc.append(c_node_)
-        else:
-            p_node = node.getParentNode()
-            node = self._goUpUntil(p_node, node, sl=sl, cc=cc)
-        return node
-
-    def _goDownUntil(self, node, sl=[]):
-        c_nodes = node.getChildNodes()
-        if len(c_nodes) == 0:
-            sl.append(node)
-        else:
-            for c_node in c_nodes:
-                self._goDownUntil(c_node, sl=sl)
+    def _getSubtreeLeafs(self, node):
+        '''
+        Returns the leafs in the subtree of `node`, in depth-first order
+        '''
+        row = self._getArrayRow(node)
+        if row is not None:
+            arr = self.getArrayTree()
+            rows = arr.getSubtreeRows(row)
+            return [arr.nodes[row_] for row_ in rows[arr.n_children[rows] == 0]]
+        return [node_ for node_ in self.__iter__(node) if self.isLeaf(node_)]
 
     def upBifurcationNode(self, node, cnode=None):
         '''
@@ -703,7 +1273,8 @@ class STree(object):
             node: :class:`SNode`
                 Starting node for search
             cnode: :class:`SNode`
-                For recursion, don't touch default
+                If given, a child of `node`, and `node` itself is returned if
+                it is a bifurcation node. Defaults to ``None``.
 
         Returns
         -------
@@ -714,10 +1285,19 @@ class STree(object):
                 The bifurcation node's child on the path to the input node.
 
         '''
-        if cnode == None or len(node.getChildNodes()) <= 1:
+        row = self._getArrayRow(node) if cnode is None else None
+        if row is not None:
+            # nearest bifurcations are precomputed for all nodes
+            arr = self.getArrayTree()
+            brows, crows = arr.getUpBifurcations()
+            if brows[row] < 0:
+                return node, None
+            return arr.nodes[brows[row]], arr.nodes[crows[row]]
+        while cnode is None or len(node.getChildNodes()) <= 1:
             pnode = node.getParentNode()
-            if pnode != None:
-                node, cnode = self.upBifurcationNode(pnode, cnode=node)
+            if pnode is None:
+                break
+            node, cnode = pnode, node
         return node, cnode
 
     # def getBifurcationNodes(self, nodes):
@@ -750,7 +1330,9 @@ class STree(object):
 
     def getBifurcationNodes(self, nodes):
         '''
-        Get the bifurcation nodes in bewteen the provided input nodes
+        Get the bifurcation nodes in bewteen the provided input nodes, i.e. the
+        nodes with more than one child for which the subtree of each child
+        contains at least one input node. The root is always included.
 
         Parameters
         ----------
@@ -760,50 +1342,45 @@ class STree(object):
         Returns
         -------
         list of :class:`SNode`
-            the bifurcation nodes
+            the bifurcation nodes, in depth-first order
         '''
-        # tag all nodes
-        for node in self:
-            node['tag'] = 0
-        # find the 'leafs' within the list of nodes (i.e. most centripetal nodes)
-        pnodes = []
-        for node in nodes:
-            pnodes.extend([n for n in self.pathToRoot(node)])
-        pcount = Counter(pnodes)
-        nodes = [node for node in nodes if pcount[node] == 1]
-        # for each node, find nearest bifurcation towards root
-        pnodes = []
+        arr = self.getArrayTree()
+        # mark the input nodes, nodes that are not in the array tree are
+        # represented by their nearest ancestor that is
+        marks = np.zeros(len(arr), dtype=int)
         for node in nodes:
-            pnodes.extend([n for n in self.pathToRoot(node)])
-        for pathnode in pnodes:
-            pathnode['tag'] += 1
-        # find the bifurcation nodes
-        bifur_nodes = [self.root]
-        for node in self:
-            if len(node.child_nodes) > 1 and \
-               not np.any([cn['tag'] == 0 for cn in node.child_nodes]):
-                bifur_nodes.append(node)
-        # remove the tags
-        for node in self:
-            del node.content['tag']
-        # add root if necessary
-        if self.root not in bifur_nodes:
-            bifur_nodes = [self.root] + bifur_nodes
-        return bifur_nodes
-
-    def __copy__(self, new_tree=None):
-        '''
-        experimental, untested
-
+            row = self._getArrayRow(node)
+            while row is None and node is not None:
+                node = node.getParentNode()
+                row = None if node is None else self._getArrayRow(node)
+            if row is not None:
+                marks[row] = 1
+        # number of input nodes in the subtree of each node
+        n_input = arr.accumulateUp(marks)
+        # number of children whose subtree contains input nodes
+        rows = np.where(n_input[1:] > 0)[0] + 1
+        n_input_children = np.bincount(arr.parent[rows], minlength=len(arr))
+        n_children = arr.n_children
+        is_bifur = (n_children > 1) & (n_input_children == n_children)
+        is_bifur[0] = False
+        return [self.root] + [arr.nodes[row] for row in np.where(is_bifur)[0]]
+
+    def __copy__(self, new_tree=None, deep=True):
+        '''
         Fill the ``new_tree`` with it's corresponding nodes in the same
         structure as ``self``, and copies all node variables that both tree
-        classes have in common
+        classes have in common. The nodes are copied in a single iterative
+        pass.
 
         Parameters
         ----------
         new_tree: :class:`STree` or derived class (default is ``None``)
             the tree class in which the ``self`` is copied. If ``None``,
             returns a copy of ``self``.
+        deep: bool (default is ``True``)
+            whether to deep copy the node and tree attributes. If ``False``,
+            only the tree structure is copied and the new nodes refer to the
+            same attribute values as the original nodes.
 
         Returns
         -------
@@ -812,24 +1389,105 @@ class STree(object):
         if new_tree is None:
             new_tree = self.__class__()
 
-        new_node = new_tree.createCorrespondingNode(self.root.index)
-
-        self.root.__copy__(new_node=new_node)
-        new_tree.setRoot(new_node)
-        self._recurseCopy(self.root, new_tree)
+        new_tree.setRoot(self._copyNodes(self.root,
+                                         create_node=new_tree.createCorrespondingNode,
+                                         deep=deep))
         # copy all attributes not related to tree structure
         orig_keys = set(self.__dict__.keys())
         copy_keys = orig_keys.intersection(set(new_tree.__dict__.keys()))
+        # references to the present tree are replaced by the new tree
+        memo = {id(self): new_tree}
         for key in copy_keys:
-            if key not in ['root', '_computational_root', '_original_root']:
-                new_tree.__dict__[key] = copy.deepcopy(self.__dict__[key])
+            if key not in ['_root', '_computational_root', '_original_root'] and \
+               not key.startswith(('_index_map', '_cache', '_revision',
+                                   '_observers')):
+                val = self.__dict__[key]
+                new_tree.__dict__[key] = copy.deepcopy(val, memo) if deep else val
 
         return new_tree
 
-    def _recurseCopy(self, pnode, new_tree):
-        for node in pnode.getChildNodes(skip_inds=[]):
-            new_node = new_tree.createCorrespondingNode(node.index)
-            new_node = node.__copy__(new_node=new_node)
-            new_tree.addNodeWithParent(new_node, new_tree.__getitem__(pnode.index,
-                                                                      skip_inds=[]))
-            self._recurseCopy(node, new_tree)
+
+class SubTreeView(STree):
+    '''
+    Read-only view on the subtree of a node in a tree. The view shares the
+    nodes with the tree it was created from, so that constructing it does not
+    require any copying. All functions of :class:`STree` that inspect the tree
+    structure are available, functions that modify the tree structure raise an
+    AttributeError.
+
+    The cached quantities of the view are stored in the cache of the underlying
+    tree, so that they are discarded when the structure of the underlying tree
+    changes.
+
+    Not intended to be constructed directly, use :func:`STree.getSubTree`.
+    '''
+    def __init__(self, tree, node):
+        '''
+        Parameters
+        ----------
+            tree: :class:`STree`
+                the tree that contains `node`
+            node: :class:`SNode`
+                the root of the subtree
+        '''
+        self._tree = tree
+        self._root = node
+
+    def getRoot(self):
+        return self._root
+
+    def setRoot(self, node):
+        raise AttributeError("`root` of a subtree view is read-only")
+
+    root = property(getRoot, setRoot)
+
+    def _getCache(self):
+        return self._tree._cache.setdefault(('subtree_view', id(self._root)), {})
+
+    _cache = property(_getCache)
+
+    def _getIndexMap(self):
+        if 'index_map' not in self._cache:
+            self._cache['index_map'] = {node.index: node for node in \
+                    self._iterDepthFirst(self._root, skip_inds=[])}
+        return self._cache['index_map']
+
+    def _getNodeColumns(self, nodes):
+        return self._tree._getNodeColumns(nodes)
+
+    def _getRevisions(self):
+        return self._tree._getRevisions()
+
+    def isRoot(self, node):
+        return node is self._root
+
+    def pathToRoot(self, node):
+        '''
+        Return the path from a given node to the root of the subtree
+
+        Parameters:
+            node: :class:`SNode`
+
+        Returns
+        -------
+            list of :class:`SNode`
+        '''
+        nodes = [node]
+        while node is not self._root:
+            node = node.getParentNode()
+            nodes.append(node)
+        return nodes
+
+    def createCorrespondingNode(self, node_index, *args, **kwargs):
+        return self._tree.createCorrespondingNode(node_index, *args, **kwargs)
+
+    def _readOnly(self, *args, **kwargs):
+        raise AttributeError("a subtree view can not be modified")
+
+    addNodeWithParentFromIndex = _readOnly
+    addNodeWithParent = _readOnly
+    softRemoveNode = _readOnly
+    removeNode = _readOnly
+    removeSingleNode = _readOnly
+    insertNode = _readOnly
+    resetIndices = _readOnly
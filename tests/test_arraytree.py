@@ -0,0 +1,141 @@
+import numpy as np
+
+import pytest
+
+from neat import STree, SNode, ArrayTree, PhysTree
+
+
+class TestArrayTree():
+    def createTree(self):
+        '''
+        Create a simple tree structure
+
+          4     5     6
+           \   /     /
+            \ /     /
+             2     3
+              \   /
+               \ /
+                1
+                |
+                |
+                0
+
+        '''
+        self.nodelist = [SNode(ii) for ii in xrange(7)]
+        self.tree = STree()
+        self.tree.setRoot(self.nodelist[0])
+        for ii, pii in [(1,0), (2,1), (3,1), (4,2), (5,2), (6,3)]:
+            self.tree.addNodeWithParent(self.nodelist[ii], self.nodelist[pii])
+
+    def loadTree(self):
+        '''
+        Load the T-tree morphology in memory
+
+          6--5--4--7--8
+                |
+                |
+                1
+        '''
+        fname = 'test_morphologies/Ttree.swc'
+        self.tree = PhysTree(fname, types=[1,3,4])
+
+    def testStructure(self):
+        self.createTree()
+        arr = self.tree.array_tree
+        assert isinstance(arr, ArrayTree)
+        assert len(arr) == 7
+        assert arr.index.tolist() == [node.index for node in self.tree]
+        # parents and depths
+        assert arr.index[arr.parent[1:]].tolist() == \
+                [node.parent_node.index for node in self.tree.nodes[1:]]
+        assert arr.parent[0] == -1
+        assert arr.depth.tolist() == [0, 1, 2, 3, 3, 2, 3]
+        # child lists
+        for row, node in enumerate(arr.nodes):
+            assert arr.index[arr.getChildRows(row)].tolist() == \
+                    [cnode.index for cnode in node.child_nodes]
+        assert arr.n_children.tolist() == [1, 2, 2, 0, 0, 1, 0]
+        assert arr.size.tolist() == [7, 6, 3, 1, 1, 2, 1]
+        # traversal orders
+        assert arr.index[arr.preorder].tolist() == [0, 1, 2, 4, 5, 3, 6]
+        assert arr.index[arr.postorder].tolist() == [4, 5, 2, 6, 3, 1, 0]
+        assert arr.index[arr.bfsorder].tolist() == [0, 1, 2, 3, 4, 5, 6]
+        assert [arr.index[rows].tolist() for rows in arr.getLevels()] == \
+                [[0], [1], [2, 3], [4, 5, 6]]
+        assert arr.getRows(5) == 4
+        assert arr.getRows([6, 0]).tolist() == [6, 0]
+
+    def testAccumulation(self):
+        self.createTree()
+        arr = self.tree.array_tree
+        assert np.allclose(arr.accumulateUp(np.ones(7)), arr.size)
+        assert np.allclose(arr.accumulateDown(np.ones(7)), arr.depth + 1)
+        # sum of indices on path to root
+        assert np.allclose(arr.accumulateDown(arr.index.astype(float)),
+                           [0., 1., 3., 7., 8., 4., 10.])
+
+    def testLCA(self):
+        self.createTree()
+        arr = self.tree.array_tree
+        r_ = arr.getRows
+        assert arr.isAncestor(r_(1), r_(5)) and arr.isAncestor(r_(5), r_(5))
+        assert not arr.isAncestor(r_(2), r_(6))
+        assert arr.getLCA(r_(4), r_(5)) == r_(2)
+        assert arr.getLCA(r_(4), r_(6)) == r_(1)
+        assert arr.getLCA(r_(0), r_(6)) == r_(0)
+        # vectorized queries
+        rows1, rows2 = np.meshgrid(np.arange(7), np.arange(7), indexing='ij')
+        lca = arr.getLCA(rows1, rows2)
+        assert lca.shape == (7, 7) and np.all(lca == lca.T)
+        assert np.all(arr.depth[lca] <= np.minimum(arr.depth[rows1],
+                                                   arr.depth[rows2]))
+        assert np.all(arr.isAncestor(lca, rows1) & arr.isAncestor(lca, rows2))
+        assert arr.index[lca[r_(5), r_(6)]] == 1
+
+    def testSubtrees(self):
+        self.createTree()
+        arr = self.tree.array_tree
+        r_ = arr.getRows
+        assert arr.index[arr.getSubtreeRows(r_(2))].tolist() == [2, 4, 5]
+        assert arr.index[arr.getSubtreeRows(r_(0))].tolist() == \
+                [0, 1, 2, 4, 5, 3, 6]
+        brows, crows = arr.getUpBifurcations()
+        assert brows[0] == -1 and crows[0] == -1
+        assert arr.index[brows[1:]].tolist() == [0, 1, 2, 2, 1, 1]
+        assert arr.index[crows[1:]].tolist() == [1, 2, 4, 5, 3, 3]
+
+    def testCaching(self):
+        self.createTree()
+        arr = self.tree.array_tree
+        assert self.tree.getArrayTree() is arr
+        # modifying the tree structure requires a new array tree
+        self.tree.addNodeWithParent(SNode(7), self.nodelist[6])
+        arr_ = self.tree.array_tree
+        assert arr_ is not arr and len(arr_) == 8
+        with pytest.raises(AttributeError):
+            self.tree.array_tree = arr
+
+    def testColumns(self):
+        self.loadTree()
+        arr = self.tree.array_tree
+        assert arr.index.tolist() == [1, 4, 5, 6, 7, 8]
+        assert np.allclose(arr['L'], [0., 100., 50., 50., 50., 50.])
+        assert np.allclose(arr['R'], [10., 1., 1., .5, 1., .5])
+        assert arr['xyz'].shape == (6, 3)
+        assert np.allclose(arr['xyz'][3], [100., 100., 0.])
+        assert np.allclose(arr['r_a'], 100.*1e-6)
+        # channel densities
+        self.tree.addCurrent('L', 100., -75., node_arg=[self.tree[6]])
+        arr = self.tree.getArrayTree(recompute_flag=1)
+        assert np.allclose(arr['g_L'], [0., 0., 0., 100., 0., 0.])
+        assert np.allclose(arr['e_L'][3], -75.)
+        # array tree of the computational tree
+        self.tree.setCompTree()
+        self.tree.treetype = 'computational'
+        arr_comp = self.tree.array_tree
+        assert arr_comp.index.tolist() == [node.index for node in self.tree]
+        assert arr_comp.nodes[-1] is self.tree[8]
+        assert arr_comp.nodes[-1] is not arr.nodes[-1]
+        self.tree.treetype = 'original'
+        assert self.tree.array_tree is arr
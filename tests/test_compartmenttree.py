@@ -211,6 +211,32 @@ class TestCompartmentTree():
         assert np.allclose(z_fit_1, ctree_3.calcImpedanceMatrix(self.freqs, indexing='tree'))
         assert np.allclose(z_fit_1, ctree_4.calcImpedanceMatrix(self.freqs, indexing='tree'))
 
+    def testBlockwiseFit(self, tmpdir, n_loc=20):
+        self.loadBallAndStick()
+        xvals = np.linspace(0., 1., n_loc+1)[1:]
+        locs = random.sample([(1, 0.5)] + [(4, x) for x in xvals], k=n_loc+1)
+        # impedance matrix stored on disk
+        fname = str(tmpdir.join('zmat.npy'))
+        self.greens_tree.calcImpedanceMatrix(locs, block_size=4,
+                                             filename=fname)
+        z_mat = np.load(fname, mmap_mode='r')
+        # reference fit in memory
+        ctree = self.greens_tree.createCompartmentTree(locs)
+        ctree.computeGMC(np.array(z_mat[0]).real)
+        ctree.computeC(self.freqs, np.array(z_mat))
+        # the fits accumulated over blocks give the same model
+        ctree_ = self.greens_tree.createCompartmentTree(locs)
+        ctree_.computeGMC(z_mat[0].real, block_size=4)
+        ctree_.computeC(self.freqs, z_mat, freq_block_size=2)
+        for node, node_ in zip(ctree, ctree_):
+            assert np.allclose([node.g_c, node.currents['L'][0], node.ca],
+                               [node_.g_c, node_.currents['L'][0], node_.ca])
+        ctree_ = self.greens_tree.createCompartmentTree(locs)
+        ctree_.computeGC(self.freqs, z_mat, freq_block_size=3)
+        for node, node_ in zip(ctree, ctree_):
+            assert np.allclose([node.g_c, node.currents['L'][0], node.ca],
+                               [node_.g_c, node_.currents['L'][0], node_.ca])
+
 
 if __name__ == '__main__':
     # tcomp = TestCompartmentTree()
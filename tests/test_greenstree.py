@@ -2,8 +2,9 @@ import numpy as np
 import matplotlib.pyplot as pl
 
 import pytest
+import warnings
 
-from neat import SOVTree, GreensTree, GreensNode
+from neat import SOVTree, GreensTree, GreensNode, LocArray
 import neat.tools.kernelextraction as ke
 
 
@@ -81,6 +82,10 @@ class TestGreensTree():
         z_mat_0 = self.tree.calcImpedanceMatrix('0')[ft.ind_0s]
         z_mat_1 = self.tree.calcImpedanceMatrix('1')[ft.ind_0s]
         z_mat_2 = self.tree.calcImpedanceMatrix('2')[ft.ind_0s]
+        # location arrays are accepted as location lists
+        locarr_1 = LocArray(locs_1, self.tree)
+        assert np.allclose(self.tree.calcImpedanceMatrix(locarr_1)[ft.ind_0s],
+                           z_mat_1)
         # check complex steady state component zero
         assert np.allclose(z_mat_0.imag, np.zeros_like(z_mat_0.imag))
         assert np.allclose(z_mat_1.imag, np.zeros_like(z_mat_1.imag))
@@ -161,6 +166,58 @@ class TestGreensTree():
         # print z_sov
         # print z_gf
 
+    def testImpedanceCache(self):
+        self.loadTTree()
+        freqs = np.array([0., 1., 10.]) * 1j
+        self.tree.setImpedance(freqs)
+        buf = self.tree._impedance_buffer
+        # unchanged tree and frequencies, nothing is recomputed
+        self.tree.setImpedance(freqs.copy())
+        assert self.tree._impedance_buffer is buf
+        self.tree.setImpedance(freqs, recompute_flag=True)
+        assert self.tree._impedance_buffer is not buf
+        # parameter changes invalidate the impedances
+        buf = self.tree._impedance_buffer
+        z_in = self.tree.calcZF((1, .5), (1, .5))
+        self.tree.treetype = 'computational'
+        self.tree.addCurrent('L', 200., -75.)
+        self.tree.treetype = 'original'
+        self.tree.setImpedance(freqs)
+        assert self.tree._impedance_buffer is not buf
+        assert not np.allclose(self.tree.calcZF((1, .5), (1, .5)), z_in)
+        # different frequencies
+        buf = self.tree._impedance_buffer
+        self.tree.setImpedance(freqs[:2])
+        assert self.tree._impedance_buffer.shape[-1] == 2
+        # parameters modified through the nodes invalidate the impedances
+        z_in = self.tree.calcZF((1, .5), (1, .5))
+        self.tree.treetype = 'computational'
+        for node in self.tree: node.addCurrent('L', 500., -75.)
+        self.tree.treetype = 'original'
+        self.tree.setImpedance(freqs[:2])
+        assert not np.allclose(self.tree.calcZF((1, .5), (1, .5)), z_in)
+
+    def testImpedanceBuffer(self):
+        self.loadTTree()
+        freqs = np.array([0., 1., 10.]) * 1j
+        self.tree.setImpedance(freqs)
+        buf = self.tree._impedance_buffer
+        self.tree.treetype = 'computational'
+        nodes = self.tree.getOrderedNodes()
+        assert buf.shape == (len(GreensNode.impedance_names), len(nodes), 3)
+        # node quantities are views on the buffer of the tree
+        for ii, node in enumerate(nodes):
+            assert np.shares_memory(node.z_m, buf)
+            assert np.allclose(node.z_m, buf[0,ii])
+        assert np.allclose(nodes[0].z_soma, nodes[0].z_m)
+        assert np.allclose(nodes[0].z_in, nodes[0].z_00)
+        # nodes without a buffer have no impedances
+        node = GreensNode(10, None)
+        with pytest.raises(AttributeError):
+            node.z_m
+        with pytest.raises(AttributeError):
+            node.foo = 1.
+
         # self.tree.treetype = 'computational'
         # for node in self.tree:
         #     print node
@@ -198,10 +255,173 @@ class TestGreensTree():
         #             # pass
         #             print imp.z_soma[ft.ind_0s]
 
+    def testSweep(self):
+        self.loadTTree()
+        self.tree.addCurrent('Na_Ta', 100., 50., node_arg='basal')
+        self.tree.addCurrent('Kv3_1', 50., -85.)
+        self.tree.setCompTree()
+        freqs = np.array([0., 1., 10., 100.]) * 1j
+        self.tree.setImpedance(freqs)
+        buf = self.tree._impedance_buffer.copy()
+        # the vectorized sweeps agree with the node-level recursions
+        self.tree.treetype = 'computational'
+        nodes = self.tree.getOrderedNodes()
+        for node in nodes:
+            node.setImpedance(freqs, channel_storage=self.tree.channel_storage)
+        for node in self.tree.getOrderedNodes(order='postorder'):
+            node.setImpedanceDistal()
+        for node in nodes[1:]:
+            node.setImpedanceProximal()
+        for node in nodes:
+            node.setImpedanceArrays()
+        finite = np.isfinite(buf)
+        assert np.array_equal(finite, np.isfinite(self.tree._impedance_buffer))
+        assert np.allclose(buf[finite], self.tree._impedance_buffer[finite])
+        assert np.all(np.isinf(nodes[-1].z_distal))
+
+    def testIncrementalUpdate(self):
+        self.loadTTree()
+        self.tree.addCurrent('Kv3_1', 50., -85.)
+        self.tree.setCompTree()
+        freqs = np.array([0., 1., 10., 100.]) * 1j
+        self.tree.setImpedance(freqs)
+        evaluated_rows = []
+        get_terms = self.tree._getMembraneAdmittanceTerms
+        def spy(arr, freqs, rows=None):
+            evaluated_rows.append(rows)
+            return get_terms(arr, freqs, rows=rows)
+        self.tree._getMembraneAdmittanceTerms = spy
+        self.tree.treetype = 'computational'
+        for node_arg, g in [([6], 200.), ([1], 20.), ([5, 8], 100.)]:
+            buf = self.tree._impedance_buffer
+            buf_ = buf.copy()
+            self.tree.addCurrent('Na_Ta', g, 50.,
+                                 node_arg=[self.tree[ii] for ii in node_arg])
+            self.tree.setImpedance(freqs)
+            # only the modified nodes are evaluated, in place
+            rows = self.tree.getArrayTree().getRows(node_arg)
+            assert evaluated_rows[-1].tolist() == rows.tolist()
+            assert self.tree._impedance_buffer is buf
+            assert not np.array_equal(buf[:,rows], buf_[:,rows])
+            buf = self.tree._impedance_buffer.copy()
+            # the update agrees with a full evaluation
+            self.tree.setImpedance(freqs, recompute_flag=True)
+            assert evaluated_rows[-1] is None
+            finite = np.isfinite(buf)
+            assert np.array_equal(finite,
+                                  np.isfinite(self.tree._impedance_buffer))
+            assert np.allclose(buf[finite], self.tree._impedance_buffer[finite])
+        # nodes below a node whose proximal impedance is unchanged keep their
+        # proximal impedances
+        buf = self.tree._impedance_buffer.copy()
+        self.tree.addCurrent('Na_Ta', 300., 50., node_arg=[self.tree[6]])
+        self.tree.setImpedance(freqs)
+        row = self.tree.getArrayTree().getRows([4])[0]
+        ind = GreensNode.impedance_names.index('z_proximal')
+        assert np.array_equal(self.tree._impedance_buffer[ind,row],
+                              buf[ind,row])
+        # a new parameter revision without changes to the computational tree
+        n_eval = len(evaluated_rows)
+        self.tree.treetype = 'original'
+        self.tree.addCurrent('L', 100., -75., node_arg=[self.tree[5]])
+        self.tree.setImpedance(freqs)
+        self.tree.treetype = 'computational'
+        self.tree.setImpedance(freqs)
+        assert len(evaluated_rows) == n_eval
+        self.tree.bumpRevision('parameter')
+        self.tree.setImpedance(freqs)
+        assert len(evaluated_rows) == n_eval
+
+    def testImpedanceMatrix(self, tmpdir):
+        self.loadTTree()
+        self.tree.addCurrent('Na_Ta', 100., 50., node_arg='basal')
+        freqs = np.array([0., 1., 10., 100.]) * 1j
+        self.tree.setImpedance(freqs)
+        locs = [(1, .5), (4, .2), (4, .8), (4, 1.), (5, .0), (5, .5), (6, 1.),
+                (7, .7), (7, .3), (8, .5), (4, .2)]
+        self.tree.storeLocs(locs, 'matlocs')
+        z_ref = np.zeros((len(freqs), len(locs), len(locs)), dtype=complex)
+        for ii, loc1 in enumerate(locs):
+            for jj, loc2 in enumerate(locs):
+                z_ref[:,ii,jj] = self.tree.calcZF(loc1, loc2)
+        # no floating point warnings, e.g. from the soma quantities
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', RuntimeWarning)
+            z_mat = self.tree.calcImpedanceMatrix('matlocs')
+        assert np.allclose(z_mat, z_ref)
+        assert np.allclose(self.tree.calcImpedanceMatrix(locs), z_ref)
+        # computation in blocks, written to a memory-mapped file
+        fname = str(tmpdir.join('zmat.npy'))
+        z_mat = self.tree.calcImpedanceMatrix('matlocs', block_size=3,
+                                              freq_block_size=3,
+                                              filename=fname)
+        assert isinstance(z_mat, np.memmap)
+        assert np.allclose(np.load(fname), z_ref)
+        # streaming over blocks of the impedance matrix
+        z_mat = np.zeros_like(z_ref)
+        n_block = 0
+        for f_slice, loc_slice, z_block in self.tree.iterImpedanceMatrix(
+                            'matlocs', block_size=4, freq_block_size=3):
+            assert z_block.shape[0] <= 3 and z_block.shape[1] <= 4
+            z_mat[f_slice,loc_slice] = z_block
+            n_block += 1
+        assert n_block == 6
+        assert np.allclose(z_mat, z_ref)
+
+    def testWorkerPool(self, tmpdir):
+        self.loadTTree()
+        freqs = np.array([0., 1., 10., 100., 1000.]) * 1j
+        self.tree.setImpedance(freqs)
+        buf = self.tree._impedance_buffer.copy()
+        locs = [(1, .5), (4, .5), (4, 1.), (5, .5), (6, .5), (7, .5), (8, .5)]
+        z_ref = self.tree.calcImpedanceMatrix(locs)
+        # sweeps and impedance matrices evaluated by worker processes
+        self.tree.setImpedance(freqs, recompute_flag=True, n_workers=2,
+                               freq_block_size=2)
+        finite = np.isfinite(buf)
+        assert np.array_equal(finite, np.isfinite(self.tree._impedance_buffer))
+        assert np.allclose(buf[finite], self.tree._impedance_buffer[finite])
+        assert np.allclose(self.tree.calcImpedanceMatrix(locs, n_workers=3),
+                           z_ref)
+        out = np.zeros_like(z_ref)
+        z_mat = self.tree.calcImpedanceMatrix(locs, out=out, n_workers=2)
+        assert z_mat is out and np.allclose(out, z_ref)
+        fname = str(tmpdir.join('zmat.npy'))
+        self.tree.calcImpedanceMatrix(locs, filename=fname, n_workers=2,
+                                      freq_block_size=1)
+        assert np.allclose(np.load(fname), z_ref)
 
+    def testThreadedViews(self):
+        from multiprocessing.pool import ThreadPool
+        self.loadTTree()
+        freqs = np.array([0., 10.j, 100.j])
+        self.tree.setImpedance(freqs)
+        locs = [(1, .5), (4, .5), (4, 1.), (5, .5), (6, .5), (7, .5), (8, .5)]
+        self.tree.storeLocs(locs, 'threadlocs')
+        z_ref = self.tree.calcImpedanceMatrix('threadlocs')
+        # impedance and location queries from a thread pool
+        view_orig = self.tree.getView('original')
+        view_comp = self.tree.getView('computational')
+        def query(ii):
+            if ii % 2:
+                return view_comp.calcImpedanceMatrix('threadlocs')
+            else:
+                return view_orig.getNodeIndices('threadlocs')
+        pool = ThreadPool(4)
+        try:
+            results = pool.map(query, range(40))
+        finally:
+            pool.close()
+            pool.join()
+        for ii, res in enumerate(results):
+            if ii % 2:
+                assert np.allclose(res, z_ref)
+            else:
+                assert list(res) == [1,4,4,5,6,7,8]
+        assert self.tree.treetype == 'original'
 
 
 if __name__ == '__main__':
     tgt = TestGreensTree()
     # tgt.testBasicProperties()
-    tgt.testValues()
\ No newline at end of file
+    tgt.testValues()
@@ -1,9 +1,11 @@
 import numpy as np
+import copy
 import matplotlib.pyplot as pl
 
 import pytest
 
-from neat import MorphTree, MorphNode, MorphLoc
+from neat import MorphTree, MorphNode, MorphLoc, LocArray
+from neat.trees.morphtree import getSWCHash
 
 
 class TestMorphTree():
@@ -29,6 +31,69 @@ class TestMorphTree():
             fname = 'test_morphologies/Ttree.swc'
             self.tree = MorphTree(fname, types=[1,3,4])
 
+    def testSWCParsing(self, tmpdir):
+        self.loadTree()
+        ref = [(node.index, node.parent_node, node.xyz, node.R, node.L) \
+               for node in self.tree]
+        # comments, blank lines and additional columns
+        lines = open('test_morphologies/Ttree.swc').read().splitlines()
+        fname1 = str(tmpdir.join('Ttree_comments.swc'))
+        with open(fname1, 'w') as file:
+            file.write('\n'.join([lines[0], ''] + \
+                                 [line + ' # sample' for line in lines[2:]]))
+        fname2 = str(tmpdir.join('Ttree_columns.swc'))
+        with open(fname2, 'w') as file:
+            file.write('\n'.join([line + ' 0.' for line in lines[2:]]))
+        for fname in [fname1, fname2]:
+            tree = MorphTree(fname, types=[1,3,4])
+            assert [node.index for node in tree] == [r_[0] for r_ in ref]
+            for node, (_, pnode, xyz, R, L) in zip(tree, ref):
+                assert np.allclose(node.xyz, xyz)
+                assert np.allclose([node.R, node.L], [R, L])
+                if pnode is not None:
+                    assert node.parent_node.index == pnode.index
+            assert tree.__getitem__(2, skip_inds=[]).parent_node is tree[1]
+
+    def testNPZCache(self, tmpdir):
+        self.loadTree(reinitialize=1)
+        swc_file = 'test_morphologies/Ttree.swc'
+        fname = str(tmpdir.join(getSWCHash(swc_file) + '.npz'))
+        self.tree.storeLocs([(1,.5), (5,.5), (8,.3)], 'locs1')
+        # tree without computational tree
+        self.tree.writeNPZTreeToFile(fname, swc_file=swc_file)
+        tree = MorphTree().readNPZTreeFromFile(fname, swc_file=swc_file)
+        assert tree._computational_root is None
+        assert [node.index for node in tree.__iter__(skip_inds=[])] == \
+               [node.index for node in self.tree.__iter__(skip_inds=[])]
+        assert [loc for loc in tree.getLocs('locs1')] == \
+               [loc for loc in self.tree.getLocs('locs1')]
+        with pytest.raises(ValueError):
+            tree.readNPZTreeFromFile(fname,
+                        swc_file='test_morphologies/ball_and_stick.swc')
+        # tree with computational tree
+        self.tree.setCompTree()
+        self.tree.storeLocs([(4,1.), (6,.5)], 'locs2')
+        self.tree.treetype = 'computational'
+        self.tree.writeNPZTreeToFile(fname)
+        tree.readNPZTreeFromFile(fname)
+        assert tree.treetype == 'computational'
+        assert [node.index for node in tree] == [1, 4, 6, 8]
+        for treetype in ['original', 'computational']:
+            self.tree.treetype = treetype; tree.treetype = treetype
+            for node, node_ in zip(self.tree, tree):
+                assert node.index == node_.index
+                assert node.parent_node is None or \
+                       node.parent_node.index == node_.parent_node.index
+                assert np.allclose([node.L, node.R], [node_.L, node_.R])
+                assert np.allclose(node.xyz, node_.xyz)
+            for name in ['locs1', 'locs2']:
+                assert np.allclose(tree.getXCoords(name),
+                                   self.tree.getXCoords(name))
+                assert [loc['node'] for loc in tree.getLocs(name)] == \
+                       [loc['node'] for loc in self.tree.getLocs(name)]
+        tree.treetype = 'original'
+        assert tree[6].used_in_comptree and not tree[5].used_in_comptree
+
     def testLocEquality(self):
         self.loadTree()
         loc1 = MorphLoc((4,.5), self.tree)
@@ -116,6 +181,31 @@ class TestMorphTree():
         assert np.allclose(leaf2.L, 50.)
         assert leaf2.swc_type == 4
 
+    def testCopy(self):
+        self.loadTree(reinitialize=1)
+        self.tree.setCompTree()
+        locs = [(1, .5), (4, .5), (8, 1.)]
+        self.tree.storeLocs(locs, 'locs')
+        tree = copy.copy(self.tree)
+        assert tree.treetype == 'original'
+        for treetype in ['original', 'computational']:
+            self.tree.treetype = treetype; tree.treetype = treetype
+            nodes = self.tree.getNodes(skip_inds=[])
+            nodes_ = tree.getNodes(skip_inds=[])
+            assert [node.index for node in nodes] == \
+                   [node.index for node in nodes_]
+            for node, node_ in zip(nodes, nodes_):
+                assert node is not node_
+                assert np.allclose(node.xyz, node_.xyz)
+                assert node.R == node_.R
+                if hasattr(node, 'L'):
+                    assert node.L == node_.L
+        # stored locations refer to the new tree
+        tree.treetype = 'original'
+        assert [loc.reftree for loc in tree.getLocs('locs')] == [tree] * 3
+        assert np.allclose(tree.distancesToSoma('locs'),
+                           self.tree.distancesToSoma('locs'))
+
     def testComptree(self):
         self.loadTree(reinitialize=1)
         # check exception when treetype is invalid
@@ -160,6 +250,10 @@ class TestMorphTree():
         assert np.allclose(leaf2.xyz, np.array([100.,-100.,0.]))
         assert np.allclose(leaf2.R, .75)
         assert np.allclose(leaf2.L, 100.)
+        # node lookup uses the index map of the computational tree
+        assert self.tree[5] == None and self.tree[7] == None
+        assert self.tree[2] == None
+        assert self.tree.__getitem__(2, skip_inds=[]).parent_node == root
         # test nodes getter
         assert len(self.tree.nodes) == 4
         leafs = self.tree.leafs
@@ -168,6 +262,11 @@ class TestMorphTree():
         assert len(self.tree.nodes) == 6
         leafs = self.tree.leafs
         assert np.allclose([leafs[0].L, leafs[1].L], [50., 50.])
+        # the cached leaf list is not exposed
+        leafs.pop()
+        assert len(self.tree.leafs) == 2
+        assert self.tree[5].parent_node is self.tree[4]
+        assert self.tree[4] is not bifur
         # remove the computational tree
         self.tree.removeComptree()
         with pytest.raises(ValueError):
@@ -175,6 +274,85 @@ class TestMorphTree():
         for node in self.tree:
             assert not node.used_in_comptree
 
+    def testViews(self):
+        self.loadTree(reinitialize=1)
+        # computational view requires a computational tree
+        with pytest.raises(ValueError):
+            self.tree.getView('computational')
+        with pytest.raises(ValueError):
+            self.tree.getView('bla')
+        self.tree.setCompTree()
+        locs = [(1,.5), (4, 1.), (5, .5), (6, .5), (6, 1.), (7, .2), (8, .5)]
+        self.tree.storeLocs(locs, 'viewlocs')
+        view_orig = self.tree.getView('original')
+        view_comp = self.tree.getView('computational')
+        assert view_orig.treetype == 'original'
+        assert view_comp.treetype == 'computational'
+        assert view_orig.getTree() is self.tree
+        # views share the nodes of the underlying tree
+        assert view_orig[5] is self.tree[5]
+        assert view_comp[5] is None
+        assert [node.index for node in view_comp] == [1,4,6,8]
+        assert len(view_orig) == 6 and len(view_comp) == 4
+        assert view_comp.root is self.tree._computational_root
+        with self.tree.treetypeContext('computational'):
+            assert view_comp[4] is self.tree[4]
+            assert view_orig[4] is not self.tree[4]
+            assert self.tree.treetype == 'computational'
+        assert self.tree.treetype == 'original'
+        # views are immutable
+        with pytest.raises(AttributeError):
+            view_comp.treetype = 'original'
+        with pytest.raises(AttributeError):
+            view_orig.locs = {}
+        # locations are interpreted in the treetype of the view
+        nids_orig = view_orig.getNodeIndices('viewlocs')
+        nids_comp = view_comp.getNodeIndices('viewlocs')
+        assert list(nids_orig) == [1,4,5,6,6,7,8]
+        assert list(nids_comp) == [1,4,6,6,6,8,8]
+        loc = MorphLoc((5, .5), view_comp)
+        assert loc.reftree is self.tree
+        # returned locations are read in the treetype of the calling thread
+        loc = view_comp.getLocs('viewlocs')[2]
+        assert loc['node'] == 5
+        with self.tree.treetypeContext('computational'):
+            assert loc['node'] == 6
+        # the treetype of the tree is unaffected by queries on the views
+        d_orig = view_orig.pathLengthMatrix('viewlocs')
+        d_comp = view_comp.pathLengthMatrix('viewlocs')
+        assert self.tree.treetype == 'original'
+        assert np.allclose(d_orig, d_comp)
+
+    def testViewsThreaded(self):
+        from multiprocessing.pool import ThreadPool
+        self.loadTree(reinitialize=1)
+        self.tree.setCompTree()
+        locs = [(1,.5), (4, 1.), (5, .5), (6, .5), (6, 1.), (7, .2), (8, .5)]
+        self.tree.storeLocs(locs, 'viewlocs')
+        views = [self.tree.getView('original'),
+                 self.tree.getView('computational')]
+        def query(ii):
+            view = views[ii % 2]
+            nids = view.getNodeIndices('viewlocs')
+            d2s = view.distancesToSoma('viewlocs')
+            n_node = len(view.nodes)
+            assert view.treetype == views[ii % 2].treetype
+            return ii % 2, tuple(nids), tuple(d2s), n_node
+        pool = ThreadPool(4)
+        try:
+            results = pool.map(query, range(200))
+        finally:
+            pool.close()
+            pool.join()
+        assert len(set(res for res in results if res[0] == 0)) == 1
+        assert len(set(res for res in results if res[0] == 1)) == 1
+        res_orig = next(res for res in results if res[0] == 0)
+        res_comp = next(res for res in results if res[0] == 1)
+        assert res_orig[1] == (1,4,5,6,6,7,8) and res_orig[3] == 6
+        assert res_comp[1] == (1,4,6,6,6,8,8) and res_comp[3] == 4
+        assert np.allclose(res_orig[2], res_comp[2])
+        assert self.tree.treetype == 'original'
+
     def testInputArgConversion(self):
         self.loadTree()
         nodes = self.tree._convertNodeArgToNodes(None)
@@ -187,6 +365,12 @@ class TestMorphTree():
         assert self.tree.getNodesInBasalSubtree() == nodes
         nodes = self.tree._convertNodeArgToNodes('axonal')
         assert self.tree.getNodesInAxonalSubtree() == nodes
+        # modifying the returned list does not affect the cached regions
+        nodes = self.tree.getNodesInApicalSubtree()
+        nodes.append(self.tree[1])
+        assert self.tree[1] not in self.tree.getNodesInApicalSubtree()
+        assert [node.index for node in self.tree.getNodesInApicalSubtree()] == \
+               [node.index for node in self.tree if node.swc_type == 4]
         nodes_ = [self.tree[5], self.tree[7]]
         nodes = self.tree._convertNodeArgToNodes(nodes_)
         assert nodes_ == nodes
@@ -232,6 +416,86 @@ class TestMorphTree():
         assert locs[4].comp_loc == {'node': 6, 'x': .75}
         assert locs[5].comp_loc == {'node': 8, 'x': .75}
 
+    def testLocArray(self):
+        self.loadTree(reinitialize=1)
+        locs = [(1, .5), (4, .5), (5, .5), (7, .5), (6, .5), (8, .5)]
+        locarr = LocArray(locs, self.tree)
+        assert len(locarr) == 6
+        assert list(locarr['node']) == [1,4,5,7,6,8]
+        assert np.allclose(locarr['x'], .5)
+        # construction from arrays and from other location sets
+        locarr_ = LocArray({'node': np.array([1,4,5,7,6,8]),
+                            'x': .5*np.ones(6)}, self.tree)
+        assert np.array_equal(locarr_['node'], locarr['node'])
+        locarr_ = LocArray([MorphLoc(loc, self.tree) for loc in locs],
+                           self.tree)
+        assert np.array_equal(locarr_['node'], locarr['node'])
+        locarr_ = copy.copy(locarr)
+        assert np.array_equal(locarr_['node'], locarr['node'])
+        assert locarr_['node'] is not locarr['node']
+        with pytest.raises(ValueError):
+            LocArray([(4, 1.5)], self.tree)
+        with pytest.raises(TypeError):
+            LocArray([4], self.tree)
+        # sequence behaviour
+        assert isinstance(locarr[2], MorphLoc) and locarr[2] == (5, .5)
+        assert locarr[-1] == (8, .5)
+        assert [loc['node'] for loc in locarr] == [1,4,5,7,6,8]
+        assert isinstance(locarr[1:3], LocArray)
+        assert list(locarr[1:3]['node']) == [4,5]
+        assert list(locarr[[0,5]]['node']) == [1,8]
+        assert list((locarr[:2] + [(6, 1.)])['node']) == [1,4,6]
+        assert list(([(6, 1.)] + locarr[:2])['node']) == [6,1,4]
+        assert locarr.index((7, .5)) == 3
+        assert locarr.index(MorphLoc((1, .2), self.tree)) == 0
+        assert locarr.count({'node': 8, 'x': .5}) == 1
+        assert locarr.count((8, .4)) == 0
+        assert (6, .5) in locarr and (6, .4) not in locarr
+        with pytest.raises(ValueError):
+            locarr.index((8, .4))
+        assert not hasattr(locarr, 'append')
+        # conversion to the computational tree is the same as for `MorphLoc`
+        self.tree.setCompTree()
+        self.tree.treetype = 'computational'
+        assert list(locarr['node']) == [1,4,6,8,6,8]
+        assert np.allclose(locarr['x'], [.5,.5,.25,.25,.75,.75])
+        assert locarr[2]['node'] == 6 and np.allclose(locarr[2]['x'], .25)
+        for loc, loc_ in zip(locarr, locs):
+            loc_ = MorphLoc(loc_, self.tree)
+            assert loc['node'] == loc_['node']
+            assert np.allclose(loc['x'], loc_['x'])
+        # initialization on the computational tree
+        locarr_ = LocArray([(1, .5), (4, .5), (6, .25), (8, .75)], self.tree,
+                           set_as_comploc=True)
+        self.tree.treetype = 'original'
+        assert list(locarr_['node']) == [1,4,5,8]
+        assert np.allclose(locarr_['x'], .5)
+        for loc in locarr_:
+            loc_ = MorphLoc(loc.comp_loc, self.tree, set_as_comploc=True)
+            assert loc == loc_
+        # storage of location arrays
+        self.tree.storeLocs(locarr, 'locarr')
+        locarr_ = self.tree.getLocs('locarr')
+        assert isinstance(locarr_, LocArray) and locarr_ is not locarr
+        assert list(self.tree.getNodeIndices('locarr')) == [1,4,5,7,6,8]
+        self.tree.treetype = 'computational'
+        assert list(self.tree.getNodeIndices('locarr')) == [1,4,6,8,6,8]
+        self.tree.treetype = 'original'
+        self.tree.addLoc((7, 1.), 'locarr')
+        assert list(self.tree.getNodeIndices('locarr')) == [1,4,5,7,6,8,7]
+        self.tree.treetype = 'computational'
+        assert list(self.tree.getNodeIndices('locarr')) == [1,4,6,8,6,8,8]
+        assert np.allclose(self.tree.getXCoords('locarr')[-1], .5)
+        self.tree.treetype = 'original'
+        # large location sets
+        n_loc = 100000
+        nodes = self.tree.nodes[1:]
+        nids = np.array([nodes[ii].index for ii in
+                         np.random.randint(len(nodes), size=n_loc)])
+        self.tree.storeLocs({'node': nids, 'x': np.random.rand(n_loc)}, 'big')
+        with self.tree.treetypeContext('computational'):
+            assert np.all(np.in1d(self.tree.getNodeIndices('big'), [4,6,8]))
+
     def testPathLength(self):
         self.loadTree()
         # lengths in the original tree
@@ -277,6 +541,27 @@ class TestMorphTree():
         assert np.allclose(L, 20.)
         L = self.tree.pathLength({'node': 8, 'x': .2}, {'node': 4, 'x': .5})
         assert np.allclose(L, 110.)
+        # weighted average radii
+        L, R = self.tree.pathLength({'node': 6, 'x': .5}, {'node': 4, 'x': .5},
+                                    compute_radius=1)
+        assert np.allclose([L, R], [125., (75.*.75 + 50.) / 125.])
+        self.tree.treetype = 'original'
+        L, R = self.tree.pathLength({'node': 6, 'x': .5}, {'node': 4, 'x': .5},
+                                    compute_radius=1)
+        assert np.allclose([L, R], [125., (25.*.5 + 50. + 50.) / 125.])
+        L, R = self.tree.pathLength({'node': 4, 'x': .5}, {'node': 8, 'x': 1.},
+                                    compute_radius=1)
+        assert np.allclose([L, R], [150., (50. + 50. + 50.*.5) / 150.])
+        L, R = self.tree.pathLength({'node': 6, 'x': .5}, {'node': 6, 'x': .1},
+                                    compute_radius=1)
+        assert np.allclose([L, R], [20., .5])
+        # the common root of a set of locations
+        self.tree.storeLocs([(6, .5), (8, .5)], 'common')
+        assert self.tree.findCommonRoot('common') is self.tree[4]
+        self.tree.storeLocs([(6, .5), (5, .5)], 'common')
+        assert self.tree.findCommonRoot('common') is self.tree[5]
+        self.tree.storeLocs([(6, .5), (1, .5)], 'common')
+        assert self.tree.findCommonRoot('common') is self.tree[1]
 
     def testLocStorageRetrievalLookup(self):
         self.loadTree()
@@ -351,6 +636,18 @@ class TestMorphTree():
         nodes = self.tree.getNodesInSubtree(self.tree[5], self.tree[4])
         locinds = self.tree.getLocindsOnNodes('testlocs', nodes)
         assert locinds == [2,1,3,4,5,6]
+        # test locinds in the subtree of a node, from the per-node index
+        locinds = self.tree.getLocindsInSubtree('testlocs', self.tree[5])
+        assert locinds == [3,4,5,6]
+        locinds = self.tree.getLocindsInSubtree('testlocs', self.tree[4])
+        assert locinds[:2] == [2,1] and sorted(locinds) == list(range(1,9))
+        locinds = self.tree.getLocindsInSubtree('testlocs', self.tree[7])
+        assert locinds == [7,8]
+        # the index follows a new set stored under the same name
+        self.tree.storeLocs([(7, .5), (6, .3), (5, 1.), (5, .2)], 'testlocs')
+        assert self.tree.getLocindsInSubtree('testlocs', self.tree[5]) == \
+               [3,2,1]
+        self.tree.storeLocs(locs, 'testlocs')
         # find the nearest locs
         locs = [(1,.5), (4, .5), (5, .4), (5, 1.),
                 (6, .5), (6, 1.), (8, .5), (8, 1.)]
@@ -382,6 +679,47 @@ class TestMorphTree():
         assert locinds1[0] == 1
         assert locinds2[0] == 1
 
+    def testNearestLocArrays(self):
+        self.loadTree()
+        locs = [(1,.5), (4, .5), (5, .4), (5, 1.),
+                (6, .5), (6, 1.), (8, .5), (8, 1.)]
+        self.tree.storeLocs(locs, 'nearlocs')
+        qlocs = [(7, .5), (1,.6), (6, .1), (6, .7), (4, .5)]
+        locinds, lengths = self.tree.getNearestLocindArrays(qlocs, 'nearlocs')
+        assert locinds.tolist() == [2, 0, 3, 4, 1]
+        assert np.allclose(lengths, [45., 0., 5., 10., 0.])
+        locinds, lengths = self.tree.getNearestLocindArrays(qlocs, 'nearlocs',
+                                                            direction=2)
+        assert locinds.tolist() == [6, 0, 4, 5, 1]
+        assert np.allclose(lengths, [50., 0., 20., 15., 0.])
+        with pytest.raises(ValueError):
+            self.tree.getNearestLocindArrays(qlocs, 'nearlocs', direction=3)
+        # no locations in the given direction
+        self.tree.storeLocs([(5, .5), (8, .5)], 'nearlocs')
+        locinds, lengths = self.tree.getNearestLocindArrays(
+                                [(1, .5), (6, .5)], 'nearlocs', direction=1)
+        assert locinds.tolist() == [-1, 0] and np.isinf(lengths[0])
+        assert self.tree.getNearestLocinds([(1, .5), (6, .5)], 'nearlocs',
+                                           direction=1) == [None, 0]
+        # both directions together give the nearest location overall
+        fname = 'test_morphologies/sovvalidationtree.swc'
+        tree = MorphTree(fname, types=[1,3,4])
+        tree.storeLocs(tree.distributeLocsRandom(20, add_soma=0, seed=37),
+                       'ref')
+        qlocs = tree.distributeLocsRandom(30, seed=38)
+        for direction in [0, 1, 2]:
+            locinds, lengths = tree.getNearestLocindArrays(qlocs, 'ref',
+                                                           direction=direction)
+            for qloc, locind, length in zip(qlocs, locinds, lengths):
+                if locind < 0:
+                    assert direction > 0 and np.isinf(length)
+                    continue
+                assert np.allclose(length,
+                                   tree.pathLength(qloc, tree.getLocs('ref')[locind]))
+                if direction == 0:
+                    assert np.allclose(length, min([tree.pathLength(qloc, loc) \
+                                       for loc in tree.getLocs('ref')]))
+
     def testDistances(self):
         self.loadTree()
         locs = [(1,.5), (4, 1.), (5, .5), (6, .5), (6, 1.)]
@@ -392,6 +730,41 @@ class TestMorphTree():
         d2b = self.tree.distancesToBifurcation('testlocs')
         assert np.allclose(d2b, np.array([0.,100.,25.,75.,100.]))
 
+    def testPathLengthMatrix(self, tmpdir):
+        self.loadTree()
+        locs = [(1,.5), (4, 1.), (5, .5), (6, .5), (6, 1.), (7, .2), (8, .5)]
+        self.tree.storeLocs(locs, 'matlocs')
+        n_loc = len(locs)
+        for treetype in ['original', 'computational']:
+            if treetype == 'computational': self.tree.setCompTree()
+            self.tree.treetype = treetype
+            # reference from pairwise computation
+            L_ref = np.zeros((n_loc, n_loc)); R_ref = np.zeros((n_loc, n_loc))
+            for ii, loc1 in enumerate(self.tree.getLocs('matlocs')):
+                for jj, loc2 in enumerate(self.tree.getLocs('matlocs')):
+                    if ii != jj:
+                        L_ref[ii,jj], R_ref[ii,jj] = \
+                            self.tree.pathLength(loc1, loc2, compute_radius=1)
+            L_mat = self.tree.pathLengthMatrix('matlocs')
+            assert np.allclose(L_mat, L_ref)
+            assert np.allclose(L_mat, L_mat.T)
+            L_mat, R_mat = self.tree.pathLengthMatrix('matlocs', compute_radius=1)
+            offdiag = ~np.eye(n_loc, dtype=bool)
+            assert np.allclose(R_mat[offdiag], R_ref[offdiag])
+            # blockwise computation in a given array
+            out = np.zeros((n_loc, n_loc))
+            L_mat = self.tree.pathLengthMatrix('matlocs', block_size=3, out=out)
+            assert L_mat is out and np.allclose(out, L_ref)
+        # blockwise computation in a memory-mapped file
+        fname = str(tmpdir.join('pathlengths.npy'))
+        L_mat, R_mat = self.tree.pathLengthMatrix('matlocs', compute_radius=1,
+                                                  block_size=2, filename=fname)
+        assert isinstance(L_mat, np.memmap)
+        assert np.allclose(np.load(fname), L_ref)
+        assert np.allclose(np.load(str(tmpdir.join('pathlengths_radius.npy'))),
+                           R_mat)
+        self.tree.treetype = 'original'
+
     def testLocDistribution(self):
         self.loadTree()
         # check comptree resetting
@@ -460,6 +833,41 @@ class TestMorphTree():
         assert len(locs) == 0
         with pytest.raises(ValueError):
             self.tree.distributeLocsRandom(10, node_arg='bad type')
+        # seeded random distributions, at most one location per node
+        locs1 = self.tree.distributeLocsRandom(10, seed=5)
+        locs2 = self.tree.distributeLocsRandom(10, seed=5)
+        assert isinstance(locs1, LocArray) and locs1['node'][0] == 1
+        assert np.allclose(locs1['x'], locs2['x'])
+        assert len(set(locs1['node'].tolist())) == len(locs1)
+        # nodes near the distal end of a drawn node are excluded
+        for seed in range(5):
+            locs = self.tree.distributeLocsRandom(10, dx=60., add_soma=0,
+                                                  seed=seed)
+            nids = locs['node']
+            for ii, jj in zip(*np.triu_indices(len(nids), 1)):
+                assert min(self.tree.pathLength((nids[ii], 1.), (nids[jj], 0.)),
+                           self.tree.pathLength((nids[ii], 1.), (nids[jj], 1.))) \
+                       >= 60.
+        # independent draws with node weights
+        locs = self.tree.distributeLocsRandom(1000, dx=None, add_soma=0,
+                                              seed=2, weights='area')
+        assert len(locs) == 1000
+        assert 0 < np.sum(locs['node'] == 6) < np.sum(locs['node'] == 4)
+        locs = self.tree.distributeLocsRandom(100, dx=None, add_soma=0,
+                            node_arg=self.tree[5], weights=np.array([0., 1.]))
+        assert np.all(locs['node'] == 6)
+        with pytest.raises(ValueError):
+            self.tree.distributeLocsRandom(10, weights=np.ones(2))
+        with pytest.raises(ValueError):
+            self.tree.distributeLocsRandom(10, weights='volume')
+        # extension with bifurcation locations
+        locs = self.tree.extendWithBifurcationLocs([(1, .5), (6, .5), (8, .5),
+                                                    (4, 1.), (6, .5)])
+        assert [(loc['node'], loc['x']) for loc in locs] == \
+               [(1, .5), (6, .5), (8, .5), (4, 1.)]
+        locs = self.tree.extendWithBifurcationLocs([(6, .5), (8, .5)])
+        assert [(loc['node'], loc['x']) for loc in locs] == \
+               [(6, .5), (8, .5), (1, 1.), (4, 1.)]
 
     def testTreeCreation(self):
         self.loadTree(self)
@@ -479,6 +887,34 @@ class TestMorphTree():
             assert np.allclose(new_xyzs[ii], new_node.xyz)
             assert new_inds[ii] == new_node.index
 
+    def testResampling(self):
+        self.loadTree(reinitialize=1)
+        surface = lambda tree: sum([2.*np.pi*node.R*node.L for node in tree])
+        resistance = lambda tree: sum([node.L / (np.pi*node.R**2) \
+                                       for node in tree if node.index != 1])
+        # splitting nodes is exact
+        new_tree, errors = self.tree.createResampledTree(25.)
+        assert [node.index for node in new_tree] == \
+               [1, 9, 10, 11, 4, 12, 13, 14, 6, 15, 16, 17, 8]
+        assert np.allclose(new_tree[10].xyz, [50., 0., 0.])
+        assert np.allclose(new_tree[12].xyz, [100., 25., 0.])
+        assert np.allclose([node.L for node in new_tree][1:], 25.)
+        assert np.allclose(errors, 0.)
+        assert len(new_tree[1].getChildNodes(skip_inds=[])) == 3
+        # merging nodes preserves surface and axial resistance
+        new_tree, errors = self.tree.createResampledTree(200.)
+        assert [node.index for node in new_tree] == [1, 4, 6, 8]
+        assert np.allclose(new_tree[6].xyz, [100., 100., 0.])
+        assert np.abs(surface(new_tree) - surface(self.tree)) < 1e-8
+        assert np.abs(resistance(new_tree) - resistance(self.tree)) < 1e-8
+        assert np.allclose(errors[:2], 0.) and np.all(errors[2:] > 0.)
+        # the original tree is not modified
+        assert [node.index for node in self.tree] == [1, 4, 5, 6, 7, 8]
+        with pytest.raises(ValueError):
+            self.tree.createResampledTree(0.)
+        with pytest.raises(ValueError):
+            self.tree.createResampledTree(.1, electrotonic=True)
+
     def testPlotting(self, pshow=0):
         self.loadTree()
         self.tree.setCompTree()
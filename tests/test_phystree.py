@@ -4,6 +4,14 @@ import matplotlib.pyplot as pl
 import pytest
 
 from neat import PhysTree, PhysNode
+from neat.channels import channelcollection
+
+
+class NaCustom(channelcollection.Na_Ta):
+    '''
+    Ion channel that is not part of `channelcollection`
+    '''
+    pass
 
 
 class TestPhysTree():
@@ -41,6 +49,136 @@ class TestPhysTree():
                    1e-9
             assert np.abs(node.e_eq + 75.) < 1e-9
 
+    def testPhysiology(self):
+        self.loadTree(reinitialize=1)
+        arr = self.tree.array_tree
+        rev = self.tree.getRevision('parameter')
+        self.tree.setPhysiology(2., lambda x: 100.*1e-6 + x*1e-8,
+                                node_arg=[self.tree[5], self.tree[6]])
+        assert self.tree.getRevision('parameter') == rev + 1
+        assert np.abs(self.tree[5].c_m - 2.) < 1e-10
+        assert np.abs(self.tree[6].r_a - (100.*1e-6 + 175.*1e-8)) < 1e-10
+        assert np.abs(self.tree[4].c_m - 1.) < 1e-10
+        with pytest.raises(TypeError):
+            self.tree.setPhysiology('wrong', 100.*1e-6)
+        # the columns of the array tree are updated
+        arr_ = self.tree.array_tree
+        assert arr_ is arr
+        assert np.allclose(arr['c_m'], [1., 1., 2., 2., 1., 1.])
+        self.tree.addCurrent('L', 100., -75.)
+        assert np.allclose(self.tree.array_tree['g_L'], 100.)
+        # modifications through the nodes increase the parameter revision
+        rev = self.tree.getRevision('parameter')
+        self.tree[5].setEEq(-70.)
+        assert self.tree.getRevision('parameter') == rev + 1
+        assert self.tree.getRevision('parameter') == rev + 1
+        assert np.allclose(self.tree.array_tree['e_eq'],
+                           [-75., -75., -70., -75., -75., -75.])
+        # other trees and their nodes do not affect the revision
+        tree = PhysTree(file_n='test_morphologies/Ttree.swc')
+        tree.array_tree
+        tree[5].setEEq(-70.)
+        assert self.tree.getRevision('parameter') == rev + 1
+        # the copied nodes of the computational tree are owned by the tree
+        self.tree.setCompTree()
+        self.tree.treetype = 'computational'
+        self.tree.array_tree
+        rev = self.tree.getRevision('parameter')
+        self.tree[4].setEEq(-65.)
+        assert self.tree.getRevision('parameter') == rev + 1
+        self.tree.treetype = 'original'
+
+    def testDistributions(self):
+        self.loadTree(reinitialize=1)
+        d2s_ref = {node.index: self.tree.pathLength({'node': node.index,
+                                                     'x': .5}, (1., .5)) \
+                   for node in self.tree}
+        # a distribution accepting arrays is evaluated once for all nodes
+        calls = []
+        def g_vec(d2s):
+            calls.append(d2s)
+            return 10. + d2s
+        self.tree.addCurrent('Na_Ta', g_vec, 50.)
+        assert len(calls) == 1
+        for node in self.tree:
+            assert np.abs(node.currents['Na_Ta'][0] - \
+                          (10. + d2s_ref[node.index])) < 1e-10
+        # a distribution accepting only floats is evaluated per node
+        g_step = lambda d2s: 1. if d2s < 120. else 2.
+        self.tree.addCurrent('Kv3_1', g_step, -85.)
+        for node in self.tree:
+            assert node.currents['Kv3_1'][0] == \
+                   (1. if d2s_ref[node.index] < 120. else 2.)
+        # a constant function is evaluated per node as well
+        self.tree.addCurrent('Kv3_1', lambda d2s: 3., -85.)
+        for node in self.tree:
+            assert node.currents['Kv3_1'][0] == 3.
+        # other errors are not caught and the function is called only once
+        calls = []
+        def g_err(d2s):
+            calls.append(d2s)
+            raise KeyError('g_err')
+        with pytest.raises(KeyError):
+            self.tree.addCurrent('Kv3_1', g_err, -85.)
+        assert len(calls) == 1
+
+    def testResampling(self):
+        self.loadTree(reinitialize=1)
+        self.tree.fitLeakCurrent(e_eq_target=-75., tau_m_target=10.)
+        self.tree.addCurrent('Na_Ta', 1000., 50., node_arg=[self.tree[6]])
+        # node 5 is retained since the physiology of node 6 differs
+        new_tree, errors = self.tree.createResampledTree(200.)
+        assert [node.index for node in new_tree] == [1, 4, 5, 6, 8]
+        assert 'Na_Ta' in new_tree[6].currents
+        assert 'Na_Ta' not in new_tree[5].currents
+        assert 'Na_Ta' in new_tree.channel_storage
+        # resampling to an electrotonic length
+        lambda_m = np.sqrt(1e-4 / (2. * 100. * 100.*1e-6)) * 1e4 # um
+        new_tree, errors = self.tree.createResampledTree(25. / lambda_m,
+                                                         electrotonic=True)
+        assert np.allclose([node.L for node in new_tree \
+                            if node.index in [9, 10, 11, 4]], 25.)
+        assert np.allclose(errors[:5], 0.)
+
+    def testNPZCache(self, tmpdir):
+        self.loadTree(reinitialize=1)
+        self.tree.addCurrent('L', 100., -75.)
+        self.tree.addCurrent('Na_Ta', 1000., 50., node_arg=[self.tree[4]])
+        self.tree.addConcMech('ca', params={'tau': 100.})
+        self.tree.setCompTree()
+        fname = str(tmpdir.join('Ttree.npz'))
+        self.tree.writeNPZTreeToFile(fname)
+        tree = PhysTree()
+        tree.readNPZTreeFromFile(fname)
+        for treetype in ['original', 'computational']:
+            self.tree.treetype = treetype; tree.treetype = treetype
+            for node, node_ in zip(self.tree, tree):
+                assert node.index == node_.index
+                assert node.currents == node_.currents
+                assert node.concmechs == node_.concmechs
+                assert np.allclose([node.c_m, node.r_a, node.L, node.R],
+                                   [node_.c_m, node_.r_a, node_.L, node_.R])
+        assert 'Na_Ta' in tree.channel_storage
+        assert 'Na_Ta' not in tree[1].currents
+
+    def testNPZCacheChannelClasses(self, tmpdir):
+        self.loadTree(reinitialize=1)
+        self.tree.addCurrent('L', 100., -75.)
+        self.tree.channel_storage['NaCustom'] = NaCustom()
+        self.tree.addCurrent('NaCustom', 1000., 50., node_arg=[self.tree[4]])
+        fname = str(tmpdir.join('Ttree.npz'))
+        self.tree.writeNPZTreeToFile(fname)
+        tree = PhysTree().readNPZTreeFromFile(fname)
+        assert isinstance(tree.channel_storage['NaCustom'], NaCustom)
+        assert tree[4].currents['NaCustom'] == (1000., 50.)
+        # channel classes that can not be imported are refused on writing
+        class NaLocal(channelcollection.Na_Ta):
+            pass
+        self.tree.channel_storage['NaLocal'] = NaLocal()
+        self.tree.addCurrent('NaLocal', 1000., 50., node_arg=[self.tree[4]])
+        with pytest.raises(ValueError):
+            self.tree.writeNPZTreeToFile(fname)
+
 
 if __name__ == '__main__':
     tphys = TestPhysTree()
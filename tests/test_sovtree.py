@@ -97,11 +97,22 @@ class TestSOVTree():
         assert np.allclose(z_mat_a - z_mat_a.T, np.zeros(z_mat_a.shape))
         for ii, z_row in enumerate(z_mat_a):
             assert np.argmax(z_row) == ii
+        alphas, gammas = self.tree.getImportantModes(name='1', eps=1e-10)
+        z_mat_ref = np.sum(gammas[:,:,np.newaxis] * gammas[:,np.newaxis,:] / \
+                           alphas[:,np.newaxis,np.newaxis], 0).real
+        assert np.allclose(z_mat_a, z_mat_ref)
+        # computation in blocks of rows
+        z_mat_c = self.tree.calcImpedanceMatrix(name='1', eps=1e-10,
+                                                block_size=2)
+        assert np.allclose(z_mat_a, z_mat_c)
         # test Fourrier impedance matrix
         ft = ke.FourrierTools(np.arange(0.,100.,0.1))
         z_mat_ft = self.tree.calcImpedanceMatrix(name='1', eps=1e-10, freqs=ft.s)
         print z_mat_ft[ft.ind_0s,:,:]
         print z_mat_a
+        z_mat_ft_ = self.tree.calcImpedanceMatrix(name='1', eps=1e-10,
+                                                  freqs=ft.s, block_size=3)
+        assert np.allclose(z_mat_ft, z_mat_ft_)
         assert np.allclose(z_mat_ft[ft.ind_0s,:,:].real, \
                            z_mat_a, atol=1e-1) # check steady state
         assert np.allclose(z_mat_ft - np.transpose(z_mat_ft, axes=(0,2,1)), \
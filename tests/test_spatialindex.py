@@ -0,0 +1,70 @@
+import numpy as np
+
+import pytest
+
+from neat import MorphTree, SegmentIndex, LocArray
+
+
+class TestSegmentIndex():
+    def loadTree(self):
+        '''
+        Load the T-tree morphology in memory
+
+          6--5--4--7--8
+                |
+                |
+                1
+        '''
+        fname = 'test_morphologies/Ttree.swc'
+        self.tree = MorphTree(fname, types=[1,3,4])
+
+    def testProjection(self):
+        p0 = np.array([[0.,0.,0.], [0.,0.,0.]])
+        p1 = np.array([[10.,0.,0.], [0.,0.,0.]])
+        sindex = SegmentIndex(p0, p1, np.array([1., 5.]))
+        ts, ds = sindex.project(np.array([[4.,3.,0.], [-3.,4.,0.]]),
+                                np.array([0, 0]))
+        assert np.allclose(ts, [.4, 0.]) and np.allclose(ds, [3., 5.])
+        ts, ds = sindex.project(np.array([[4.,3.,0.]]), np.array([1]))
+        assert np.allclose(ts, [.5]) and np.allclose(ds, [5.])
+        segs, ts, ds = sindex.query(np.array([[4.,3.,0.], [11.,0.,0.]]))
+        assert segs.tolist() == [0, 0]
+        assert np.allclose(ts, [.4, 1.]) and np.allclose(ds, [3., 1.])
+        # distances to the surface
+        segs, ts, ds = sindex.query(np.array([[8.,3.,0.], [1.,1.,0.]]),
+                                    surface=True)
+        assert segs.tolist() == [0, 1]
+        assert np.allclose(ds, [2., 0.])
+
+    def testNearestLocs(self):
+        self.loadTree()
+        points = np.array([[100., 25., 0.], [90., -120., 3.], [1., 2., 0.]])
+        locs, distances = self.tree.getNearestLocsToPoints(points)
+        assert isinstance(locs, LocArray)
+        assert locs['node'].tolist() == [5, 8, 4]
+        assert np.allclose(locs['x'], [.5, 1., .01])
+        assert np.allclose(distances, [0., np.sqrt(509.), 2.])
+        # the soma is closer when measuring to the membrane surface
+        locs, distances = self.tree.getNearestLocsToPoints(points, surface=True,
+                                                           name='synlocs')
+        assert self.tree.getNodeIndices('synlocs').tolist() == [5, 8, 1]
+        assert np.allclose(distances, [0., np.sqrt(509.) - .5, 0.])
+        assert self.tree.getSegmentIndex() is self.tree.getSegmentIndex()
+
+    def testBruteForce(self):
+        fname = 'test_morphologies/sovvalidationtree.swc'
+        tree = MorphTree(fname, types=[1,3,4])
+        sindex = tree.getSegmentIndex(max_piece_length=20.)
+        xyz = np.array([node.xyz for node in tree])
+        np.random.seed(11)
+        points = xyz.min(0) - 20. + \
+                 np.random.rand(500, 3) * (xyz.max(0) - xyz.min(0) + 40.)
+        for surface in [False, True]:
+            segs, ts, ds = sindex.query(points, surface=surface, k=1,
+                                        block_size=64)
+            ts_all, ds_all = sindex.project(points[:,None,:],
+                                            np.arange(len(sindex))[None,:])
+            if surface:
+                ds_all = np.maximum(ds_all - sindex.radius[None,:], 0.)
+            assert np.allclose(ds, np.min(ds_all, axis=1))
+            assert np.allclose(ds, ds_all[np.arange(len(points)), segs])
@@ -1,4 +1,7 @@
-from neat import STree, SNode
+import copy
+import pickle
+
+from neat import STree, SNode, SubTreeView
 
 import pytest
 
@@ -73,6 +76,28 @@ class TestSTree():
             assert self.tree[ii].index == ii
         assert self.tree[4] == None
 
+    def testIndexMap(self):
+        self.createTree()
+        # index map is kept up to date when the tree is modified
+        newnode = SNode(15)
+        self.tree.insertNode(newnode, self.nodelist[1], self.nodelist[2:3])
+        assert self.tree[15] is newnode
+        self.tree.removeSingleNode(newnode)
+        assert self.tree[15] == None
+        self.tree.addNodeWithParent(SNode(4), self.nodelist[3])
+        assert self.tree[4].parent_node is self.nodelist[3]
+        self.tree.removeNode(self.nodelist[3])
+        assert self.tree[3] == None and self.tree[4] == None
+        assert self.tree[2] is self.nodelist[2]
+        # index map follows the new indices
+        self.tree.resetIndices(n=10)
+        assert [self.tree[ii] for ii in xrange(10, 13)] == self.nodelist[0:3]
+        assert self.tree[0] == None
+        # lookup remains valid on a new root
+        newroot = SNode(20)
+        self.tree.insertNode(newroot, None)
+        assert self.tree[20] is newroot and self.tree[10] is self.nodelist[0]
+
     def testIter(self):
         self.createTree()
         # full iteration
@@ -82,6 +107,168 @@ class TestSTree():
         nodeset = set([node for node in self.tree.__iter__(self.nodelist[1])])
         assert nodeset == set(self.nodelist[1:])
 
+    def testTraversalOrders(self):
+        self.createTree2()
+        assert [node.index for node in self.tree.getOrderedNodes()] == \
+                    [0, 1, 2, 4, 5, 3, 6]
+        assert [node.index for node in self.tree.getOrderedNodes('postorder')] == \
+                    [4, 5, 2, 6, 3, 1, 0]
+        assert [node.index for node in self.tree.getOrderedNodes('bfs')] == \
+                    [0, 1, 2, 3, 4, 5, 6]
+        with pytest.raises(ValueError):
+            self.tree.getOrderedNodes('inorder')
+        # orders are cached and updated when the tree changes
+        assert self.tree.getOrderedNodes() is self.tree.getOrderedNodes()
+        self.tree.addNodeWithParent(SNode(7), self.nodelist[6])
+        assert [node.index for node in self.tree.getOrderedNodes('postorder')] == \
+                    [4, 5, 2, 7, 6, 3, 1, 0]
+        assert len(self.tree) == 8
+        # the node list can be modified without affecting the cached order
+        nodes = self.tree.nodes
+        del nodes[0]
+        assert len(self.tree.nodes) == 8
+
+    def testSweep(self):
+        self.createTree2()
+        # leaf-to-root sweep, children are visited before their parent
+        visited = []
+        def countSubtree(node, visited=visited):
+            node['n_sub'] = 1 + sum([cnode['n_sub'] for cnode in node.child_nodes])
+            visited.append(node)
+        self.tree.sweep(countSubtree, order='postorder')
+        assert [node['n_sub'] for node in self.nodelist] == [7, 6, 3, 2, 1, 1, 1]
+        assert visited == self.tree.getOrderedNodes('postorder')
+        # root-to-leaf sweep with keyword arguments
+        def setDepth(node, offset=0):
+            pnode = node.parent_node
+            node['depth'] = offset if pnode is None else pnode['depth'] + 1
+        self.tree.sweep(setDepth, order='preorder', offset=1)
+        assert [node['depth'] for node in self.nodelist] == [1, 2, 3, 3, 4, 4, 4]
+        # batched sweep processes one depth level at a time
+        levels = []
+        self.tree.sweep(lambda nodes: levels.append([n.index for n in nodes]),
+                        order='postorder', batch=True)
+        assert levels == [[4, 5, 6], [2, 3], [1], [0]]
+        levels = []
+        self.tree.sweep(lambda nodes: levels.append([n.index for n in nodes]),
+                        order='preorder', batch=True)
+        assert levels == [[0], [1], [2, 3], [4, 5, 6]]
+        with pytest.raises(ValueError):
+            self.tree.sweep(setDepth, order='bfs')
+
+    def testSlots(self):
+        node = SNode(0)
+        assert not hasattr(node, '__dict__')
+        with pytest.raises(AttributeError):
+            node.foo = 1.
+        # subclasses can opt in to dynamic attributes
+        class DynamicNode(SNode):
+            __slots__ = ('__dict__',)
+        dnode = DynamicNode(1)
+        dnode.foo = 1.
+        assert dnode.foo == 1.
+        # copying and pickling preserve the slot attributes
+        self.createTree2()
+        self.nodelist[2]['tag'] = 'a'
+        tree = copy.deepcopy(self.tree)
+        assert [node.index for node in tree] == [0, 1, 2, 4, 5, 3, 6]
+        assert tree[2]['tag'] == 'a' and tree[2] is not self.nodelist[2]
+        assert tree[2].parent_node is tree[1]
+        node = pickle.loads(pickle.dumps(self.nodelist[2], -1))
+        assert node.index == 2 and node['tag'] == 'a'
+        assert [cnode.index for cnode in node.child_nodes] == [4, 5]
+
+    def testCopy(self):
+        self.createTree2()
+        shared = {'a': 1}
+        for node in self.nodelist:
+            node['shared'] = shared
+        tree = copy.copy(self.tree)
+        assert [node.index for node in tree] == [0, 1, 2, 4, 5, 3, 6]
+        for node, node_ in zip(self.tree, tree):
+            assert node is not node_
+            assert [cn.index for cn in node.child_nodes] == \
+                   [cn.index for cn in node_.child_nodes]
+        # deep copies preserve objects that are shared between nodes
+        assert tree[4]['shared'] is tree[6]['shared']
+        assert tree[4]['shared'] is not shared
+        # structural copies share the node attributes
+        tree = self.tree.__copy__(deep=False)
+        assert tree[4]['shared'] is shared
+        tree.removeNode(tree[2])
+        assert len(tree) == 4 and len(self.tree) == 7
+        # copy of a subtree
+        subtree = self.tree.getSubTree(self.nodelist[2])
+        assert [node.index for node in subtree] == [2, 4, 5]
+        assert subtree.root.parent_node is None
+        assert self.nodelist[2].parent_node is self.nodelist[1]
+
+    def testSubTreeView(self):
+        self.createTree2()
+        view = self.tree.getSubTree(self.nodelist[1], view=True)
+        assert isinstance(view, SubTreeView)
+        # the view shares the nodes of the tree
+        assert [node.index for node in view] == [1, 2, 4, 5, 3, 6]
+        assert view[4] is self.nodelist[4] and view[0] is None
+        assert view.root is self.nodelist[1] and view.isRoot(self.nodelist[1])
+        assert [node.index for node in view.leafs] == [4, 5, 6]
+        assert [node.index for node in view.pathToRoot(self.nodelist[4])] == \
+               [4, 2, 1]
+        assert view.getCommonAncestor(self.nodelist[4], self.nodelist[6]) is \
+               self.nodelist[1]
+        assert view.array_tree.index.tolist() == [1, 2, 4, 5, 3, 6]
+        # the view can not be modified
+        with pytest.raises(AttributeError):
+            view.addNodeWithParent(SNode(7), self.nodelist[6])
+        with pytest.raises(AttributeError):
+            view.removeNode(self.nodelist[2])
+        with pytest.raises(AttributeError):
+            view.root = self.nodelist[2]
+        # the view reflects changes to the underlying tree
+        self.tree.addNodeWithParent(SNode(7), self.nodelist[6])
+        assert [node.index for node in view] == [1, 2, 4, 5, 3, 6, 7]
+        assert view[7] is self.tree[7]
+
+    def testRevisions(self):
+        self.createTree2()
+        events = []
+        self.tree.addObserver(lambda tree, kind: events.append(kind))
+        rev = self.tree.getRevision()
+        cache = self.tree.getRevisionCache('test', kinds=('structure',))
+        cache['a'] = 1
+        assert self.tree.getRevisionCache('test', kinds=('structure',)) is cache
+        # parameter changes do not affect structural caches
+        self.tree.bumpRevision('parameter')
+        assert self.tree.getRevision('parameter') == rev[1] + 1
+        assert self.tree.getRevisionCache('test', kinds=('structure',)) is cache
+        assert 'a' in self.tree.getRevisionCache('test', kinds=('structure',))
+        # structural changes invalidate the cache
+        leafs = self.tree.leafs
+        self.tree.addNodeWithParent(SNode(7), self.nodelist[6])
+        assert self.tree.getRevision('structure') > rev[0]
+        assert 'a' not in self.tree.getRevisionCache('test', kinds=('structure',))
+        assert events[0] == 'parameter' and events[-1] == 'structure'
+        assert [node.index for node in leafs] == [4, 5, 6]
+        assert [node.index for node in self.tree.leafs] == [4, 5, 7]
+        with pytest.raises(ValueError):
+            self.tree.bumpRevision('bla')
+
+    def testDeepTree(self):
+        # traversal of deep trees does not hit the recursion limit
+        n_node = 5000
+        tree = STree()
+        nodes = [SNode(ii) for ii in xrange(n_node)]
+        tree.setRoot(nodes[0])
+        for node, pnode in zip(nodes[1:], nodes[:-1]):
+            tree.addNodeWithParent(node, pnode)
+        assert len(tree) == n_node
+        assert tree.nodes == nodes
+        assert tree.leafs == nodes[-1:]
+        assert len(tree.pathToRoot(nodes[-1])) == n_node
+        assert tree.__len__(nodes[10]) == n_node - 10
+        tree.removeNode(nodes[1])
+        assert len(tree) == 1
+
     def testNodeCounting(self):
         self.createTree()
         assert len(self.tree) == 4
@@ -183,6 +370,37 @@ class TestSTree():
         assert self.tree.pathBetweenNodesDepthFirst(self.nodelist[2], self.nodelist[2]) == \
                     [self.nodelist[2]]
 
+    def testCommonAncestor(self):
+        self.createTree2()
+        nl = self.nodelist
+        assert self.tree.getCommonAncestor(nl[4], nl[5]) is nl[2]
+        assert self.tree.getCommonAncestor(nl[4], nl[6]) is nl[1]
+        assert self.tree.getCommonAncestor(nl[6], nl[3]) is nl[3]
+        assert self.tree.getCommonAncestor(nl[0], nl[5]) is nl[0]
+        assert self.tree.getCommonAncestor(nl[5], nl[5]) is nl[5]
+        # on-path checks
+        assert self.tree.isOnPath(nl[1], nl[4], nl[6])
+        assert self.tree.isOnPath(nl[4], nl[4], nl[6])
+        assert not self.tree.isOnPath(nl[0], nl[4], nl[6])
+        assert not self.tree.isOnPath(nl[5], nl[4], nl[6])
+        assert self.tree.isOnPath(nl[2], nl[5], nl[0])
+        # paths use the common ancestor
+        assert self.tree.pathBetweenNodes(nl[4], nl[6]) == \
+                    [nl[4], nl[2], nl[1], nl[3], nl[6]]
+        assert self.tree.pathBetweenNodesDepthFirst(nl[4], nl[6]) == \
+                    [nl[1], nl[2], nl[4], nl[3], nl[6]]
+        # the ancestor index is updated when the tree changes
+        newnode = SNode(7)
+        self.tree.addNodeWithParent(newnode, nl[5])
+        assert self.tree.getCommonAncestor(newnode, nl[4]) is nl[2]
+        # compare with paths to the root for all pairs
+        for node1 in self.tree:
+            for node2 in self.tree:
+                path1 = self.tree.pathToRoot(node1)
+                path2 = self.tree.pathToRoot(node2)
+                anode = next(n_ for n_ in path1 if n_ in path2)
+                assert self.tree.getCommonAncestor(node1, node2) is anode
+
     def testSisterLeafs(self):
         self.createTree()
         # normal case
@@ -224,6 +442,25 @@ class TestSTree():
         nodes3 = self.tree.getNodesInSubtree(rn, subtree_root=rn)
         assert len(nodes3) == 1 and nodes3[0].index == 2
 
+    def testIsInSubtree(self):
+        self.createTree2()
+        nl = self.nodelist
+        assert self.tree.isInSubtree(nl[4], nl[2])
+        assert self.tree.isInSubtree(nl[2], nl[2])
+        assert self.tree.isInSubtree(nl[6], nl[0])
+        assert not self.tree.isInSubtree(nl[6], nl[2])
+        assert not self.tree.isInSubtree(nl[1], nl[2])
+        # subtrees are slices of the depth-first node list
+        assert [node.index for node in self.tree.gatherNodes(nl[3])] == [3, 6]
+        nodes = self.tree.getNodesInSubtree(nl[5], subtree_root=nl[1])
+        assert [node.index for node in nodes] == [1, 2, 4, 5]
+        with pytest.raises(ValueError):
+            self.tree.getNodesInSubtree(nl[5], subtree_root=nl[3])
+        bnode, sleafs, cchildren = self.tree.sisterLeafs(nl[6])
+        assert bnode is nl[1]
+        assert sleafs == [nl[6], nl[4], nl[5]]
+        assert cchildren == [nl[3], nl[2]]
+
     def testBifurcationNodes(self):
         self.createTree()
         nodes = [self.tree[3]]